@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""Suggestions for what a reader is typing: section numbers, citations
+("42 USC 1983"), places in a code ("Title 42 ch 21") and words of
+section names.
+
+Each Code's titles, chapters, parts, sections and so on (everything
+above the subsection) are entered into a ``PrefixIndex`` under several
+normalized keys:
+
+ * where it is: "title 42 chapter 21 subchapter i section 1983"
+ * its own label, "section 1983", and its number, "1983"
+ * for a section, "title 42 section 1983" and "42 usc 1983"
+ * its name, from each word that isn't a stop word on, so "civil
+   action for deprivation of rights" is also found as "deprivation" or
+   "rights"
+
+The keys are kept sorted, in one string with an array of offsets, so a
+lookup is a binary search (``bisect``) for the normalized query
+followed by a scan of the keys it is a prefix of, taking well under a
+millisecond, and a code the size of the US Code takes about 25 MB per
+process and a few hundred thousand fewer objects than a list of keys
+would. Keys are cut to ``KEY_LENGTH`` bytes, which is plenty to tell
+them apart.
+
+``import_us_code`` builds the index from the code's tree snapshot (see
+``law_code.snapshot``) and writes it next to it, and each process loads
+it on first use and again when the file is replaced, the same way as
+the snapshot.
+
+"""
+from array import array
+import bisect
+import marshal
+import os
+import re
+
+from django.conf import settings
+
+from law_code import snapshot
+from law_code.models import Section
+
+
+FORMAT_VERSION = 1
+
+KEY_LENGTH = 40
+
+INDEXED_TYPES = (Section.TITLE, Section.SUBTITLE, Section.CHAPTER,
+                 Section.SUBCHAPTER, Section.PART, Section.SUBPART,
+                 Section.DIVISION, Section.SECTION)
+
+# What readers abbreviate the labels to.
+ABBREVIATIONS = {
+    "tit": "title",
+    "subtit": "subtitle",
+    "ch": "chapter",
+    "chap": "chapter",
+    "subch": "subchapter",
+    "pt": "part",
+    "subpt": "subpart",
+    "div": "division",
+    "sec": "section",
+    "secs": "section",
+    "usca": "usc",
+    }
+
+STOP_WORDS = dict.fromkeys(
+    "a an and as at by for from in into of on or the to under with".split())
+
+# Keys a lookup looks at, per suggestion asked for, before giving up on
+# finding more; keeps a query that is a prefix of most keys fast.
+SCAN_FACTOR = 20
+
+NON_WORD_RX = re.compile(r"[^\w.]+", re.UNICODE)
+
+
+def _tokens(text):
+    "The lower case words of ``text``, ignoring punctuation."
+    if not isinstance(text, unicode):
+        text = text.decode("utf-8", "replace")
+    text = text.lower().replace(u"\xa7", u" section ")
+    # Dropping dots makes "U.S.C." "usc".
+    return NON_WORD_RX.sub(u" ", text).replace(u".", u"").split()
+
+
+def _key(tokens):
+    return u" ".join(tokens).encode("utf-8")[:KEY_LENGTH]
+
+
+def normalize_query(text):
+    """
+    The key to look up for what's been typed so far. Abbreviations are
+    expanded, except in the last word, which may be the start of a
+    longer one ("ch" is the start of "chapter" as it is, but "pt"
+    isn't of "part"). A trailing space ends the last word too, so
+    "title 4 " doesn't suggest title 42.
+
+    """
+    tokens = _tokens(text)
+    finished = text[-1:].isspace()
+    for index, token in enumerate(tokens):
+        expansion = ABBREVIATIONS.get(token)
+        if expansion is not None and (finished or index < len(tokens) - 1 or
+                                      not expansion.startswith(token)):
+            tokens[index] = expansion
+    # "42 U.S.C. § 1983" is keyed as "42 usc 1983".
+    tokens = [token for index, token in enumerate(tokens)
+              if not (token == "section" and index and tokens[index - 1] == "usc")]
+    key = _key(tokens)
+    if key and finished:
+        key = (key + " ")[:KEY_LENGTH]
+    return key
+
+
+class _Keys(object):
+    "The sorted keys of a PrefixIndex, as a sequence for ``bisect``."
+    __slots__ = ("data", "offsets")
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+
+class PrefixIndex(object):
+    """
+    The suggestions for one Code; see the module docstring. Each
+    suggestion has an ``id``, ``label`` (eg "Title 42, Chapter 21,
+    Section 1983"), ``name`` and ``path``, and ``targets`` gives the
+    suggestion each key leads to.
+
+    """
+    def __init__(self, code_id, public, data, offsets, targets,
+                 ids, labels, names, paths):
+        self.code_id = code_id
+        self.public = public
+        self.keys = _Keys(data, offsets)
+        self.targets = targets
+        self.ids = ids
+        self.labels = labels
+        self.names = names
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, query, limit=10):
+        """
+        Up to ``limit`` suggestions, as dicts, for sections with a key
+        that starts with ``query``, in key order.
+
+        """
+        prefix = normalize_query(query)
+        # A finished last word matches the key that ends with it too,
+        # which sorts just before those that go on.
+        whole = prefix.rstrip()
+        if not whole:
+            return []
+        keys, targets = self.keys, self.targets
+        position = bisect.bisect_left(keys, whole)
+        end = min(len(keys), position + limit * SCAN_FACTOR)
+        seen = {}
+        suggestions = []
+        while position < end and len(suggestions) < limit:
+            key = keys[position]
+            if key != whole and not key.startswith(prefix):
+                break
+            target = targets[position]
+            if target not in seen:
+                seen[target] = True
+                suggestions.append({
+                    "id": self.ids[target],
+                    "label": self.labels[target],
+                    "name": self.names[target],
+                    "path": self.paths[target],
+                    })
+            position += 1
+        return suggestions
+
+    def dumps(self):
+        return marshal.dumps((
+            FORMAT_VERSION, self.code_id, self.public,
+            self.keys.data, self.keys.offsets.tostring(),
+            self.targets.tostring(), self.ids.tostring(),
+            self.labels, self.names, self.paths))
+
+    def loads(cls, data):
+        fields = marshal.loads(data)
+        if fields[0] != FORMAT_VERSION:
+            raise ValueError("Unknown autocomplete index format %r" % (fields[0],))
+        arrays = []
+        for packed in (fields[4], fields[5], fields[6]):
+            values = array("i")
+            values.fromstring(packed)
+            arrays.append(values)
+        offsets, targets, ids = arrays
+        return cls(fields[1], fields[2], fields[3], offsets, targets, ids,
+                   *fields[7:])
+    loads = classmethod(loads)
+
+
+def _section_keys(chain, name):
+    """
+    The keys for a section, given ``chain``, the ``(type, number)``
+    of it and of each of its indexed ancestors, from the top down.
+
+    """
+    type, number = chain[-1]
+    keys = {}
+    place = []
+    for label in chain:
+        place.extend(label)
+    keys[_key(_tokens(u" ".join(place)))] = True
+    keys[_key(_tokens(u"%s %s" % (type, number)))] = True
+    keys[_key(_tokens(number))] = True
+    if type == Section.SECTION and chain[0][0] == Section.TITLE:
+        title = chain[0][1]
+        keys[_key(_tokens(u"title %s section %s" % (title, number)))] = True
+        keys[_key(_tokens(u"%s usc %s" % (title, number)))] = True
+    words = _tokens(name or u"")
+    for index, word in enumerate(words):
+        if word not in STOP_WORDS:
+            # No key needs more than KEY_LENGTH words.
+            keys[_key(words[index:index + KEY_LENGTH])] = True
+    keys.pop("", None)
+    return keys.keys()
+
+
+def build_index(tree):
+    "A PrefixIndex of the TreeSnapshot ``tree``."
+    types, numbers, names = tree.types, tree.numbers, tree.names
+    parents, paths = tree.parents, tree.paths
+    ids = array("i")
+    labels, suggestion_names, suggestion_paths = [], [], []
+    entries = []
+    # The (type, number) of each position and its indexed ancestors.
+    chains = []
+    for position in xrange(len(tree)):
+        parent = parents[position]
+        chain = parent != -1 and chains[parent] or ()
+        if types[position] in INDEXED_TYPES:
+            chain = chain + ((types[position], numbers[position]),)
+            target = len(ids)
+            ids.append(tree.ids[position])
+            labels.append(u", ".join([u"%s %s" % (type.capitalize(), number)
+                                      for type, number in chain]))
+            suggestion_names.append(names[position])
+            suggestion_paths.append(paths[position])
+            for key in _section_keys(chain, names[position]):
+                entries.append((key, target))
+        chains.append(chain)
+    entries.sort()
+
+    keys = []
+    offsets = array("i", [0])
+    targets = array("i")
+    for key, target in entries:
+        keys.append(key)
+        offsets.append(offsets[-1] + len(key))
+        targets.append(target)
+    return PrefixIndex(tree.code_id, tree.public, "".join(keys), offsets, targets,
+                       ids, labels, suggestion_names, suggestion_paths)
+
+
+def index_path(code_id):
+    "The index file for ``code_id``, or None if snapshots are off."
+    directory = getattr(settings, "LAW_CODE_SNAPSHOT_DIR", None)
+    if not directory:
+        return None
+    return os.path.join(directory, "code_%d.autocomplete" % code_id)
+
+
+def write_index(tree):
+    """Build the index of a TreeSnapshot and replace its file, which
+    the processes serving it will pick up. Returns the index.
+
+    """
+    index = build_index(tree)
+    path = index_path(tree.code_id)
+    if path is not None:
+        snapshot.write_file(path, index.dumps())
+    return index
+
+
+# code_id: (mtime, index)
+_indexes = {}
+
+
+def get_index(code_id):
+    """The index of ``code_id``, loaded from its file on first use and
+    again whenever the file changes, or None if there is no file.
+
+    """
+    return snapshot.load_cached(_indexes, code_id, index_path(code_id),
+                                PrefixIndex.loads)
+
+
+def tree_index(tree):
+    """The index of a TreeSnapshot with no index file, built the first
+    time it's needed and kept with the snapshot.
+
+    """
+    index = getattr(tree, "autocomplete_index", None)
+    if index is None:
+        index = tree.autocomplete_index = build_index(tree)
+    return index
@@ -0,0 +1,251 @@
+"""Bulk loading of Section trees.
+
+Saving Sections one at a time through the ORM lets mptt keep the
+tree fields up to date, but every insert shifts the ``lft``/``rght``
+values of the nodes to its right, so loading a large title gets
+slower as the tree grows.
+
+Instead, a whole title can be built in memory as ``SectionNode``
+objects, numbered in a single traversal, and written with batched
+INSERTs. The numbering matches what mptt produces when the same nodes
+are saved one at a time in document order: each root gets the next
+free ``tree_id``, and children are appended as the last child of their
+parent. Primary keys are left to the database, so the rows share its
+id sequence with the ORM's inserts.
+
+"""
+import datetime
+
+from django.db import connection
+
+from law_code.models import Section, SectionText, encode_content, section_content_hash
+
+
+class SectionNode(object):
+    "An unsaved Section, held in memory while a title is being built."
+    __slots__ = ("type", "number", "name", "content", "parent", "path",
+                 "children", "id", "tree_id", "lft", "rght", "level")
+
+    def __init__(self, type, number, name, content=None, parent=None, path=None):
+        self.type = type
+        self.number = number
+        self.name = name
+        self.content = content
+        self.parent = parent
+        self.path = path
+        self.children = []
+        self.id = None
+        self.tree_id = self.lft = self.rght = self.level = None
+        if parent is not None:
+            parent.children.append(self)
+
+    def __repr__(self):
+        return "<SectionNode(%s) %s>" % (self.type, self.number)
+
+
+def iter_tree(roots):
+    "Yield every node under ``roots`` in document (pre-)order."
+    stack = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+def number_tree(roots, tree_id):
+    """Assign ``tree_id``, ``lft``, ``rght`` and ``level`` to every
+    node under ``roots``, starting with ``tree_id`` for the first root.
+
+    Returns the next free tree_id.
+
+    """
+    for root in roots:
+        counter = 1
+        root.level = 0
+        # Each entry is (node, visited); a node is closed (given its
+        # rght value) the second time it comes off the stack.
+        stack = [(root, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                node.rght = counter
+                counter += 1
+                continue
+            node.tree_id = tree_id
+            node.lft = counter
+            counter += 1
+            if node.parent is not None:
+                node.level = node.parent.level + 1
+            stack.append((node, True))
+            for child in reversed(node.children):
+                stack.append((child, False))
+        tree_id += 1
+    return tree_id
+
+
+def _max_value(column):
+    cursor = connection.cursor()
+    cursor.execute("SELECT MAX(%s) FROM %s" % (
+        connection.ops.quote_name(column),
+        connection.ops.quote_name(Section._meta.db_table)))
+    value = cursor.fetchone()[0]
+    return value or 0
+
+
+def next_tree_id():
+    "The tree_id mptt would give the next new root Section."
+    return _max_value(Section._meta.tree_id_attr) + 1
+
+
+def _insert_sql(table, fields):
+    qn = connection.ops.quote_name
+    return "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(table),
+        ", ".join([qn(f.column) for f in fields]),
+        ", ".join(["%s"] * len(fields)))
+
+
+def insert_tree(roots, code, batch_size=500):
+    """Write every node under ``roots`` to the Section table, and their
+    content to the SectionText table.
+
+    The nodes must already have been through ``number_tree``. The rows
+    are written a level of the tree at a time, so that each parent row
+    is written before its children, and the database assigns their
+    primary keys, as it does for the ORM; each level's ids are read
+    back by ``(tree_id, lft)`` and set on the nodes before the next
+    level is written. This should run inside the caller's transaction.
+
+    Returns the number of rows written.
+
+    """
+    opts = Section._meta
+    # Everything but the primary key, which the database assigns.
+    fields = [f for f in opts.fields if f is not opts.pk]
+    sql = _insert_sql(opts.db_table, fields)
+    text_fields = SectionText._meta.fields
+    text_sql = _insert_sql(SectionText._meta.db_table, text_fields)
+
+    levels = []
+    for node in iter_tree(roots):
+        while len(levels) <= node.level:
+            levels.append([])
+        levels[node.level].append(node)
+    if not levels:
+        return 0
+    # The roots have consecutive tree_ids, new to the table.
+    tree_ids = (roots[0].tree_id, roots[-1].tree_id)
+
+    now = datetime.datetime.now()
+    cursor = connection.cursor()
+    written = 0
+    for level, nodes in enumerate(levels):
+        for start in range(0, len(nodes), batch_size):
+            batch = []
+            for node in nodes[start:start + batch_size]:
+                values = {
+                    "code_id": code.id,
+                    "name": node.name,
+                    "type": node.type,
+                    "parent_id": node.parent is not None and node.parent.id or None,
+                    "number": node.number,
+                    "path": node.path,
+                    "created": now,
+                    "modified": now,
+                    "current_version": True,
+                    "valid_from": now,
+                    "valid_to": None,
+                    "content_hash": section_content_hash(
+                        node.type, node.number, node.name, node.content),
+                    opts.left_attr: node.lft,
+                    opts.right_attr: node.rght,
+                    opts.tree_id_attr: node.tree_id,
+                    opts.level_attr: node.level,
+                    }
+                batch.append([f.get_db_prep_save(values[f.attname]) for f in fields])
+            cursor.executemany(sql, batch)
+            written += len(batch)
+
+        by_position = dict([((node.tree_id, node.lft), node) for node in nodes])
+        rows = Section.objects.filter(**{
+            "%s__range" % opts.tree_id_attr: tree_ids,
+            opts.level_attr: level,
+            }).values_list("id", opts.tree_id_attr, opts.left_attr)
+        for id, tree_id, lft in rows.iterator():
+            by_position[(tree_id, lft)].id = id
+
+        texts = []
+        for node in nodes:
+            if node.content is None:
+                continue
+            encoding, data = encode_content(node.content)
+            text_values = {"section_id": node.id, "encoding": encoding, "data": data}
+            texts.append([f.get_db_prep_save(text_values[f.attname])
+                          for f in text_fields])
+            if len(texts) >= batch_size:
+                cursor.executemany(text_sql, texts)
+                texts = []
+        if texts:
+            cursor.executemany(text_sql, texts)
+    return written
+
+
+def verify_tree(roots):
+    """Compare the MPTT fields stored for each saved node against the
+    ones computed by ``number_tree``.
+
+    Every node needs an ``id`` (set once it has been saved) along with
+    its computed fields. Returns a list of ``(node, expected, stored)``
+    tuples, one for each node that does not match.
+
+    """
+    opts = Section._meta
+    attrs = (opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr)
+    stored = {}
+    for root in roots:
+        rows = Section.objects.filter(**{opts.tree_id_attr: root.tree_id})\
+            .values("id", *attrs)
+        for row in rows:
+            stored[row["id"]] = tuple([row[attr] for attr in attrs])
+
+    mismatches = []
+    for node in iter_tree(roots):
+        expected = (node.tree_id, node.lft, node.rght, node.level)
+        found = stored.get(node.id)
+        if found != expected:
+            mismatches.append((node, expected, found))
+    return mismatches
+
+
+def flatten_tree(roots):
+    """Turn the tree under ``roots`` into a flat, picklable list of
+    ``(type, number, name, content, path, parent_index)`` records in
+    document order, where ``parent_index`` is the position of the
+    parent's record (or None for a root).
+
+    """
+    records = []
+    index = {}
+    for node in iter_tree(roots):
+        parent_index = None
+        if node.parent is not None:
+            parent_index = index[id(node.parent)]
+        index[id(node)] = len(records)
+        records.append((node.type, node.number, node.name, node.content,
+                        node.path, parent_index))
+    return records
+
+
+def unflatten_tree(records):
+    "Rebuild the nodes from ``flatten_tree`` records, returning the roots."
+    nodes = []
+    roots = []
+    for type, number, name, content, path, parent_index in records:
+        parent = None
+        if parent_index is not None:
+            parent = nodes[parent_index]
+        node = SectionNode(type, number, name, content, parent=parent, path=path)
+        if parent is None:
+            roots.append(node)
+        nodes.append(node)
+    return roots
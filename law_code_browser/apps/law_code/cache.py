@@ -0,0 +1,175 @@
+"""Caching of rendered law code pages.
+
+The statute text only changes when an import runs, so the expensive
+part of each page (the breadcrumbs, the section and the tree of its
+descendants for a section; the top of the tree for a code) is rendered
+once and cached. The key is made from the object's id and ``modified``
+(and, for sections, ``current_version``), so nothing ever needs to be
+deleted: the importer touches ``modified`` on exactly the sections
+whose pages it changed (see ``Invalidation``), and their old entries
+are never asked for again and fall out of the cache.
+
+The backend is set by ``settings.LAW_CODE_CACHE_BACKEND``, which takes
+any Django cache URI, eg::
+
+    locmem:///?max_entries=5000
+    file:///var/tmp/law_code_cache?max_entries=100000
+    memcached://127.0.0.1:11211/
+
+The local memory and file backends cull old entries beyond
+``max_entries``; memcached is bounded by its own memory limit.
+
+"""
+import datetime
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils.safestring import mark_safe
+
+from law_code.models import Code, Section
+
+
+DEFAULT_BACKEND = "locmem:///?max_entries=5000"
+
+_page_cache = None
+
+
+def get_page_cache():
+    "The cache for rendered pages, from ``LAW_CODE_CACHE_BACKEND``."
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = get_cache(
+            getattr(settings, "LAW_CODE_CACHE_BACKEND", DEFAULT_BACKEND))
+    return _page_cache
+
+
+def rendered_depth():
+    """How many levels below a section (or the top of a code) its page
+    renders; see ``views.view_section``.
+
+    """
+    return getattr(settings, "LAW_CODE_TREE_DEPTH", 2)
+
+
+def section_key(section):
+    return "law_code:section:%d:%s:%d:%d" % (
+        section.id, section.modified.isoformat(), section.current_version,
+        rendered_depth())
+
+
+def code_key(code):
+    return "law_code:code:%d:%s:%d" % (
+        code.id, code.modified.isoformat(), rendered_depth())
+
+
+def cached_fragment(key, render):
+    """Return the HTML cached under ``key``, calling ``render`` to
+    produce (and cache) it if it isn't there.
+
+    """
+    page_cache = get_page_cache()
+    html = page_cache.get(key)
+    if html is None:
+        html = render()
+        page_cache.set(key, html)
+    return mark_safe(html)
+
+
+def _level(node):
+    level = 0
+    while node.parent is not None:
+        node = node.parent
+        level += 1
+    return level
+
+
+class Invalidation(object):
+    """
+    Collects the pages an import changes, given saved
+    ``bulk.SectionNode`` objects, and then touches their ``modified``
+    in as few queries as possible.
+
+     * A section's page shows its ancestors' names, and the names and
+       content of descendants up to ``rendered_depth()`` levels down.
+       So when a section is added, changed or removed, the pages of
+       its ancestors up to that many levels up are affected.
+
+     * If a section's name or number changed, every page below it
+       shows the new breadcrumb, so its whole subtree is affected.
+
+     * The code's page shows the top ``rendered_depth()`` levels.
+
+    """
+    def __init__(self):
+        self.section_ids = {}
+        # The ids of sections whose whole subtree changed.
+        self.subtree_ids = {}
+        self.code_changed = False
+
+    def _ancestors_changed(self, node, level):
+        depth = rendered_depth()
+        ancestor = node.parent
+        steps = 1
+        while ancestor is not None and steps <= depth:
+            self.section_ids[ancestor.id] = True
+            ancestor = ancestor.parent
+            steps += 1
+        if level < depth:
+            self.code_changed = True
+
+    def tree_added(self):
+        "A new top level section was written, so the code's page changed."
+        self.code_changed = True
+
+    def section_added(self, node):
+        self._ancestors_changed(node, _level(node))
+
+    def section_changed(self, node, old):
+        """``node`` was written over the Section ``old``, which still
+        has the old name and number.
+
+        """
+        self.section_ids[node.id] = True
+        self._ancestors_changed(node, _level(node))
+        if old.name != node.name or old.number != node.number:
+            self.subtree_ids[node.id] = True
+
+    def section_removed(self, parent, level):
+        """A section at ``level`` under the saved node ``parent`` is
+        no longer current.
+
+        """
+        self.section_ids[parent.id] = True
+        # The parent's ancestors see one level less of the change.
+        depth = rendered_depth()
+        ancestor = parent.parent
+        steps = 2
+        while ancestor is not None and steps <= depth:
+            self.section_ids[ancestor.id] = True
+            ancestor = ancestor.parent
+            steps += 1
+        if level < depth:
+            self.code_changed = True
+
+    def apply(self, code):
+        "Touch ``modified`` on everything collected."
+        now = datetime.datetime.now()
+        opts = Section._meta
+        ids = self.section_ids.keys()
+        for start in range(0, len(ids), 500):
+            Section.objects.filter(id__in=ids[start:start + 500])\
+                .update(modified=now)
+        # The subtrees' bounds as they are now, after any other changes
+        # to the tree.
+        subtree_ids = self.subtree_ids.keys()
+        subtrees = []
+        for start in range(0, len(subtree_ids), 500):
+            subtrees.extend(Section.objects.filter(id__in=subtree_ids[start:start + 500])
+                            .values_list(opts.tree_id_attr, opts.left_attr, opts.right_attr))
+        for tree_id, lft, rght in subtrees:
+            Section.objects.filter(**{
+                opts.tree_id_attr: tree_id,
+                "%s__gt" % opts.left_attr: lft,
+                "%s__lt" % opts.right_attr: rght}).update(modified=now)
+        if self.code_changed:
+            Code.objects.filter(id=code.id).update(modified=now)
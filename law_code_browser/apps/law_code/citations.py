@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Resolving US Code citations, eg "42 U.S.C. § 1983(a)", to Sections.
+
+A citation names a title, a section number within it, and optionally
+subsections, paragraphs and so on. Section numbers are unique within a
+title (apart from a few the House files repeat; see
+``us_code.SectionTreeBuilder._path``), so each citation is resolved
+with an index from ``(title, section number)`` to the Section, built
+from the code's tree snapshot (see ``law_code.snapshot``) the first
+time it's needed and kept until the snapshot is reloaded. The
+subdivisions are then just more of the Section's path.
+
+"""
+import re
+
+from law_code.models import Section
+
+
+CITATION_RX = re.compile(ur"""
+^\s*
+(\d+[a-z]?)                     # The title, eg "42"
+\s*U\.?\s*S\.?\s*C\.?(?:\s*A\.?)?  # U.S.C., USC or U.S.C.A.
+\s*(?:§§?|secs?\.?|sections?)?  # An optional section sign
+\s*([0-9][0-9A-Za-z\-]*)        # The section number, eg "2000e-2"
+((?:\s*\([0-9A-Za-z]+\))*)      # Any subdivisions, eg "(a)(1)"
+\s*(?:et\.?\s*seq\.?)?\s*$
+""", re.VERBOSE | re.IGNORECASE | re.UNICODE)
+
+
+def parse_citation(text):
+    """
+    Split a citation into ``(title, section, subdivisions)``, eg
+    ``("42", "1983", ["a", "1"])`` for "42 U.S.C. § 1983(a)(1)", or
+    return None if it isn't a US Code citation.
+
+    """
+    if not isinstance(text, unicode):
+        text = text.decode("utf-8", "replace")
+    match = CITATION_RX.match(text)
+    if match is None:
+        return None
+    title, section, subdivisions = match.groups()
+    subdivisions = [part.strip().strip("()") for part
+                    in subdivisions.split(")") if part.strip()]
+    return title, section, subdivisions
+
+
+def citation_index(tree):
+    """
+    ``(index, repeated)`` for a TreeSnapshot: ``index`` maps ``(title,
+    section number)``, lower cased, to the position of the first
+    Section with that number in the title, and ``repeated`` holds the
+    keys of numbers used more than once.
+
+    """
+    cached = getattr(tree, "citation_index", None)
+    if cached is not None:
+        return cached
+    index = {}
+    repeated = {}
+    types, numbers, paths = tree.types, tree.numbers, tree.paths
+    for position in xrange(len(tree)):
+        if types[position] != Section.SECTION:
+            continue
+        path = paths[position]
+        key = (path[:path.find("/")].lower(), numbers[position].lower())
+        if key in index:
+            repeated[key] = True
+        else:
+            index[key] = position
+    tree.citation_index = (index, repeated)
+    return tree.citation_index
+
+
+def resolve_citations(tree, citations, url_prefix):
+    """
+    Resolve each citation in ``citations`` against the TreeSnapshot
+    ``tree``, returning a list of dicts, one per citation, in order.
+
+    A resolved citation gets the Section's ``id``, ``path`` and
+    ``url`` (``url_prefix`` followed by the path). If some of its
+    subdivisions don't exist, it resolves to the deepest one that
+    does, with ``exact`` set to False. If its section number is used
+    more than once in the title, ``ambiguous`` is set, and it resolves
+    to the first. Anything else gets an ``error``.
+
+    """
+    index, repeated = citation_index(tree)
+    by_path, paths, ids = tree.by_path, tree.paths, tree.ids
+    results = []
+    for citation in citations:
+        result = {"citation": citation}
+        results.append(result)
+        parsed = parse_citation(citation)
+        if parsed is None:
+            result["error"] = "unrecognized citation"
+            continue
+        title, section, subdivisions = parsed
+        key = (title.lower(), section.lower())
+        position = index.get(key)
+        if position is None:
+            result["error"] = "no such section"
+            continue
+        exact = True
+        path = paths[position]
+        for label in subdivisions:
+            child = by_path.get("%s/%s" % (path, label))
+            if child is None:
+                exact = False
+                break
+            position = child
+            path = paths[child]
+        result["id"] = ids[position]
+        result["path"] = path
+        result["url"] = url_prefix + path
+        result["exact"] = exact
+        if key in repeated:
+            result["ambiguous"] = True
+    return results
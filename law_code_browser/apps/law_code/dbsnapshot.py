@@ -0,0 +1,134 @@
+"""Publishing read-only copies of the SQLite database for web workers.
+
+``import_us_code`` writes to the database in long transactions. With
+SQLite, readers of the same file can be held up by them, so instead of
+serving from it, the importer can publish an immutable copy when it
+finishes, set by ``settings.LAW_CODE_DB_SNAPSHOT``:
+
+ * The database is copied with ``VACUUM INTO``, which reads it in one
+   transaction, so the copy is consistent and compact, and writers are
+   never blocked for long.
+
+ * The copy is given the indexes the views need (they are also in
+   sql/section.sql, but databases created before them lack them),
+   ANALYZEd so SQLite's planner has statistics, VACUUMed again, and
+   made read-only.
+
+ * ``LAW_CODE_DB_SNAPSHOT`` is a symlink to the latest copy, which is
+   replaced with a rename, so it always points at a complete database.
+
+Web workers then use the ``law_code.readonly_sqlite`` database backend
+with ``DATABASE_NAME`` set to the symlink. Each new connection (Django
+opens one per request) follows the link, so workers move to a new
+snapshot at the start of their next request, while requests under way
+finish on the old one.
+
+"""
+import glob
+import os
+import shutil
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+# (name, table, columns) of the indexes the views rely on.
+INDEXES = [
+    ("law_code_section_code_parent_number", "law_code_section",
+     "code_id, parent_id, number"),
+    ("law_code_section_tree_lft", "law_code_section", "tree_id, lft"),
+    ]
+# How many snapshots to keep, counting the current one, for workers
+# still reading an older one.
+KEEP = 2
+
+
+def snapshot_link():
+    "The path of the link to the current snapshot, or None."
+    return getattr(settings, "LAW_CODE_DB_SNAPSHOT", None)
+
+
+def _copy(source, target):
+    "Copy the database ``source`` to ``target`` consistently."
+    if sqlite3.sqlite_version_info >= (3, 27, 0):
+        connection = sqlite3.connect(source)
+        try:
+            connection.execute("VACUUM INTO ?", [target])
+        finally:
+            connection.close()
+        return
+    # Older SQLite: hold off writers while the file is copied.
+    connection = sqlite3.connect(source, isolation_level=None)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            shutil.copyfile(source, target)
+        finally:
+            connection.execute("ROLLBACK")
+    finally:
+        connection.close()
+
+
+def _optimize(path):
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        for name, table, columns in INDEXES:
+            connection.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+                name, table, columns))
+        connection.execute("ANALYZE")
+        connection.execute("PRAGMA journal_mode = DELETE")
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+
+def publish(source=None, link=None):
+    """
+    Publish a snapshot of the SQLite database ``source`` (by default
+    the one in settings) and point ``link`` (by default
+    ``LAW_CODE_DB_SNAPSHOT``) at it. Returns the snapshot's path.
+
+    """
+    if source is None:
+        if settings.DATABASE_ENGINE != "sqlite3":
+            raise ImproperlyConfigured("LAW_CODE_DB_SNAPSHOT needs the sqlite3 "
+                                       "database engine")
+        source = settings.DATABASE_NAME
+    if link is None:
+        link = snapshot_link()
+    link = os.path.abspath(link)
+    directory = os.path.dirname(link)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    path = "%s.%d" % (link, int(time.time() * 1000))
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    _copy(source, temp_path)
+    try:
+        _optimize(temp_path)
+    except:
+        os.remove(temp_path)
+        raise
+    os.chmod(temp_path, 0444)
+    os.rename(temp_path, path)
+
+    temp_link = link + ".tmp"
+    if os.path.lexists(temp_link):
+        os.remove(temp_link)
+    os.symlink(os.path.basename(path), temp_link)
+    os.rename(temp_link, link)
+
+    snapshots = [(int(name[len(link) + 1:]), name) for name
+                 in glob.glob(link + ".*") if name[len(link) + 1:].isdigit()]
+    snapshots.sort()
+    for stamp, old in snapshots[:-KEEP]:
+        os.remove(old)
+    return path
@@ -0,0 +1,266 @@
+"""Downloading the US Code title files for ``import_us_code``.
+
+The House publishes each title as a text file (see
+http://uscode.house.gov/download/ascii.shtml). ``download_titles``
+fetches them with a bounded number of threads, handing back each one in
+title order as soon as it and the titles before it are done, so the
+importer can parse it while the rest are still downloading, and always
+imports the titles in the same order.
+
+Each file is kept in the download directory under the name
+``import_us_code --directory`` expects (``Title_01.txt`` and so on),
+next to a ``.meta`` file recording the server's ETag and Last-Modified
+and the file's SHA-1:
+
+ * A file already downloaded is requested conditionally, so an
+   unchanged one costs a 304 and nothing more. When the server doesn't
+   give validators, the checksum of what comes back tells whether it
+   changed.
+
+ * A download in progress is written to a ``.part`` file. If it is cut
+   off, the next attempt (a retry, or the next run) asks for the rest
+   with a Range request, guarded by If-Range so that a file that
+   changed in the meantime is fetched again from the start.
+
+The base URL comes from ``settings.LAW_CODE_DOWNLOAD_URL``, or the
+importer's --download-url, so a local HTTP server can stand in for the
+House's.
+
+"""
+import os
+import Queue
+import socket
+import threading
+import time
+import urllib2
+
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.hashcompat import sha_constructor
+
+
+DEFAULT_URL = "http://uscode.house.gov/download/ascii/"
+TITLE_NUMBERS = range(1, 51)
+CHUNK_SIZE = 64 * 1024
+
+
+def title_filename(number):
+    return "Title_%02d.txt" % number
+
+
+def download_url():
+    return getattr(settings, "LAW_CODE_DOWNLOAD_URL", DEFAULT_URL)
+
+
+def file_sha1(path):
+    digest = sha_constructor()
+    title_file = open(path, "rb")
+    try:
+        while True:
+            chunk = title_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        title_file.close()
+    return digest.hexdigest()
+
+
+def _read_meta(path):
+    try:
+        meta_file = open(path + ".meta")
+    except IOError:
+        return {}
+    try:
+        try:
+            return simplejson.load(meta_file)
+        except ValueError:
+            return {}
+    finally:
+        meta_file.close()
+
+
+def _write_meta(path, meta):
+    temp_path = path + ".meta.tmp"
+    meta_file = open(temp_path, "w")
+    try:
+        simplejson.dump(meta, meta_file)
+    finally:
+        meta_file.close()
+    os.rename(temp_path, path + ".meta")
+
+
+class TitleFile(object):
+    """A downloaded title file. ``unchanged`` is True if it is the
+    same as the last one ``mark_imported`` was called for.
+
+    """
+    def __init__(self, number, path, meta):
+        self.number = number
+        self.path = path
+        self.sha1 = meta.get("sha1")
+        self.unchanged = self.sha1 is not None and self.sha1 == meta.get("imported")
+
+    def __repr__(self):
+        return "<law_code.download.TitleFile %s>" % self.path
+
+    def mark_imported(self):
+        "Record that this version of the file has been imported."
+        meta = _read_meta(self.path)
+        meta["imported"] = self.sha1
+        _write_meta(self.path, meta)
+        self.unchanged = True
+
+
+class RestartDownload(Exception):
+    "The partial download can't be resumed, and has been thrown away."
+
+
+def fetch_title(number, directory, base_url=None, retries=3, timeout=60):
+    """
+    Bring the file for title ``number`` in ``directory`` up to date
+    with the server, resuming a partial download if there is one.
+    Returns a TitleFile, or None if the server doesn't have the title.
+
+    """
+    if base_url is None:
+        base_url = download_url()
+    path = os.path.join(directory, title_filename(number))
+    url = base_url + title_filename(number)
+    attempt = 0
+    while True:
+        try:
+            return _fetch(number, path, url, timeout)
+        except RestartDownload:
+            continue
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return None
+            if attempt >= retries or e.code < 500:
+                raise
+        except (urllib2.URLError, socket.error, IOError):
+            if attempt >= retries:
+                raise
+        attempt += 1
+        time.sleep(2 ** attempt)
+
+
+def _fetch(number, path, url, timeout):
+    part_path = path + ".part"
+    meta = _read_meta(path)
+    request = urllib2.Request(url)
+    if os.path.exists(path) and meta.get("sha1"):
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+    offset = 0
+    validator = meta.get("partial_etag") or meta.get("partial_last_modified")
+    if os.path.exists(part_path):
+        if validator:
+            offset = os.path.getsize(part_path)
+            request.add_header("Range", "bytes=%d-" % offset)
+            request.add_header("If-Range", validator)
+        else:
+            os.remove(part_path)
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError, e:
+        if e.code == 304:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return TitleFile(number, path, meta)
+        if e.code == 416 and offset:
+            # The partial file is no good; start again.
+            os.remove(part_path)
+            raise RestartDownload()
+        raise
+    try:
+        headers = response.info()
+        length = headers.get("Content-Length")
+        if response.code == 206:
+            content_range = headers.get("Content-Range", "")
+            if not content_range.startswith("bytes %d-" % offset):
+                os.remove(part_path)
+                raise RestartDownload()
+            part_file = open(part_path, "ab")
+        else:
+            offset = 0
+            part_file = open(part_path, "wb")
+            meta["partial_etag"] = headers.get("ETag")
+            meta["partial_last_modified"] = headers.get("Last-Modified")
+            _write_meta(path, meta)
+        received = 0
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                part_file.write(chunk)
+                received += len(chunk)
+        finally:
+            part_file.close()
+    finally:
+        response.close()
+    if length is not None and received != int(length):
+        raise IOError("%s: got %d of %s bytes" % (url, received, length))
+
+    sha1 = file_sha1(part_path)
+    os.rename(part_path, path)
+    meta["etag"] = meta.pop("partial_etag", None)
+    meta["last_modified"] = meta.pop("partial_last_modified", None)
+    meta["sha1"] = sha1
+    _write_meta(path, meta)
+    return TitleFile(number, path, meta)
+
+
+def download_titles(directory, numbers=TITLE_NUMBERS, base_url=None, jobs=4):
+    """
+    Bring the files of the titles in ``numbers`` up to date in
+    ``directory``, with ``jobs`` downloads at a time, yielding
+    ``(number, title_file)`` for each in the order of ``numbers``, as
+    soon as it and the ones before it are done, so that titles are
+    imported in the same order however the downloads finish;
+    ``title_file`` is None if the server doesn't have the title. If a
+    download fails for good, the others are stopped and the error is
+    raised.
+
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    pending = Queue.Queue()
+    for number in numbers:
+        pending.put(number)
+    done = Queue.Queue()
+    stopped = threading.Event()
+
+    def work():
+        while not stopped.isSet():
+            try:
+                number = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((number, fetch_title(number, directory, base_url), None))
+            except Exception, e:
+                done.put((number, None, e))
+
+    workers = []
+    for i in range(min(jobs, len(numbers))):
+        worker = threading.Thread(target=work)
+        worker.setDaemon(True)
+        worker.start()
+        workers.append(worker)
+    # Titles that finished before one ahead of them.
+    finished = {}
+    try:
+        for number in numbers:
+            while number not in finished:
+                done_number, title, error = done.get()
+                if error is not None:
+                    raise error
+                finished[done_number] = title
+            yield number, finished.pop(number)
+    finally:
+        stopped.set()
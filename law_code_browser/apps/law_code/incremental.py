@@ -0,0 +1,214 @@
+"""Incremental re-imports.
+
+When a new release point of a code is imported over an old one, most
+sections haven't changed. ``sync_tree`` matches a freshly parsed title
+against the current Sections in the database by ``Section.path`` and
+compares content hashes (see ``models.section_content_hash``), writing
+only the differences:
+
+ * A changed section keeps its row, so its id, URL and children stay
+   where they are, and the new text is written over it. The old text
+   is kept as a separate row with ``current_version=False``, valid
+   until now (see ``law_code.versions``).
+
+ * A section with a new path is inserted under its parent. mptt adds
+   it as the parent's last child.
+
+ * A current section whose path no longer appears is retired, by
+   setting ``current_version=False`` and ``valid_to`` (and touching
+   ``modified``, so ``export_law_code`` knows to remove its page).
+
+ * Everything else is left alone.
+
+Versions that are no longer current are then taken out of the tree
+(see ``detach_old_versions``), so that mptt's counts of children and
+descendants, and so ``is_leaf_node``, only ever cover current
+sections, and tree ids aren't used up by old versions.
+
+If a ``search.SearchIndex`` is given, the same changes are made to it,
+and likewise for a ``references.ReferenceIndex``.
+Cached pages are invalidated by touching ``modified`` on every section
+whose rendered page the changes show up on (see ``cache.Invalidation``).
+
+"""
+import datetime
+
+from django.db import connection
+
+from law_code import bulk
+from law_code.cache import Invalidation
+from law_code.models import Section, section_content_hash, store_content
+
+
+# The tree_id of versions that are no longer current. mptt numbers
+# trees from 1, so no real tree has it.
+DETACHED_TREE_ID = 0
+
+
+def sync_tree(code, roots, batch_size=500, search_index=None, reference_index=None):
+    """
+    Bring the current Sections of ``code`` in line with the parsed
+    ``bulk.SectionNode`` trees under ``roots``. A root that isn't in
+    the database yet is written in one go with the bulk loader.
+
+    Returns a dict counting the sections that were inserted, changed,
+    retired and left unchanged.
+
+    """
+    counts = {"inserted": 0, "changed": 0, "retired": 0, "unchanged": 0}
+    invalidation = Invalidation()
+    for root in roots:
+        try:
+            existing = code.sections.get(
+                parent=None, current_version=True, path=root.path)
+        except Section.DoesNotExist:
+            bulk.number_tree([root], bulk.next_tree_id())
+            counts["inserted"] += bulk.insert_tree([root], code, batch_size)
+            for index in (search_index, reference_index):
+                if index is not None:
+                    index.add_nodes(code, bulk.iter_tree([root]))
+            invalidation.tree_added()
+            continue
+        _sync_root(code, existing, root, counts, invalidation, search_index,
+                   reference_index)
+    invalidation.apply(code)
+    detach_old_versions(code)
+    return counts
+
+
+def detach_old_versions(code):
+    """
+    Take every Section of ``code`` that is no longer current out of
+    its tree: its subtree (old versions all) gets ``DETACHED_TREE_ID``,
+    an ``lft`` and ``rght`` of its own, and no parent, and the gap it
+    leaves in the tree is closed, as mptt does when a node is deleted.
+    Their ``level`` and ``path`` still say where they were.
+
+    Returns the number of subtrees taken out.
+
+    """
+    opts = Section._meta
+    tree_id_attr, left_attr, right_attr = (
+        opts.tree_id_attr, opts.left_attr, opts.right_attr)
+    rows = code.sections.filter(current_version=False)\
+        .exclude(**{tree_id_attr: DETACHED_TREE_ID})\
+        .order_by(tree_id_attr, left_attr)\
+        .values_list(tree_id_attr, left_attr, right_attr)
+    # The outermost (tree_id, lft, rght) ranges; everything under a
+    # version that isn't current isn't current either.
+    subtrees = []
+    for tree_id, lft, rght in rows.iterator():
+        if subtrees and subtrees[-1][0] == tree_id and lft < subtrees[-1][2]:
+            continue
+        subtrees.append((tree_id, lft, rght))
+
+    qn = connection.ops.quote_name
+    table = qn(opts.db_table)
+    tree_id_column, left_column, right_column = [
+        qn(opts.get_field(attr).column) for attr in (tree_id_attr, left_attr, right_attr)]
+    parent_column = qn(opts.get_field("parent").column)
+    cursor = connection.cursor()
+    # From the right, so closing one gap doesn't move the ones before.
+    subtrees.reverse()
+    for tree_id, lft, rght in subtrees:
+        cursor.execute(
+            "UPDATE %s SET %s = %%s, %s = 1, %s = 2, %s = NULL "
+            "WHERE %s = %%s AND %s >= %%s AND %s <= %%s" % (
+                table, tree_id_column, left_column, right_column, parent_column,
+                tree_id_column, left_column, right_column),
+            [DETACHED_TREE_ID, tree_id, lft, rght])
+        width = rght - lft + 1
+        for column in (left_column, right_column):
+            cursor.execute("UPDATE %s SET %s = %s - %%s WHERE %s = %%s AND %s > %%s" % (
+                table, column, column, tree_id_column, column),
+                [width, tree_id, rght])
+    return len(subtrees)
+
+
+def _sync_root(code, existing, root, counts, invalidation, search_index,
+               reference_index):
+    opts = Section._meta
+    rows = Section.objects.filter(current_version=True, **{
+        opts.tree_id_attr: getattr(existing, opts.tree_id_attr)})\
+        .values("id", "path", "content_hash")
+    hashes = {}
+    stored_ids = {}
+    for row in rows:
+        hashes[row["id"]] = row["content_hash"]
+        stored_ids[row["path"]] = row["id"]
+
+    nodes = {}
+    seen = {}
+    written = []
+    for node in bulk.iter_tree([root]):
+        nodes[node.path] = node
+        row_id = stored_ids.get(node.path)
+        if row_id is None:
+            # Parents come first, so the parent already has an id.
+            sec = Section.objects.create(
+                code=code, name=node.name, number=node.number,
+                type=node.type, content=node.content, path=node.path,
+                parent=Section.objects.get(id=node.parent.id))
+            node.id = sec.id
+            written.append(node)
+            invalidation.section_added(node)
+            counts["inserted"] += 1
+            continue
+        node.id = row_id
+        seen[row_id] = True
+        new_hash = section_content_hash(
+            node.type, node.number, node.name, node.content)
+        if hashes[row_id] == new_hash:
+            counts["unchanged"] += 1
+            continue
+        old = _replace_section(code, row_id, node, new_hash)
+        invalidation.section_changed(node, old)
+        written.append(node)
+        counts["changed"] += 1
+
+    retired = []
+    retired_parents = []
+    for row_path, row_id in stored_ids.items():
+        if row_id in seen:
+            continue
+        retired.append(row_id)
+        parent = nodes.get(row_path.rsplit("/", 1)[0])
+        if parent is not None:
+            invalidation.section_removed(parent, row_path.count("/"))
+            retired_parents.append(parent)
+    now = datetime.datetime.now()
+    for start in range(0, len(retired), 500):
+        Section.objects.filter(id__in=retired[start:start + 500])\
+            .update(current_version=False, valid_to=now, modified=now)
+    counts["retired"] += len(retired)
+
+    if search_index is not None:
+        search_index.add_nodes(code, written)
+        search_index.remove(retired)
+    if reference_index is not None:
+        reference_index.remove(retired)
+        # A retired paragraph takes its references out of its section.
+        reference_index.add_nodes(code, written + retired_parents)
+
+
+def _replace_section(code, row_id, node, new_hash):
+    """
+    Archive the text of Section ``row_id`` as a new, non-current row,
+    then write ``node``'s text over it. Returns the Section as it was.
+    mptt makes the archived row a tree of its own, until
+    ``detach_old_versions`` takes it out.
+
+    """
+    now = datetime.datetime.now()
+    old = Section.objects.get(id=row_id)
+    Section.objects.create(
+        code=code, name=old.name, number=old.number, type=old.type,
+        content=old.content, path=old.path, current_version=False,
+        valid_from=old.valid_from, valid_to=now, parent=None)
+    # update() skips mptt's save handling, which would otherwise try to
+    # re-place the node in the tree.
+    Section.objects.filter(id=row_id).update(
+        name=node.name, type=node.type,
+        content_hash=new_hash, valid_from=now, modified=now)
+    store_content(row_id, node.content)
+    return old
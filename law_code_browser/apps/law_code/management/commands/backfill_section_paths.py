@@ -0,0 +1,92 @@
+"""Fill in Section.path for sections imported before it existed.
+
+view_section finds a section by its stored path (see Section.path), so
+rows without one can't be reached. syncdb doesn't add columns to
+existing tables, so if law_code_section has no path column, this adds
+it first, the equivalent of:
+
+    ALTER TABLE law_code_section ADD COLUMN path varchar(255) NOT NULL DEFAULT '';
+    CREATE INDEX law_code_section_path ON law_code_section (path);
+
+and, once the paths are filled in, the unique index on current paths
+from sql/section.sql.
+
+Each tree is walked in lft order, so a section's parent always has its
+path before the section does; a number repeated under one parent gets
+"~2", "~3" and so on, as ``us_code.SectionTreeBuilder`` does on import.
+Sections that already have a path keep it.
+
+"""
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.db.transaction import commit_on_success
+
+from law_code.models import Section
+
+
+# As in sql/section.sql.
+CURRENT_PATH_INDEX = ("CREATE UNIQUE INDEX law_code_section_current_path "
+                      "ON law_code_section (code_id, path) WHERE current_version")
+
+
+class Command(NoArgsCommand):
+    help = 'Add and fill in the path of Sections imported before paths were stored.'
+
+    @commit_on_success
+    def handle_noargs(self, **options):
+        qn = connection.ops.quote_name
+        opts = Section._meta
+        table = opts.db_table
+        cursor = connection.cursor()
+        columns = [row[0] for row in
+                   connection.introspection.get_table_description(cursor, table)]
+        added = "path" not in columns
+        if added:
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s varchar(255) NOT NULL DEFAULT ''"
+                           % (qn(table), qn("path")))
+            cursor.execute("CREATE INDEX %s ON %s (%s)" % (
+                qn("%s_path" % table), qn(table), qn("path")))
+            print "Added %s.path" % table
+
+        rows = Section.objects.order_by(opts.tree_id_attr, opts.left_attr)\
+            .values_list("id", "code", "parent", "number", "path", "current_version")
+        paths = {}
+        # (code_id, path): True for the paths of current sections.
+        used = {}
+        missing = []
+        for section_id, code_id, parent_id, number, path, current in rows.iterator():
+            if path:
+                paths[section_id] = path
+                if current:
+                    used[(code_id, path)] = True
+                continue
+            missing.append((section_id, code_id, parent_id, number, current))
+
+        update_sql = "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            qn(table), qn("path"), qn("id"))
+        batch = []
+        for section_id, code_id, parent_id, number, current in missing:
+            parent_path = paths.get(parent_id)
+            if parent_path is None:
+                path = number
+            else:
+                path = "%s/%s" % (parent_path, number)
+            unique = path
+            count = 1
+            while current and (code_id, unique) in used:
+                count += 1
+                unique = "%s~%d" % (path, count)
+            if current:
+                used[(code_id, unique)] = True
+            paths[section_id] = unique
+            batch.append((unique, section_id))
+            if len(batch) == 1000:
+                cursor.executemany(update_sql, batch)
+                batch = []
+        if batch:
+            cursor.executemany(update_sql, batch)
+        print "Filled in the path of %d sections" % len(missing)
+
+        if added:
+            cursor.execute(CURRENT_PATH_INDEX)
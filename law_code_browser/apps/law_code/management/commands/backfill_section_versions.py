@@ -0,0 +1,101 @@
+"""Add the version columns to Sections imported before they existed.
+
+``Section.valid_from``, ``valid_to`` and ``content_hash`` (see
+``law_code.versions`` and ``law_code.incremental``) are new columns of
+law_code_section, which syncdb doesn't add to an existing table. This
+adds any that are missing, the equivalent of:
+
+    ALTER TABLE law_code_section ADD COLUMN valid_from datetime NOT NULL
+        DEFAULT '1970-01-01 00:00:00';
+    ALTER TABLE law_code_section ADD COLUMN valid_to datetime NULL;
+    ALTER TABLE law_code_section ADD COLUMN content_hash varchar(40) NULL;
+
+with the column types of the database, and the validity index from
+sql/section.sql. Then it fills them in: each section has been valid
+since it was created, a version that isn't current was valid until it
+was last modified, and the content hash of each section without one is
+worked out from its text. Last, old versions are taken out of the
+tree (see ``incremental.detach_old_versions``).
+
+The text has to be in SectionText, so run move_section_content first
+on a database that has it in law_code_section.
+
+"""
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+from django.db.transaction import commit_on_success
+
+from law_code.incremental import detach_old_versions
+from law_code.models import Code, Section, SectionText, decode_content, section_content_hash
+
+
+# As in sql/section.sql.
+VALIDITY_INDEX = ("CREATE INDEX law_code_section_path_validity "
+                  "ON law_code_section (code_id, path, valid_from, valid_to)")
+
+BATCH_SIZE = 1000
+
+
+class Command(NoArgsCommand):
+    help = 'Add and fill in the version columns of Sections imported before they existed.'
+
+    @commit_on_success
+    def handle_noargs(self, **options):
+        qn = connection.ops.quote_name
+        opts = Section._meta
+        table = opts.db_table
+        cursor = connection.cursor()
+        columns = [row[0] for row in
+                   connection.introspection.get_table_description(cursor, table)]
+        if "content" in columns:
+            cursor.execute("SELECT COUNT(*) FROM %s WHERE content IS NOT NULL" % qn(table))
+            if cursor.fetchone()[0]:
+                raise CommandError("%s still has content; run move_section_content first"
+                                   % table)
+
+        added = []
+        for name, definition in (("valid_from", "NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+                                 ("valid_to", "NULL"),
+                                 ("content_hash", "NULL")):
+            if name in columns:
+                continue
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s %s %s" % (
+                qn(table), qn(name), opts.get_field(name).db_type(), definition))
+            added.append(name)
+            print "Added %s.%s" % (table, name)
+
+        if "valid_from" in added:
+            cursor.execute("UPDATE %s SET %s = %s" % (
+                qn(table), qn("valid_from"), qn("created")))
+        if "valid_to" in added:
+            cursor.execute("UPDATE %s SET %s = %s WHERE %s = %%s" % (
+                qn(table), qn("valid_to"), qn("modified"), qn("current_version")), [False])
+        if "valid_from" in added or "valid_to" in added:
+            cursor.execute(VALIDITY_INDEX)
+
+        update_sql = "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            qn(table), qn("content_hash"), qn("id"))
+        hashed = 0
+        last_id = 0
+        while True:
+            rows = list(Section.objects.filter(content_hash=None, id__gt=last_id)
+                        .order_by("id").values_list("id", "type", "number", "name")
+                        [:BATCH_SIZE])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            texts = dict([(section_id, decode_content(encoding, data))
+                          for section_id, encoding, data in SectionText.objects.filter(
+                              pk__in=[row[0] for row in rows])
+                          .values_list("section", "encoding", "data")])
+            cursor.executemany(update_sql, [
+                (section_content_hash(type, number, name, texts.get(section_id)), section_id)
+                for section_id, type, number, name in rows])
+            hashed += len(rows)
+        print "Filled in the content hash of %d sections" % hashed
+
+        detached = 0
+        for code in Code.objects.all():
+            detached += detach_old_versions(code)
+        print "Took %d subtrees of old versions out of the tree" % detached
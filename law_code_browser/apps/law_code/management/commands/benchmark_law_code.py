@@ -0,0 +1,874 @@
+"""Benchmarks for the law code importer and views.
+
+Without --directory, the benchmarks run against synthetic title files
+(see ``write_synthetic_title``), which --generate can also write out
+for use with import_us_code. The import and view benchmarks run in a
+test database, which is created for the run and then destroyed, so
+they never touch the real one.
+
+The autocomplete benchmark times suggestions from the prefix index of a
+synthetic code the size of the US Code (see ``law_code.autocomplete``).
+
+The citations benchmark resolves a batch of --citations citations
+against the same synthetic code (see ``law_code.citations``).
+
+The startup benchmark compares the full site's settings with the
+browse-only settings_readonly.py, starting a fresh worker process for
+each and timing its first request and then the ones after it.
+
+"""
+
+from array import array
+from optparse import make_option
+import datetime
+import os
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.utils import simplejson
+
+from law_code import autocomplete, cache, citations, pipeline, references, snapshot
+from law_code.bulk import SectionNode
+from law_code.management.commands.import_us_code import Command as ImportCommand
+from law_code.models import Code, Section
+from law_code.search import SearchIndex
+from law_code.us_code import (ROMAN_NUMERALS, SectionTreeBuilder,
+                              iter_us_code_sections, us_section_rx)
+
+
+def best_time(func, repeat):
+    "The fastest of ``repeat`` calls to ``func``, in seconds."
+    best = None
+    for ii in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def throughput(size, seconds):
+    "MB/s for ``size`` bytes in ``seconds``."
+    if not seconds:
+        return float("inf")
+    return size / (1024.0 * 1024.0) / seconds
+
+
+def percentile(values, fraction):
+    "The value ``fraction`` of the way through sorted ``values``."
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def synthetic_vocabulary(rand, size):
+    "``size`` made-up words, for synthetic statute text."
+    consonants, vowels = "bcdfghlmnprstv", "aeiou"
+    words = {}
+    while len(words) < size:
+        word = "".join([rand.choice(consonants) + rand.choice(vowels)
+                        for ii in range(rand.randint(2, 4))])
+        words[word] = True
+    return words.keys()
+
+
+def zipf_words(rand, vocabulary, count):
+    """``count`` words drawn from ``vocabulary`` with a roughly Zipfian
+    distribution, like real text: a few words are very common, most are
+    rare.
+
+    """
+    last = len(vocabulary) - 1
+    return [vocabulary[min(int(rand.paretovariate(1.0)) - 1, last)]
+            for ii in range(count)]
+
+
+def latency_summary(latencies):
+    "p50, p95 and max of a list of latencies, in ms."
+    latencies = sorted(latencies)
+    return {"count": len(latencies),
+            "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95),
+            "max_ms": latencies[-1]}
+
+
+# Run in a new process by the startup benchmark, with the settings
+# module to measure in DJANGO_SETTINGS_MODULE and the arguments
+# database, snapshot directory, number of requests, URL... It times
+# everything from the first import of Django to the first response,
+# then the given number of requests over the URLs, and prints the
+# results as JSON.
+STARTUP_SCRIPT = r"""
+import sys, time
+start = time.time()
+from cStringIO import StringIO
+from django.conf import settings
+settings.DATABASE_NAME = sys.argv[1]
+settings.LAW_CODE_SNAPSHOT_DIR = sys.argv[2]
+settings.DEBUG = False
+from django.core.handlers.wsgi import WSGIHandler
+from django.utils import simplejson
+
+handler = WSGIHandler()
+
+def get(path):
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": "",
+               "SCRIPT_NAME": "", "SERVER_NAME": "testserver", "SERVER_PORT": "80",
+               "SERVER_PROTOCOL": "HTTP/1.1", "wsgi.version": (1, 0),
+               "wsgi.url_scheme": "http", "wsgi.input": StringIO(""),
+               "wsgi.errors": sys.stderr, "wsgi.multithread": False,
+               "wsgi.multiprocess": True, "wsgi.run_once": False}
+    statuses = []
+    "".join(handler(environ, lambda status, headers: statuses.append(status)))
+    if not statuses[0].startswith("200"):
+        raise SystemExit("%s returned %s" % (path, statuses[0]))
+
+requests, urls = int(sys.argv[3]), sys.argv[4:]
+get(urls[0])
+cold_start = time.time() - start
+modules = len(sys.modules)
+for url in urls[1:]:
+    get(url)
+latencies = []
+for i in range(requests):
+    request_start = time.time()
+    get(urls[i % len(urls)])
+    latencies.append((time.time() - request_start) * 1000)
+print simplejson.dumps({"cold_start_ms": cold_start * 1000, "modules": modules,
+                        "latencies": latencies})
+"""
+
+
+# The divisions between a title and its sections, outermost first;
+# --divisions picks how many, starting with chapters.
+DIVISIONS = (
+    ("SUBTITLE", lambda n: chr(ord("A") + (n - 1) % 26)),
+    ("CHAPTER", str),
+    ("SUBCHAPTER", lambda n: ROMAN_NUMERALS[n - 1].upper()),
+    ("PART", lambda n: chr(ord("A") + (n - 1) % 26)),
+    ("SUBPART", lambda n: chr(ord("A") + (n - 1) % 26)),
+    )
+DIVISION_PREFERENCE = ("CHAPTER", "SUBCHAPTER", "PART", "SUBPART", "SUBTITLE")
+
+# Labels for each level of enumeration in a section's statute text:
+# (a), (1), (A), (i), (I). Letters stop at "e" so that they can't be
+# mistaken for roman numerals.
+ENUMERATION_LABELS = (
+    lambda n: "abcde"[n - 1],
+    str,
+    lambda n: "ABCDE"[n - 1],
+    lambda n: ROMAN_NUMERALS[n - 1],
+    lambda n: ROMAN_NUMERALS[n - 1].upper(),
+    )
+
+
+def synthetic_statute(rand, vocabulary, depth):
+    """The lines of a ``-STATUTE-`` field, enumerated ``depth`` levels
+    deep."""
+    def sentence(low, high):
+        return " ".join(zipf_words(rand, vocabulary, rand.randint(low, high)))
+
+    lines = [sentence(10, 40) + ":"]
+
+    def add_parts(level):
+        for number in range(1, rand.randint(2, 5) + 1):
+            has_parts = level + 1 < depth and rand.random() < 0.4
+            text = sentence(8, 60)
+            if has_parts:
+                text += ":"
+            else:
+                text += "."
+            lines.append("%s(%s) %s" % (
+                "  " * (level + 2), ENUMERATION_LABELS[level](number), text))
+            if has_parts:
+                add_parts(level + 1)
+
+    if depth:
+        add_parts(0)
+    else:
+        lines[0] = lines[0][:-1] + "."
+    return lines
+
+
+def write_synthetic_title(out, title, size, divisions, depth, rand, vocabulary):
+    """
+    Write a synthetic title file, in the format of the House's ASCII
+    title files, of about ``size`` bytes to the file object ``out``.
+    Sections sit under ``divisions`` levels of chapters, subchapters and
+    so on, and their statute text is enumerated ``depth`` levels deep.
+
+    """
+    def document(cite, head, fields=()):
+        out.write("-CITE-\r\n    %s\r\n\r\n-HEAD-\r\n    %s\r\n\r\n" % (cite, head))
+        for name, lines in fields:
+            out.write("-%s-\r\n%s\r\n\r\n" % (name, "\r\n".join(lines)))
+
+    def heading():
+        return " ".join(zipf_words(rand, vocabulary, rand.randint(2, 6))).upper()
+
+    levels = [division for division in DIVISIONS
+              if division[0] in DIVISION_PREFERENCE[:divisions]]
+    counters = [0] * len(levels)
+    # How many more children each open division will get.
+    remaining = [0] * len(levels)
+
+    def open_divisions(start):
+        for level in range(start, len(levels)):
+            if level > 0:
+                remaining[level - 1] -= 1
+            counters[level] += 1
+            for deeper in range(level + 1, len(levels)):
+                counters[deeper] = 0
+            remaining[level] = rand.randint(2, 6)
+            name, label = levels[level]
+            document("%d USC, %s %s" % (title, name, label(counters[level])),
+                     "%s %s - %s" % (name, label(counters[level]), heading()))
+
+    document("%d USC TITLE %d" % (title, title), "TITLE %d - %s" % (title, heading()))
+    number = 0
+    while out.tell() < size:
+        if levels:
+            level = len(levels) - 1
+            while level >= 0 and remaining[level] <= 0:
+                level -= 1
+            if level < len(levels) - 1:
+                open_divisions(level + 1)
+            remaining[-1] -= 1
+        number += 1
+        name = " ".join(zipf_words(rand, vocabulary, rand.randint(3, 10))).capitalize()
+        document("%d USC Sec. %d" % (title, number), "Sec. %d. %s" % (number, name), (
+            ("STATUTE", synthetic_statute(rand, vocabulary, depth)),
+            ("SOURCE", ["    (Pub. L. %d-%d, %d Stat. %d.)" % (
+                rand.randint(1, 115), rand.randint(1, 500),
+                rand.randint(1, 130), rand.randint(1, 3000))]),
+            ))
+
+
+def write_synthetic_titles(directory, titles, size, divisions, depth):
+    "Write Title_01.txt and so on; returns their paths."
+    rand = random.Random(0)
+    vocabulary = synthetic_vocabulary(rand, 5000)
+    paths = []
+    for title in range(1, titles + 1):
+        path = os.path.join(directory, "Title_%02d.txt" % title)
+        out = open(path, "wb")
+        try:
+            write_synthetic_title(out, title, size, divisions, depth, rand, vocabulary)
+        finally:
+            out.close()
+        paths.append(path)
+    return paths
+
+
+SNAPSHOT_TITLES = 50
+SNAPSHOT_CHAPTERS = 20
+
+def synthetic_snapshot(rand, vocabulary, per_chapter, subsections=0):
+    """
+    A TreeSnapshot of a synthetic code of ``SNAPSHOT_TITLES`` titles of
+    ``SNAPSHOT_CHAPTERS`` chapters, each with ``per_chapter`` sections
+    numbered from 1 in each title, and ``subsections`` subsections
+    ("a", "b"...) under each section.
+
+    """
+    ids, parents, ends, levels = array("i"), array("i"), array("i"), array("i")
+    numbers, names, types, paths = [], [], [], []
+
+    def add(parent, level, type, number, path):
+        position = len(ids)
+        ids.append(position + 1)
+        parents.append(parent)
+        ends.append(position + 1)
+        levels.append(level)
+        numbers.append(number)
+        names.append(" ".join(zipf_words(rand, vocabulary, 6)))
+        types.append(type)
+        paths.append(path)
+        return position
+
+    for title in range(1, SNAPSHOT_TITLES + 1):
+        section_number = 0
+        title_position = add(-1, 0, Section.TITLE, str(title), str(title))
+        for chapter in range(1, SNAPSHOT_CHAPTERS + 1):
+            chapter_path = "%d/%d" % (title, chapter)
+            chapter_position = add(title_position, 1, Section.CHAPTER,
+                                   str(chapter), chapter_path)
+            for ii in range(per_chapter):
+                section_number += 1
+                section_path = "%s/%d" % (chapter_path, section_number)
+                section_position = add(chapter_position, 2, Section.SECTION,
+                                       str(section_number), section_path)
+                for label in string.ascii_lowercase[:subsections]:
+                    add(section_position, 3, Section.SUBSECTION, label,
+                        "%s/%s" % (section_path, label))
+                ends[section_position] = len(ids)
+            ends[chapter_position] = len(ids)
+        ends[title_position] = len(ids)
+    return snapshot.TreeSnapshot(1, True, ids, parents, ends, levels,
+                                 numbers, names, types, paths)
+
+
+class Command(BaseCommand):
+    help = ('Run law code benchmarks: parser, search, import, views, startup. '
+            'Runs all of them by default.')
+    option_list = BaseCommand.option_list + (
+        make_option('--directory', action='store', dest='directory',
+                    help='Directory of US Code title files (Title_01.txt, etc) to benchmark '
+                    'with, instead of synthetic ones.'),
+        make_option('--titles', action='store', type='int', dest='titles', default=2,
+                    help='Synthetic title files to generate (default 2).'),
+        make_option('--title-size', action='store', type='float', dest='title_size',
+                    default=2.0, help='Size of each synthetic title, in MB (default 2).'),
+        make_option('--divisions', action='store', type='int', dest='divisions', default=2,
+                    help='Levels of chapters, subchapters, etc above synthetic sections, '
+                    '0-5 (default 2).'),
+        make_option('--depth', action='store', type='int', dest='depth', default=3,
+                    help='Levels of subsections, paragraphs, etc in synthetic sections, '
+                    '0-5 (default 3).'),
+        make_option('--generate', action='store', dest='generate',
+                    help='Just write the synthetic title files to this directory.'),
+        make_option('--json', action='store', dest='json',
+                    help='Also write the results to this file, as JSON.'),
+        make_option('--samples', action='store', type='int', dest='samples', default=20,
+                    help='Pages the views benchmark requests at each depth (default 20).'),
+        make_option('--repeat', action='store', type='int', dest='repeat', default=3,
+                    help='Run each timing this many times, and keep the best (default 3).'),
+        make_option('--sections', action='store', type='int', dest='sections', default=250000,
+                    help='Sections in the synthetic code the search benchmark indexes '
+                    '(default 250000, about the size of the US Code down to the '
+                    'subsection level); the autocomplete benchmark uses a quarter.'),
+        make_option('--citations', action='store', type='int', dest='citations',
+                    default=10000, help='Citations the citations benchmark resolves '
+                    'in one batch (default 10000).'),
+        make_option('--queries', action='store', type='int', dest='queries', default=500,
+                    help='Queries the search benchmark times (default 500).'),
+        make_option('--requests', action='store', type='int', dest='requests', default=200,
+                    help='Requests each worker makes after its first in the startup '
+                    'benchmark (default 200).'),
+    )
+    args = "[benchmark ...]"
+
+    benchmarks = ("parser", "search", "autocomplete", "citations", "import", "views",
+                  "startup")
+
+    def handle(self, *args, **options):
+        self.opts = options
+        if options.get("generate"):
+            directory = os.path.abspath(os.path.expanduser(options["generate"]))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for path in self._write_synthetic_titles(directory):
+                print "Wrote %s (%.1f MB)" % (path, os.path.getsize(path) / (1024.0 * 1024.0))
+            return
+        for name in args:
+            if name not in self.benchmarks:
+                raise CommandError("Unknown benchmark %r; choose from %s" % (
+                    name, ", ".join(self.benchmarks)))
+        self.results = {
+            "started": datetime.datetime.now().isoformat(),
+            "options": dict([(key, value) for key, value in options.items()
+                             if isinstance(value, (int, float, basestring))]),
+            }
+        self.synthetic_dir = None
+        try:
+            for name in args or self.benchmarks:
+                print "== %s" % name
+                getattr(self, "benchmark_%s" % name)()
+        finally:
+            if self.synthetic_dir is not None:
+                shutil.rmtree(self.synthetic_dir)
+        if options.get("json"):
+            out = open(options["json"], "w")
+            try:
+                simplejson.dump(self.results, out, indent=2)
+            finally:
+                out.close()
+            print "Results written to %s" % options["json"]
+
+    def _write_synthetic_titles(self, directory):
+        return write_synthetic_titles(
+            directory, self.opts.get("titles") or 1,
+            int((self.opts.get("title_size") or 2.0) * 1024 * 1024),
+            min(self.opts.get("divisions") or 0, len(DIVISIONS)),
+            min(self.opts.get("depth") or 0, len(ENUMERATION_LABELS)))
+
+    def _title_paths(self):
+        "The title files given by --directory, or synthetic ones."
+        if not self.opts.get("directory"):
+            if self.synthetic_dir is None:
+                self.synthetic_dir = tempfile.mkdtemp()
+                paths = self._write_synthetic_titles(self.synthetic_dir)
+                print "Generated %d synthetic titles, %.1f MB" % (
+                    len(paths), sum([os.path.getsize(path) for path in paths])
+                    / (1024.0 * 1024.0))
+            return [os.path.join(self.synthetic_dir, name)
+                    for name in sorted(os.listdir(self.synthetic_dir))]
+        base_dir = os.path.abspath(os.path.expanduser(self.opts["directory"]))
+        paths = []
+        for ii in range(1, 51):
+            path = os.path.join(base_dir, "Title_%02d.txt" % ii)
+            if os.path.exists(path):
+                paths.append(path)
+        if not paths:
+            raise CommandError("No title files found in %s" % base_dir)
+        return paths
+
+    def benchmark_parser(self):
+        """
+        Compare the throughput of the original header regex against
+        the tokenizer in ``law_code.us_code``, both for headers alone
+        (the same work the regex does) and for headers plus section
+        bodies split down to the clause level.
+
+        """
+        repeat = self.opts.get("repeat") or 3
+        print "%-14s %8s %12s %12s %12s" % (
+            "file", "MB", "regex MB/s", "tokens MB/s", "bodies MB/s")
+        totals = [0, 0.0, 0.0, 0.0]
+        for path in self._title_paths():
+            title_file = open(path)
+            try:
+                data = title_file.read()
+            finally:
+                title_file.close()
+
+            def run_regex():
+                us_section_rx.findall(data)
+
+            def run_headers():
+                for fields in iter_us_code_sections(StringIO(data)):
+                    pass
+
+            def run_bodies():
+                builder = SectionTreeBuilder()
+                for fields in iter_us_code_sections(StringIO(data)):
+                    builder.add(*fields)
+
+            times = [best_time(run_regex, repeat),
+                     best_time(run_headers, repeat),
+                     best_time(run_bodies, repeat)]
+            print "%-14s %8.2f %12.1f %12.1f %12.1f" % (
+                (os.path.basename(path), len(data) / (1024.0 * 1024.0)) +
+                tuple([throughput(len(data), t) for t in times]))
+            totals[0] += len(data)
+            for ii, t in enumerate(times):
+                totals[ii + 1] += t
+
+        rates = [throughput(totals[0], t) for t in totals[1:]]
+        print "%-14s %8.2f %12.1f %12.1f %12.1f" % (
+            ("total", totals[0] / (1024.0 * 1024.0)) + tuple(rates))
+        print "Tokenizer header throughput is %.2fx the regex's" % (
+            rates[1] / rates[0])
+        self.results["parser"] = {
+            "mb": totals[0] / (1024.0 * 1024.0),
+            "regex_mb_per_s": rates[0],
+            "tokens_mb_per_s": rates[1],
+            "bodies_mb_per_s": rates[2],
+            }
+
+    def benchmark_search(self):
+        """
+        Build a search index for a synthetic code of --sections
+        sections in a temporary directory, then time --queries queries
+        against it, split between common words (which match nearly
+        every section, so are the worst case for ranking), rare words
+        and two-word queries.
+
+        """
+        rand = random.Random(0)
+        vocabulary = synthetic_vocabulary(rand, 30000)
+        count = self.opts.get("sections") or 250000
+        directory = tempfile.mkdtemp()
+        try:
+            index = SearchIndex(os.path.join(directory, "search.db"))
+            code = Code(id=1)
+            start = time.time()
+            batch = []
+            for ii in range(1, count + 1):
+                node = SectionNode(
+                    "section", str(ii), " ".join(zipf_words(rand, vocabulary, 6)),
+                    " ".join(zipf_words(rand, vocabulary, rand.randint(20, 200))),
+                    path="1/%d" % ii)
+                node.id = ii
+                batch.append(node)
+                if len(batch) == 5000:
+                    index.add_nodes(code, batch)
+                    batch = []
+            index.add_nodes(code, batch)
+            index.commit()
+            index.optimize()
+            print "Indexed %d sections in %.1fs (%.1f MB)" % (
+                count, time.time() - start,
+                os.path.getsize(index.path) / (1024.0 * 1024.0))
+
+            kinds = (
+                ("common word", lambda: vocabulary[rand.randint(0, 20)]),
+                ("rare word", lambda: rand.choice(vocabulary)),
+                ("two words", lambda: " ".join(zipf_words(rand, vocabulary, 2))),
+                )
+            per_kind = (self.opts.get("queries") or 500) / len(kinds) or 1
+            self.results["search"] = {"sections": count}
+            for label, make_query in kinds:
+                latencies = []
+                for ii in range(per_kind):
+                    query = make_query()
+                    start = time.time()
+                    index.search(query, limit=20)
+                    latencies.append((time.time() - start) * 1000)
+                latencies.sort()
+                print "%-12s %d queries: p50 %.2fms, p95 %.2fms, p99 %.2fms, max %.2fms" % (
+                    label, len(latencies), percentile(latencies, 0.5),
+                    percentile(latencies, 0.95), percentile(latencies, 0.99),
+                    latencies[-1])
+                self.results["search"][label] = latency_summary(latencies)
+        finally:
+            shutil.rmtree(directory)
+
+    def benchmark_autocomplete(self):
+        """
+        Build the autocomplete index of a synthetic code with a
+        quarter of --sections sections (the US Code has about 60,000
+        above the subsection level), in 50 titles of 20 chapters each,
+        and time --queries lookups, split between section numbers,
+        places in the tree and the starts of words of names.
+
+        """
+        rand = random.Random(0)
+        vocabulary = synthetic_vocabulary(rand, 30000)
+        count = (self.opts.get("sections") or 250000) / 4
+        titles, chapters = SNAPSHOT_TITLES, SNAPSHOT_CHAPTERS
+        per_chapter = max(count / (titles * chapters), 1)
+        tree = synthetic_snapshot(rand, vocabulary, per_chapter)
+
+        start = time.time()
+        index = autocomplete.build_index(tree)
+        build_time = time.time() - start
+        data = index.dumps()
+        start = time.time()
+        index = autocomplete.PrefixIndex.loads(data)
+        load_time = time.time() - start
+        print "Indexed %d sections under %d keys in %.1fs; %.1f MB, loaded in %.0fms" % (
+            len(tree), len(index), build_time, len(data) / (1024.0 * 1024.0),
+            load_time * 1000)
+
+        def word_start():
+            word = rand.choice(vocabulary)
+            return word[:rand.randint(2, len(word))]
+
+        kinds = (
+            ("number", lambda: str(rand.randint(1, per_chapter * chapters))),
+            ("place", lambda: "title %d ch %d" % (rand.randint(1, titles),
+                                                  rand.randint(1, chapters))),
+            ("name", word_start),
+            )
+        per_kind = (self.opts.get("queries") or 500) / len(kinds) or 1
+        self.results["autocomplete"] = {
+            "sections": len(tree),
+            "keys": len(index),
+            "build_s": build_time,
+            "mb": len(data) / (1024.0 * 1024.0),
+            "load_ms": load_time * 1000,
+            }
+        for label, make_query in kinds:
+            latencies = []
+            for ii in range(per_kind):
+                query = make_query()
+                start = time.time()
+                index.lookup(query, 10)
+                latencies.append((time.time() - start) * 1000)
+            latencies.sort()
+            print "%-7s %d queries: p50 %.3fms, p95 %.3fms, p99 %.3fms, max %.3fms" % (
+                label, len(latencies), percentile(latencies, 0.5),
+                percentile(latencies, 0.95), percentile(latencies, 0.99),
+                latencies[-1])
+            summary = latency_summary(latencies)
+            summary["p99_ms"] = percentile(latencies, 0.99)
+            self.results["autocomplete"][label] = summary
+
+    def benchmark_citations(self):
+        """
+        Resolve --citations synthetic citations in one batch against
+        the snapshot of a synthetic code the size of the US Code (see
+        ``benchmark_autocomplete``), with two subsections per section.
+        Half the citations name a subsection, and one in ten a section
+        that doesn't exist. The first batch also builds the citation
+        index, which is then kept with the snapshot.
+
+        """
+        rand = random.Random(0)
+        vocabulary = synthetic_vocabulary(rand, 30000)
+        count = (self.opts.get("sections") or 250000) / 4
+        per_chapter = max(count / (SNAPSHOT_TITLES * SNAPSHOT_CHAPTERS), 1)
+        tree = synthetic_snapshot(rand, vocabulary, per_chapter, subsections=2)
+        sections_per_title = per_chapter * SNAPSHOT_CHAPTERS
+        requested = []
+        for ii in range(self.opts.get("citations") or 10000):
+            title = rand.randint(1, SNAPSHOT_TITLES)
+            number = rand.randint(1, sections_per_title)
+            if rand.random() < 0.1:
+                number += sections_per_title
+            citation = u"%d U.S.C. \xa7 %d" % (title, number)
+            if rand.random() < 0.5:
+                citation += u"(%s)" % rand.choice("ab")
+            requested.append(citation)
+
+        url_prefix = "/law/1/"
+        start = time.time()
+        results = citations.resolve_citations(tree, requested, url_prefix)
+        cold = time.time() - start
+        warm = best_time(lambda: citations.resolve_citations(tree, requested, url_prefix),
+                         self.opts.get("repeat") or 3)
+        resolved = len([result for result in results if "id" in result])
+        print "Resolved %d of %d citations against %d sections: %.0fms with the " \
+            "index build, %.0fms after (%.0f citations/s)" % (
+                resolved, len(requested), len(tree), cold * 1000, warm * 1000,
+                len(requested) / warm)
+        self.results["citations"] = {
+            "citations": len(requested),
+            "resolved": resolved,
+            "sections": len(tree),
+            "cold_ms": cold * 1000,
+            "warm_ms": warm * 1000,
+            }
+
+    def _with_test_database(self, func, on_disk=False):
+        """
+        Call ``func`` with a freshly created test database, and with
+        tree snapshots written to a temporary directory, so that the
+        real ones are left alone. With ``on_disk``, an SQLite test
+        database is a file other processes can open, rather than in
+        memory.
+
+        """
+        old_name = settings.DATABASE_NAME
+        old_test_name = getattr(settings, "TEST_DATABASE_NAME", None)
+        old_snapshot_dir = getattr(settings, "LAW_CODE_SNAPSHOT_DIR", None)
+        settings.LAW_CODE_SNAPSHOT_DIR = tempfile.mkdtemp()
+        if on_disk and settings.DATABASE_ENGINE == "sqlite3" and not old_test_name:
+            settings.TEST_DATABASE_NAME = os.path.join(
+                settings.LAW_CODE_SNAPSHOT_DIR, "benchmark.db")
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            return func()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(settings.LAW_CODE_SNAPSHOT_DIR)
+            settings.LAW_CODE_SNAPSHOT_DIR = old_snapshot_dir
+            settings.TEST_DATABASE_NAME = old_test_name
+
+    def _import(self, paths, **opts):
+        """
+        Import ``paths`` with import_us_code into a public "Benchmark"
+        code, returning the code and the time taken in seconds.
+
+        """
+        code, created = Code.objects.get_or_create(name="Benchmark", type=Code.COUNTRY)
+        importer = ImportCommand()
+        importer.opts = opts
+        importer.code = code
+        importer.format = pipeline.get_format("us")
+        importer.metrics = pipeline.StageMetrics()
+        importer.search_index = None
+        importer.reference_index = references.ReferenceIndex()
+        start = time.time()
+        for path in paths:
+            title_file = open(path)
+            try:
+                importer._load_title(importer._load_code_title, title_file)
+            finally:
+                title_file.close()
+        elapsed = time.time() - start
+        snapshot.write_snapshot(code)
+        return code, elapsed
+
+    def benchmark_import(self):
+        """
+        Time import_us_code end to end, from title files to rows, into
+        an empty test database with --bulk, and then again over the
+        same titles with --incremental, which finds nothing changed.
+
+        """
+        paths = self._title_paths()
+        size = sum([os.path.getsize(path) for path in paths])
+
+        def run():
+            code, bulk_time = self._import(paths, bulk=True, batch_size=500)
+            sections = Section.objects.filter(code=code).count()
+            code, incremental_time = self._import(paths, incremental=True, batch_size=500)
+            return sections, bulk_time, incremental_time
+
+        sections, bulk_time, incremental_time = self._with_test_database(run)
+        print "Bulk import: %d sections in %.1fs (%.2f MB/s, %.0f sections/s)" % (
+            sections, bulk_time, throughput(size, bulk_time), sections / bulk_time)
+        print "Incremental re-import, unchanged: %.1fs (%.2f MB/s)" % (
+            incremental_time, throughput(size, incremental_time))
+        self.results["import"] = {
+            "mb": size / (1024.0 * 1024.0),
+            "sections": sections,
+            "bulk_s": bulk_time,
+            "bulk_mb_per_s": throughput(size, bulk_time),
+            "incremental_s": incremental_time,
+            "incremental_mb_per_s": throughput(size, incremental_time),
+            }
+
+    def _request(self, client, url):
+        "GET ``url``, returning (latency in ms, queries run)."
+        start = time.time()
+        response = client.get(url)
+        elapsed = (time.time() - start) * 1000
+        if response.status_code != 200:
+            raise CommandError("%s returned %d" % (url, response.status_code))
+        return elapsed, len(connection.queries)
+
+    def benchmark_views(self):
+        """
+        Import the titles into a test database, then time the code
+        index page and --samples section pages at each depth of the
+        tree, counting queries, both rendered from scratch and from
+        the page cache (see ``law_code.cache``).
+
+        """
+        paths = self._title_paths()
+        samples = self.opts.get("samples") or 20
+
+        def run():
+            code, elapsed = self._import(paths, bulk=True, batch_size=500)
+            opts = Section._meta
+            max_level = Section.objects.filter(code=code)\
+                .order_by("-%s" % opts.level_attr)[0].level
+            urls_by_level = []
+            for level in range(max_level + 1):
+                paths_at_level = list(Section.objects.filter(
+                    code=code, current_version=True, **{opts.level_attr: level})
+                    .order_by("?").values_list("path", flat=True)[:samples])
+                urls_by_level.append([Section(code=code, path=path).get_absolute_url()
+                                      for path in paths_at_level])
+
+            results = {}
+            client = Client()
+            old_debug = settings.DEBUG
+            # Queries are only recorded with DEBUG on.
+            settings.DEBUG = True
+            try:
+                for label, backend in (("uncached", "dummy:///"),
+                                       ("cached", "locmem:///?max_entries=100000")):
+                    cache._page_cache = get_cache(backend)
+                    if label == "cached":
+                        # Fill the cache first.
+                        self._request(client, code.get_absolute_url())
+                        for urls in urls_by_level:
+                            for url in urls:
+                                self._request(client, url)
+                    results[label] = {}
+                    latency, queries = self._request(client, code.get_absolute_url())
+                    results[label]["code_index"] = {"ms": latency, "queries": queries}
+                    for level, urls in enumerate(urls_by_level):
+                        latencies = []
+                        queries = []
+                        for url in urls:
+                            latency, query_count = self._request(client, url)
+                            latencies.append(latency)
+                            queries.append(query_count)
+                        summary = latency_summary(latencies)
+                        summary["max_queries"] = max(queries)
+                        results[label]["level_%d" % level] = summary
+            finally:
+                settings.DEBUG = old_debug
+                cache._page_cache = None
+            return results
+
+        results = self._with_test_database(run)
+        for label in ("uncached", "cached"):
+            index = results[label]["code_index"]
+            print "%s: code index %.1fms, %d queries" % (label, index["ms"], index["queries"])
+            level = 0
+            while "level_%d" % level in results[label]:
+                summary = results[label]["level_%d" % level]
+                print "%s: sections at level %d: %d pages, p50 %.1fms, p95 %.1fms, " \
+                    "max %.1fms, at most %d queries" % (
+                        label, level, summary["count"], summary["p50_ms"],
+                        summary["p95_ms"], summary["max_ms"], summary["max_queries"])
+                level += 1
+        self.results["views"] = results
+
+    def _settings_profiles(self):
+        "(label, settings module) of the full and browse-only settings."
+        module = os.environ.get("DJANGO_SETTINGS_MODULE") or settings.SETTINGS_MODULE
+        if "." in module:
+            readonly = "%s.settings_readonly" % module.rsplit(".", 1)[0]
+        else:
+            readonly = "settings_readonly"
+        return (("full", module), ("readonly", readonly))
+
+    def _start_worker(self, module, database, urls):
+        "Run STARTUP_SCRIPT with ``module`` as the settings; returns its results."
+        env = dict(os.environ)
+        env["DJANGO_SETTINGS_MODULE"] = module
+        env["PYTHONPATH"] = os.pathsep.join([path for path in sys.path if path])
+        process = subprocess.Popen(
+            [sys.executable, "-c", STARTUP_SCRIPT, database,
+             settings.LAW_CODE_SNAPSHOT_DIR, str(self.opts.get("requests") or 200)] + urls,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = process.communicate()
+        if process.returncode:
+            raise CommandError("A worker with %s failed:\n%s" % (module, err))
+        return simplejson.loads(out.strip().splitlines()[-1])
+
+    def benchmark_startup(self):
+        """
+        Import the titles into a test database, then start workers with
+        the full settings and with settings_readonly.py, --repeat times
+        each, timing each worker's start up to its first response (the
+        list of codes), and then --requests requests over the code
+        index and --samples section pages, served from the page cache,
+        which is what's left of a request besides the middleware,
+        context processors and URL resolving.
+
+        """
+        if settings.DATABASE_ENGINE != "sqlite3":
+            raise CommandError("The startup benchmark needs the sqlite3 database engine")
+        paths = self._title_paths()
+        samples = self.opts.get("samples") or 20
+        repeat = self.opts.get("repeat") or 3
+
+        def run():
+            code, elapsed = self._import(paths, bulk=True, batch_size=500)
+            section_paths = list(Section.objects.filter(
+                code=code, current_version=True, **{Section._meta.level_attr: 2})
+                .order_by("?").values_list("path", flat=True)[:samples])
+            urls = [reverse("home"), code.get_absolute_url()] + [
+                Section(code=code, path=path).get_absolute_url() for path in section_paths]
+            database = settings.DATABASE_NAME
+            results = {}
+            for label, module in self._settings_profiles():
+                runs = [self._start_worker(module, database, urls) for i in range(repeat)]
+                latencies = []
+                for result in runs:
+                    latencies.extend(result["latencies"])
+                results[label] = latency_summary(latencies)
+                results[label]["settings"] = module
+                results[label]["cold_start_ms"] = min([result["cold_start_ms"] for result in runs])
+                results[label]["modules"] = runs[0]["modules"]
+            return results
+
+        results = self._with_test_database(run, on_disk=True)
+        for label in ("full", "readonly"):
+            summary = results[label]
+            print "%s (%s): cold start %.0fms, %d modules; per request p50 %.2fms, " \
+                "p95 %.2fms" % (label, summary["settings"], summary["cold_start_ms"],
+                                summary["modules"], summary["p50_ms"], summary["p95_ms"])
+        print "readonly saves %.0fms of start up and %.2fms (p50) per request" % (
+            results["full"]["cold_start_ms"] - results["readonly"]["cold_start_ms"],
+            results["full"]["p50_ms"] - results["readonly"]["p50_ms"])
+        self.results["startup"] = results
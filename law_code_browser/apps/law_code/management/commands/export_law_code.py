@@ -0,0 +1,238 @@
+"""Export law codes as static, pre-rendered pages.
+
+Every section page, and each code's own page, is rendered as an
+anonymous user would see it and written under the output directory at
+its URL's path, as ``index.html`` plus a gzipped ``index.html.gz``. A
+web server can then serve anonymous traffic without Django, eg with
+nginx::
+
+    location /law/ {
+        root /path/to/export;
+        gzip_static on;
+        try_files $uri/index.html @django;
+    }
+
+Anything not exported (search, the JSON used to expand the tree) falls
+through to Django.
+
+"""
+
+from optparse import make_option
+from StringIO import StringIO
+import datetime
+import gzip
+import multiprocessing
+import os
+import time
+import urllib
+
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from law_code.models import Code, Section
+
+
+class PageRenderer(BaseHandler):
+    """
+    Renders pages as the site's WSGI handler does, through the
+    middleware, the URL resolver and the views, for an anonymous GET
+    with no headers. Unlike the WSGI handler it doesn't send the
+    request_started and request_finished signals, which would close the
+    database connection after every page.
+
+    """
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+        self.load_middleware()
+
+    def get(self, url):
+        "The response to a GET of ``url``."
+        request = WSGIRequest({
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": urllib.unquote(url),
+            "SCRIPT_NAME": "",
+            "QUERY_STRING": "",
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "80",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": StringIO(),
+            "wsgi.errors": StringIO(),
+            "wsgi.multiprocess": True,
+            "wsgi.multithread": False,
+            "wsgi.run_once": False,
+        })
+        response = self.get_response(request)
+        for middleware_method in self._response_middleware:
+            response = middleware_method(request, response)
+        return self.apply_response_fixes(request, response)
+
+
+def _page_file(output, url):
+    "The file the page at ``url`` is exported to."
+    parts = [part for part in urllib.unquote(url).split("/") if part]
+    if "." in parts or ".." in parts:
+        raise CommandError("Can't export %r outside of %s" % (url, output))
+    return os.path.join(output, *(parts + ["index.html"]))
+
+
+def _write_file(path, data, mtime, compress=False):
+    "Write ``data`` to ``path`` through a temporary file."
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    out = open(tmp_path, "wb")
+    try:
+        if compress:
+            gz = gzip.GzipFile(os.path.basename(path)[:-3], "wb", 9, out)
+            gz.write(data)
+            gz.close()
+        else:
+            out.write(data)
+    finally:
+        out.close()
+    os.utime(tmp_path, (mtime, mtime))
+    os.rename(tmp_path, path)
+
+
+def export_page(renderer, output, url, modified):
+    """Render the page at ``url`` with ``renderer``, a PageRenderer, and
+    write it, and a gzipped copy."""
+    response = renderer.get(url)
+    if response.status_code != 200:
+        raise CommandError("%s returned %d" % (url, response.status_code))
+    path = _page_file(output, url)
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # Another worker may have just made it.
+        if not os.path.isdir(directory):
+            raise
+    # Match the Last-Modified Django would have sent.
+    mtime = time.mktime(modified.timetuple())
+    _write_file(path, response.content, mtime)
+    _write_file(path + ".gz", response.content, mtime, compress=True)
+
+
+def remove_page(output, url):
+    "Remove an exported page, leaving the pages below it."
+    path = _page_file(output, url)
+    for name in (path, path + ".gz"):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def export_tree(args):
+    """
+    Export the current sections of one title: the tree ``tree_id``,
+    only those modified since ``since`` unless it is None. Runs in a
+    worker process with --jobs.
+
+    Returns ``(tree_id, pages written)``.
+
+    """
+    output, tree_id, since = args
+    renderer = PageRenderer()
+    sections = Section.objects.filter(current_version=True, **{
+        Section._meta.tree_id_attr: tree_id})
+    if since is not None:
+        sections = sections.filter(modified__gte=since)
+    count = 0
+    for section in sections.order_by(Section._meta.left_attr).iterator():
+        export_page(renderer, output, section.get_absolute_url(), section.modified)
+        count += 1
+    return tree_id, count
+
+
+class Command(BaseCommand):
+    help = 'Export law codes as static pages, for serving without Django.'
+    option_list = BaseCommand.option_list + (
+        make_option('--output', action='store', dest='output',
+                    help='Directory to export to; it mirrors the site\'s URLs.'),
+        make_option('--jobs', action='store', type='int', dest='jobs', default=1,
+                    help='Export titles in this many worker processes.'),
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Re-render every page, not just the ones modified since '
+                    'the last export.'),
+    )
+    args = "[code_id ...]"
+
+    def handle(self, *args, **options):
+        self.opts = options
+        if not options.get("output"):
+            raise CommandError("--output is required")
+        self.output = os.path.abspath(os.path.expanduser(options["output"]))
+        codes = Code.objects.filter(public=True)
+        if args:
+            codes = codes.filter(id__in=[int(arg) for arg in args])
+        for code in codes:
+            self.export_code(code)
+
+    def _stamp_file(self, code):
+        return os.path.join(self.output, ".law_code_export_%d" % code.id)
+
+    def _last_export(self, code):
+        "When the last export of ``code`` started, or None."
+        path = self._stamp_file(code)
+        if self.opts.get("full") or not os.path.exists(path):
+            return None
+        stamp_file = open(path)
+        try:
+            return datetime.datetime.fromtimestamp(float(stamp_file.read()))
+        finally:
+            stamp_file.close()
+
+    def export_code(self, code):
+        """
+        Export ``code``, one title at a time. After the first export,
+        only pages whose Section or Code has been modified since the
+        previous one started are rendered again; imports touch
+        ``modified`` on every section whose page they change, and on
+        sections they retire, whose pages are removed.
+
+        """
+        started = time.time()
+        since = self._last_export(code)
+        if since is None:
+            print "Exporting %s" % code
+        else:
+            print "Exporting %s pages modified since %s" % (code, since)
+            retired = Section.objects.filter(
+                code=code, current_version=False, modified__gte=since)
+            # Changed sections also leave a non-current copy at their
+            # path, but they are exported again below.
+            for path in retired.values_list("path", flat=True).iterator():
+                remove_page(self.output, Section(code=code, path=path)
+                            .get_absolute_url())
+
+        tasks = [(self.output, getattr(top, Section._meta.tree_id_attr), since)
+                 for top in code.get_top_level_sections()]
+        jobs = self.opts.get("jobs") or 1
+        if jobs > 1:
+            # Don't let the workers inherit the open database connection.
+            connection.close()
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = list(pool.imap_unordered(export_tree, tasks))
+            except:
+                pool.terminate()
+                raise
+            pool.close()
+            pool.join()
+        else:
+            results = [export_tree(task) for task in tasks]
+        count = sum([pages for tree_id, pages in results])
+
+        if since is None or code.modified >= since:
+            export_page(PageRenderer(), self.output, code.get_absolute_url(), code.modified)
+            count += 1
+        print "Wrote %d pages in %.1fs" % (count, time.time() - started)
+
+        stamp_file = open(self._stamp_file(code), "w")
+        try:
+            stamp_file.write("%.6f" % started)
+        finally:
+            stamp_file.close()
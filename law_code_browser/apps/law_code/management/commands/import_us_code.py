@@ -1,154 +1,314 @@
-"""Load the entire US law code into the database.
+"""Load the entire US law code, or another code, into the database.
+
+The import runs in the stages of ``law_code.pipeline``, with the code's
+format (--format; the US Code by default) fetching and parsing its
+title files. The time, throughput and memory of each stage are printed
+at the end. After each title file is loaded, a checkpoint is saved, so
+if the run stops part way through, running it again carries on with
+the next title (unless --restart is given).
 """
 
 from optparse import make_option
-import re
+import multiprocessing
 import os
 import string
 import tempfile
 
-from django.core.management.base import BaseCommand, NoArgsCommand
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError, NoArgsCommand
+from django.db import connection
 from django.db.transaction import commit_on_success
 
+from law_code import (autocomplete, bulk, dbsnapshot, incremental, pipeline,
+                      references, search, snapshot)
+from law_code.cache import Invalidation
 from law_code.models import Section, Code
 
 
-us_section_rx = re.compile("""
-^\- HEAD \-# The header of each... well, header.
-.*\n # Get to the next line, when the content starts
-\W* # strip the leading whitespace
-([\w]+?) # The first group: part, section, title, etc
-(?:\-1)? # This is a special case for Title 42, Chapter 77, Subchaper
-         # III, Part A-1, which is inconsistently named, and should
-         # either be renamed B, or removed entirely.
-\.? # Sections are usually abbreviated "Sec." - so, ignore the period
-\W # Strop whitespace after the title
-([0-9]+[a-z]?) # Each section is ually a number with at most 1 suffix
-               # character, or a single character. This matches both.
-\.?# Section *numbers* usually have a trailing dot -  "2181."
-(?:\- )? # Larger sections (titles, etc) use SECTION X - THE TITLE
-\W+ # Force whitespace between section and title
-([\r\na-zA-Z,\(\) ]+) # The title of the section
-\\r\\n\\r\\n # Two newlines end the title
-""", re.VERBOSE|re.MULTILINE)
-
-section_mapping = {
-    "sec": Section.SECTION,
-    "chapter": Section.CHAPTER,
-    "title": Section.TITLE,
-    # Usually, eg, "secs 210 to 215: repealed". Exclude for now.
-    "secs": None,
-    "subchapter": Section.SUBCHAPTER,
-    "subpart": Section.SUBPART,
-    "part": Section.PART,
-    "division": Section.DIVISION,
-    }
-
 class Command(BaseCommand):
     help = 'Import a law code.'
     option_list = NoArgsCommand.option_list + (
+        make_option('--format', action='store', dest='format', default='us',
+                    help='The format of the code to import, from settings.LAW_CODE_FORMATS '
+                    '(default "us", the US Code).'),
+        make_option('--restart', action='store_true', dest='restart', default=False,
+                    help='Import every title, even if an earlier run that stopped part '
+                    'way through had already loaded some.'),
         make_option('--directory', action='store', dest='directory',
                     help='Use downloaded files (Title_01.txt, etc) in this directory; '
                     'see http://uscode.house.gov/download/ascii.shtml\n'
-                    'Otherwise, all the files are downloaded, which will take upwards of an hour.'),
+                    'Otherwise, they are downloaded (see --download-dir).'),
+        make_option('--download-dir', action='store', dest='download_dir',
+                    help='Where to keep downloaded title files between runs '
+                    '(default settings.LAW_CODE_DOWNLOAD_DIR). Files that are already '
+                    'up to date are not downloaded again, and partial downloads are resumed.'),
+        make_option('--download-url', action='store', dest='download_url',
+                    help='Download the title files from this URL instead of '
+                    'settings.LAW_CODE_DOWNLOAD_URL.'),
+        make_option('--download-jobs', action='store', type='int', dest='download_jobs',
+                    default=4, help='How many files to download at a time (default 4).'),
+        make_option('--bulk', action='store_true', dest='bulk', default=False,
+                    help='Build each title in memory, precompute the MPTT fields, and '
+                    'write it with batched INSERTs instead of one save per Section.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+                    default=500, help='Rows per INSERT batch with --bulk (default 500).'),
+        make_option('--verify-mptt', action='store_true', dest='verify_mptt', default=False,
+                    help='Save Sections one at a time, then check the stored MPTT fields '
+                    'against the ones --bulk would have computed.'),
+        make_option('--jobs', action='store', type='int', dest='jobs', default=1,
+                    help='Parse titles in this many worker processes, writing them '
+                    'from a single process with the bulk loader (implies --bulk).'),
+        make_option('--incremental', action='store_true', dest='incremental', default=False,
+                    help='Compare each title against the sections already imported, and '
+                    'only write the ones that were added, changed or removed.'),
     )
     args = "type(US)"
     def handle(self, **options):
         self.opts = options
-        self.load_us_code()
+        try:
+            self.format = pipeline.get_format(options.get("format") or "us")
+        except ImproperlyConfigured, e:
+            raise CommandError(str(e))
+        self.metrics = pipeline.StageMetrics()
+        self.load_code()
 
     @commit_on_success
-    def _load_us_code_title(self, title_file):
+    def _load_code_title(self, title_file):
         """
-        Load a single US code title file, run a regex over it, and
-        build Section objects out of it.
-
-        Determination of the Parent
-        ===========================
+        Load a single title file, parsing it as the file is read with
+        the stages of the code's format (see ``law_code.pipeline``),
+        and build Section objects out of it.
 
-        TODO: Rewrite
+        Without --bulk, each Section and its subsections, paragraphs
+        and so on are saved as soon as its block has been parsed, and
+        mptt maintains the tree as it goes; the builder then lets go of
+        them, so memory doesn't grow with the title. With --bulk or
+        --incremental, the tree is kept until the end of the file and
+        then written by ``_write_code_title``.
 
         """
         print "Starting %r" % title_file
-        section_match_groups = us_section_rx.findall(title_file.read())
+        if self.opts.get("bulk") or self.opts.get("incremental"):
+            builder = pipeline.parse_title(self.format, title_file, self.metrics)
+            print getattr(builder, "order", "")
+            self._write_code_title(builder.roots)
+            return
 
-        # See "Ordering Section Types"
-        order = determine_order(section_match_groups)
-        print order
+        builder = self.format.tree_builder()
+        release = getattr(builder, "release", None)
+        # --verify-mptt checks the whole tree's shape at the end.
+        keep_tree = bool(self.opts.get("verify_mptt"))
+        first_tree_id = bulk.next_tree_id()
+        for document in self.metrics.iterate("parse", self.format.documents(title_file)):
+            fields = self.metrics.call("normalize", 1, self.format.normalize, document)
+            if fields is None:
+                continue
+            section_node = self.metrics.call("tree-build", 1, builder.add, *fields)
+            if section_node is None:
+                continue
+            nodes = list(bulk.iter_tree([section_node]))
+            self.metrics.call("load", len(nodes), self._save_nodes, nodes)
+            if release is not None:
+                release(section_node, keep_tree)
+        print getattr(builder, "order", "")
 
-        parents = {}
-        for sectype in order:
-            parents[sectype] = None
+        if self.opts.get("verify_mptt"):
+            bulk.number_tree(builder.roots, first_tree_id)
+            mismatches = bulk.verify_tree(builder.roots)
+            for node, expected, stored in mismatches:
+                print "MPTT mismatch for %r: computed %r, stored %r" % (
+                    node, expected, stored)
+            if mismatches:
+                raise CommandError("%d sections have MPTT fields that differ "
+                                   "from the bulk loader's" % len(mismatches))
+            print "MPTT fields verified"
 
-        for groups in section_match_groups:
+    def _save_nodes(self, nodes):
+        "Save a section's nodes, parents first, one at a time."
+        for node in nodes:
+            parent = None
+            if node.parent is not None:
+                # Re-fetch, since saving a child changes the parent's rght.
+                parent = Section.objects.get(id=node.parent.id)
+            sec = Section.objects.create(
+                code=self.code, name=node.name, number=node.number,
+                type=node.type, parent=parent, content=node.content,
+                path=node.path)
+            node.id = sec.id
+        self._index_nodes(nodes)
 
-            sectype, number, name = groups
-            sectype = sectype.lower().strip()
+    def _write_code_title(self, roots):
+        "Write one title's tree of ``bulk.SectionNode`` objects."
+        count = 0
+        for node in bulk.iter_tree(roots):
+            count += 1
+        self.metrics.call("load", count, self._write_tree, roots)
 
-            # Clear out child types, so they aren't seen as potential parents.
-            child_types = order[order.index(sectype):]
-            for ct in child_types:
-                parents[ct] = None
-            parent = None
-            potential_parent_types = order[:order.index(sectype)]
-            for ppt in potential_parent_types:
-                if parents[ppt] is not None:
-                    parent = parents[ppt]
-
-            name = name.rstrip("\r")
-            assert sectype in section_mapping, sectype
-            type = section_mapping[sectype]
-            if type is None:
+    def _write_tree(self, roots):
+        """
+        With --incremental, write only the differences between
+        ``roots`` and what is already in the database (see
+        ``law_code.incremental``). Otherwise compute the MPTT fields in
+        one pass and write the rows in batches.
+
+        """
+        batch_size = self.opts.get("batch_size") or 500
+        if self.opts.get("incremental"):
+            counts = incremental.sync_tree(self.code, roots, batch_size,
+                                           search_index=self.search_index,
+                                           reference_index=self.reference_index)
+            print "Inserted %(inserted)d, changed %(changed)d, retired " \
+                "%(retired)d, unchanged %(unchanged)d sections" % counts
+            return
+        bulk.number_tree(roots, bulk.next_tree_id())
+        count = bulk.insert_tree(roots, self.code, batch_size=batch_size)
+        self._index_nodes(bulk.iter_tree(roots))
+        print "Wrote %d sections" % count
+
+    def _index_nodes(self, nodes):
+        """Add saved nodes to the search index, if there is one, and
+        extract their cross references.
+
+        """
+        nodes = list(nodes)
+        if self.search_index is not None:
+            self.search_index.add_nodes(self.code, nodes)
+        self.reference_index.add_nodes(self.code, nodes)
+
+    def _load_title(self, loader, *args):
+        """
+        Call ``loader``, one of the title loading methods, then commit
+        the search index changes it made once its own transaction has
+        committed, or roll them back if it failed.
+
+        A title loaded from scratch adds to the top of the code's tree,
+        so the code's cached page is invalidated; --incremental works
+        out which pages it changed itself.
+
+        """
+        try:
+            loader(*args)
+        except:
+            if self.search_index is not None:
+                self.search_index.rollback()
+            raise
+        if not self.opts.get("incremental"):
+            invalidation = Invalidation()
+            invalidation.tree_added()
+            invalidation.apply(self.code)
+        if self.search_index is not None:
+            self.search_index.commit()
+
+    @commit_on_success
+    def _resolve_references(self, tree):
+        "Point cross references at the sections they cite."
+        print "Resolved %d cross references" % self.reference_index.resolve(tree)
+
+    @commit_on_success
+    def _save_parsed_code_title(self, records):
+        "Write a title parsed by a --jobs worker."
+        self._write_code_title(bulk.unflatten_tree(records))
+
+    def _load_code_titles_parallel(self, paths, jobs):
+        """
+        Parse the title files in ``jobs`` worker processes.
+
+        The workers run the parse, normalize and tree-build stages;
+        they never touch the database. Each finished title comes back
+        as a flat list of records, with the workers' metrics, and is
+        written from this process, in title order, with the bulk loader
+        (or incrementally, with --incremental).
+
+        """
+        # Don't let the workers inherit the open database connection.
+        connection.close()
+        pool = multiprocessing.Pool(jobs)
+        work = ((self.format.name, path) for path in paths)
+        try:
+            for path, order, records, stats in pool.imap(pipeline.parse_title_file, work):
+                print "Parsed %s: %r" % (path, order)
+                self.metrics.merge(stats)
+                self._load_title(self._save_parsed_code_title, records)
+                self._title_loaded(path)
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+    def _fetch(self):
+        """
+        Fetch the title files with the code's format, yielding the path
+        of each in title order as soon as it's ready, and skipping those
+        the last run loaded before it stopped (see ``pipeline.Checkpoint``).
+
+        """
+        def log(message):
+            print message
+        paths = self.metrics.iterate("fetch", self.format.fetch(self.opts, log),
+                                     size=os.path.getsize)
+        for path in paths:
+            if self.checkpoint.is_done(path):
+                print "Skipping %s, loaded before the last run stopped" % path
                 continue
-            kwargs = {
-                "code": self.us_code,
-                "name": name,
-                "number": number,
-                "type": type,
-                "parent": parent,}
-            if False:
-                parents[sectype] = kwargs
+            # Counted here only, whether this process or a --jobs worker
+            # parses the file.
+            self.metrics.add_bytes("parse", os.path.getsize(path))
+            yield path
+
+    def _title_loaded(self, path):
+        "Record that a title file has been imported."
+        self.format.loaded(path)
+        self.checkpoint.mark_done(path)
+
+    def load_code(self):
+        jobs = self.opts.get("jobs") or 1
+        if self.opts.get("verify_mptt") and (
+                jobs > 1 or self.opts.get("bulk") or self.opts.get("incremental")):
+            raise CommandError("--verify-mptt saves Sections one at a time, and "
+                               "can't be used with --bulk, --jobs or --incremental")
+        self.code, created = Code.objects.get_or_create(
+            name=self.format.code_name, type=self.format.code_type)
+        self.search_index = search.get_index()
+        self.reference_index = references.ReferenceIndex()
+        self.checkpoint = pipeline.Checkpoint(
+            pipeline.checkpoint_path(self.format, self.code))
+        if self.opts.get("restart"):
+            self.checkpoint.clear()
+        elif len(self.checkpoint):
+            print "Resuming: %d title files were loaded before the last run stopped" % (
+                len(self.checkpoint))
+
+        try:
+            # With the downloader, each title is parsed as soon as it and
+            # the titles before it have been downloaded.
+            paths = self._fetch()
+            if jobs > 1:
+                self._load_code_titles_parallel(paths, jobs)
             else:
-                sec = Section.objects.create(**kwargs)
-                parents[sectype] = sec
-
-    def load_us_code(self):
-        self.us_code, created = Code.objects.get_or_create(
-            name="US Code", type=Code.COUNTRY)
-        if self.opts.get("directory", False):
-            base_dir = os.path.abspath(os.path.expanduser(self.opts["directory"]))
-            name_fmt = "Title_%s.txt"
-            for ii in range(1, 51):
-                if ii < 10:
-                    str_ii = "0%d" % ii
-                else:
-                    str_ii = str(ii)
-                name = name_fmt % str_ii
-                self._load_us_code_title(file(os.path.join(base_dir, name)))
-                # Stop after Title 1 for the time being.
-                assert False
-
-def determine_order(groups_list):
-    """
-    Ordering Section Types
-    ======================
-
-    The US code does not use consistent ordering. This is just one of
-    many beautiful features that makes it a write-only document. The
-    Title is the uppermost division, while the Section is always,
-    AFAIK, the smallest division. However, the divisions bewtween
-    Title and Section do not use consistent ordering:
-
-    http://en.wikipedia.org/wiki/United_States_Code#Organization
-
-    Since greater subtypes must always precede lower ones, I simply
-    loop through all the sections, and add each new section type if it
-    hasn't yet been added to the ordering list.
-
-    """
-    order = []
-    for groups in groups_list:
-        section = groups[0].lower().strip()
-        if section not in order:
-            order.append(section)
-    return order
+                for path in paths:
+                    title_file = open(path)
+                    try:
+                        self._load_title(self._load_code_title, title_file)
+                    finally:
+                        title_file.close()
+                    self._title_loaded(path)
+        except ImproperlyConfigured, e:
+            raise CommandError(str(e))
+        if self.search_index is not None:
+            self.search_index.optimize()
+        # References are resolved before the snapshot is written, with
+        # the sections they touch stamped with the time it was built,
+        # so snapshot_for still serves them from it. Running servers
+        # reload the snapshot and the autocomplete index when their
+        # files change.
+        tree = snapshot.build_snapshot(self.code)
+        self._resolve_references(tree)
+        snapshot.write_snapshot(self.code, tree)
+        autocomplete.write_index(tree)
+        if dbsnapshot.snapshot_link():
+            # Web workers switch to it on their next request.
+            print "Published %s" % dbsnapshot.publish()
+        self.checkpoint.clear()
+        for line in self.metrics.report():
+            print line
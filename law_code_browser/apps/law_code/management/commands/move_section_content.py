@@ -0,0 +1,58 @@
+"""Move Section content out of the Section table.
+
+Databases created before SectionText existed keep each section's text
+in a ``content`` column of law_code_section, which the models no longer
+use. This copies it into SectionText (compressing it, with
+LAW_CODE_COMPRESS_CONTENT) and then clears the old column, which can
+be dropped by hand afterwards.
+
+"""
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.db.transaction import commit_on_success
+
+from law_code.bulk import _insert_sql
+from law_code.models import Section, SectionText, encode_content
+
+
+class Command(NoArgsCommand):
+    help = 'Move Section content from the old law_code_section.content column into SectionText.'
+
+    @commit_on_success
+    def handle_noargs(self, **options):
+        qn = connection.ops.quote_name
+        table = Section._meta.db_table
+        cursor = connection.cursor()
+        columns = [row[0] for row in
+                   connection.introspection.get_table_description(cursor, table)]
+        if "content" not in columns:
+            print "%s has no content column; nothing to move" % table
+            return
+
+        cursor.execute("SELECT MAX(id) FROM %s" % qn(table))
+        max_id = cursor.fetchone()[0] or 0
+        text_fields = SectionText._meta.fields
+        text_sql = _insert_sql(SectionText._meta.db_table, text_fields)
+        moved = 0
+        for start in range(0, max_id + 1, 1000):
+            cursor.execute(
+                "SELECT id, content FROM %s WHERE id >= %%s AND id < %%s "
+                "AND content IS NOT NULL" % qn(table), [start, start + 1000])
+            rows = cursor.fetchall()
+            if not rows:
+                continue
+            existing = dict.fromkeys(SectionText.objects.filter(
+                pk__in=[row[0] for row in rows]).values_list("section", flat=True))
+            texts = []
+            for section_id, content in rows:
+                if section_id in existing:
+                    continue
+                encoding, data = encode_content(content)
+                values = {"section_id": section_id, "encoding": encoding, "data": data}
+                texts.append([f.get_db_prep_save(values[f.attname]) for f in text_fields])
+            if texts:
+                cursor.executemany(text_sql, texts)
+                moved += len(texts)
+        cursor.execute("UPDATE %s SET content = NULL" % qn(table))
+        print "Moved the content of %d sections" % moved
@@ -0,0 +1,47 @@
+import time
+
+from law_code import stats
+
+
+class RequestStatsMiddleware(object):
+    """
+    Measure every request and add it to ``stats.get_stats()``, under
+    the module and name of the view that handled it, as Django passes
+    it to ``process_view``.
+
+    Put this first in MIDDLEWARE_CLASSES, so that the time spent in the
+    other middleware is counted too.
+
+    """
+    def process_request(self, request):
+        request._stats_start = time.time()
+        stats.start_request()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._stats_view = "%s.%s" % (
+            getattr(view_func, "__module__", "?"),
+            getattr(view_func, "__name__", view_func.__class__.__name__))
+
+    def process_response(self, request, response):
+        timings = stats.finish_request()
+        start = getattr(request, "_stats_start", None)
+        if timings is None or start is None:
+            return response
+        name = getattr(request, "_stats_view", None) or "unresolved"
+        if response.has_header("Content-Length"):
+            size = int(response["Content-Length"])
+        elif getattr(response, "_is_string", True):
+            size = len(response.content)
+        else:
+            # A streamed response; reading it here would consume it.
+            size = None
+        values = {
+            "wall_ms": (time.time() - start) * 1000,
+            "queries": timings.queries,
+            "query_ms": timings.query_time * 1000,
+            "render_ms": timings.render_time * 1000,
+            }
+        if size is not None:
+            values["bytes"] = size
+        stats.get_stats().record(name, values)
+        return response
@@ -12,8 +12,14 @@ consistent. If so, it would be possible to somehow make each title
 aware of it's own organization, then just use a tree of objects.
 
 """
+import base64
+import datetime
+import zlib
+
+from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.utils.hashcompat import sha_constructor
 
 import mptt
 
@@ -49,6 +55,21 @@ class Code(models.Model):
 choices.CODE_TYPE_CHOICES.apply_to(Code)
 
 
+def section_content_hash(type, number, name, content):
+    """A hash of a Section's own text. It doesn't cover the Section's
+    children, so a change to one paragraph only changes that
+    paragraph's hash.
+
+    """
+    digest = sha_constructor()
+    for value in (type, number, name, content or ""):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        digest.update(value)
+        digest.update("\0")
+    return digest.hexdigest()
+
+
 class Section(models.Model):
     """A section of a Code.
 
@@ -69,15 +90,31 @@ class Section(models.Model):
     name = models.TextField()
     type = models.CharField(max_length=127, choices=choices.SECTION_TYPE_CHOICES)
     parent = models.ForeignKey('self', null=True)
-    content = models.TextField(null=True, blank=True)
+    # The section's text is kept in SectionText; see ``content`` below.
+
     # Can be a number, or a string: '101a'.
     number = models.CharField(max_length=127)
+    # The numbers of this section and its ancestors, from the top down,
+    # eg '42/21/I/1983'; the same as the URL after the code id. Unique
+    # among a code's current versions (see sql/section.sql), so a
+    # repeated number gets a suffix: '42/21/I/1983~2'.
+    path = models.CharField(max_length=255, db_index=True)
 
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
-    # Set to False when changing the content
+    # Set to False when changing the content. Versions that aren't
+    # current are taken out of the tree; see law_code.incremental.
     current_version = models.BooleanField(default=True)
+    # When this version took effect, and when it was replaced or
+    # retired (None while it is current); see law_code.versions. The
+    # versions of a section all have its path. Databases from before
+    # these and content_hash need backfill_section_versions.
+    valid_from = models.DateTimeField(default=datetime.datetime.now)
+    valid_to = models.DateTimeField(null=True, blank=True)
+    # See section_content_hash(); lets re-imports skip unchanged sections.
+    content_hash = models.CharField(max_length=40, null=True, blank=True,
+                                    editable=False)
 
     class Meta:
         db_table = "law_code_section"
@@ -89,12 +126,128 @@ class Section(models.Model):
         return "<law_code.Section(%s) %s>" % (
             self.get_type_display(), unicode(self))
 
+    def _get_content(self):
+        if not hasattr(self, "_content"):
+            if self.id is None:
+                return None
+            load_content([self])
+        return self._content
+
+    def _set_content(self, value):
+        self._content = value
+        self._content_changed = True
+
+    content = property(_get_content, _set_content, doc="""
+        The section's own text, or None. It is kept in SectionText, so
+        that queries for the tree don't load it; it's fetched the first
+        time it's used, or for a list of Sections in one go with
+        ``load_content``.""")
+
+    def save(self, *args, **kwargs):
+        self.content_hash = section_content_hash(
+            self.type, self.number, self.name, self.content)
+        if not self.path:
+            if self.parent is None:
+                self.path = self.number
+            else:
+                self.path = "%s/%s" % (self.parent.path, self.number)
+        super(Section, self).save(*args, **kwargs)
+        if getattr(self, "_content_changed", False):
+            store_content(self.id, self._content)
+            self._content_changed = False
+
     def get_absolute_url(self):
-        section_parts = [str(sec.number) for sec in self.get_ancestors()] + [str(self.number)]
-        section_url_fragment = '/'.join(section_parts)
-        return reverse("view-code-section",
-                       args=[self.code.id, section_url_fragment])
+        # The stored path is already the URL fragment, so this doesn't
+        # need to query the ancestors or the Code; templates can call
+        # it for every node of a subtree for free. (Databases imported
+        # before paths were stored need backfill_section_paths.)
+        return reverse("view-code-section", args=[self.code_id, self.path])
 
 mptt.register(Section)
 choices.SECTION_TYPE_CHOICES.apply_to(Section)
 
+
+# Content shorter than this isn't worth compressing.
+COMPRESS_MIN_LENGTH = 200
+
+def encode_content(text):
+    """
+    Return ``(encoding, data)`` to store ``text`` in a SectionText.
+
+    With ``settings.LAW_CODE_COMPRESS_CONTENT``, longer texts are
+    compressed with zlib (and base64 encoded, since the column is
+    text), as long as that makes them smaller.
+
+    """
+    if isinstance(text, unicode):
+        encoded = text.encode("utf-8")
+    else:
+        encoded = text
+    if getattr(settings, "LAW_CODE_COMPRESS_CONTENT", False) \
+            and len(encoded) >= COMPRESS_MIN_LENGTH:
+        data = base64.b64encode(zlib.compress(encoded, 6))
+        if len(data) < len(encoded):
+            return "zlib", data
+    return "", text
+
+
+def decode_content(encoding, data):
+    "Reverse ``encode_content``."
+    if encoding == "zlib":
+        return zlib.decompress(base64.b64decode(data)).decode("utf-8")
+    return data
+
+
+class SectionText(models.Model):
+    "The content of a Section; see ``Section.content``."
+    section = models.OneToOneField(Section, primary_key=True, related_name="text")
+    # "" for plain text, or "zlib"; see encode_content().
+    encoding = models.CharField(max_length=8, blank=True)
+    data = models.TextField()
+
+    class Meta:
+        db_table = "law_code_sectiontext"
+
+
+class SectionReference(models.Model):
+    """A reference in the text of one Section to another, eg "section
+    1983 of this title"; see ``law_code.references``.
+
+    """
+    source = models.ForeignKey(Section, related_name="references")
+    # Null until the cited section has been imported.
+    target = models.ForeignKey(Section, null=True, related_name="cited_by")
+    target_title = models.CharField(max_length=16)
+    target_number = models.CharField(max_length=127)
+
+    class Meta:
+        db_table = "law_code_sectionreference"
+
+
+def load_content(sections):
+    """Fetch the content of every Section in ``sections`` with one
+    query, so that using it doesn't take a query per Section. Returns
+    ``sections``.
+
+    """
+    by_id = dict([(section.id, section) for section in sections
+                  if not hasattr(section, "_content")])
+    ids = by_id.keys()
+    for section in by_id.values():
+        section._content = None
+    for start in range(0, len(ids), 500):
+        rows = SectionText.objects.filter(pk__in=ids[start:start + 500])\
+            .values_list("section", "encoding", "data")
+        for section_id, encoding, data in rows:
+            by_id[section_id]._content = decode_content(encoding, data)
+    return sections
+
+
+def store_content(section_id, text):
+    "Replace the stored content of Section ``section_id`` with ``text``."
+    if text is None:
+        SectionText.objects.filter(pk=section_id).delete()
+        return
+    encoding, data = encode_content(text)
+    SectionText(section_id=section_id, encoding=encoding, data=data).save()
+
@@ -0,0 +1,318 @@
+"""The stages of importing a code, and the formats codes come in.
+
+``import_us_code`` imports a code title by title, each going through
+the same stages:
+
+ * fetch: get the title's file, eg by downloading it.
+ * parse: read the file into documents, one per header.
+ * normalize: turn each document into ``(type, number, name, text)``.
+ * tree-build: hang each of those on its parent, as ``bulk.SectionNode``
+   trees.
+ * load: write the trees to the database.
+
+Everything that depends on how a particular code is published lives
+in a ``CodeFormat``: the first four stages are its methods, and the
+load stage is the same for every code. The US Code's format is
+``us_code.USCodeFormat``; others (state codes, say) are added by
+subclassing ``CodeFormat`` and listing the class in
+``settings.LAW_CODE_FORMATS``.
+
+``StageMetrics`` keeps the time, throughput and memory of each stage,
+and ``Checkpoint`` records the titles that have been loaded, so that a
+run that stops part way through can pick up where it left off.
+
+"""
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import simplejson
+
+from law_code.bulk import flatten_tree
+from law_code.download import file_sha1
+
+
+STAGES = ("fetch", "parse", "normalize", "tree-build", "load")
+
+DEFAULT_FORMATS = ("law_code.us_code.USCodeFormat",)
+
+# How often StageMetrics samples memory use, in items.
+RSS_SAMPLE_EVERY = 1000
+
+
+class CodeFormat(object):
+    """
+    How one code is published. Subclasses set ``name`` (what
+    ``import_us_code --format`` calls it), ``code_name`` and
+    ``code_type`` (the Code it is imported into), and implement the
+    stages.
+
+    """
+    name = None
+    code_name = None
+    code_type = None
+
+    def fetch(self, options, log):
+        """
+        Yield the path of each title file to import, in the order to
+        import them, as soon as it's available. ``options`` are the
+        importer's; ``log`` is called with messages for the user.
+
+        """
+        raise NotImplementedError
+
+    def documents(self, title_file):
+        "Yield the documents of an open title file, one per header."
+        raise NotImplementedError
+
+    def normalize(self, document):
+        """
+        ``(type, number, name, text)`` for a document, where ``type``
+        is whatever the format's tree builder orders sections by, and
+        ``text`` is the section's text, or None; or None to skip the
+        document.
+
+        """
+        raise NotImplementedError
+
+    def tree_builder(self):
+        """
+        A new object for building one title's tree: its ``add(type,
+        number, name, text)`` takes normalized documents in order,
+        returning the ``bulk.SectionNode`` made, or None if the
+        document isn't imported, and its ``roots`` are the finished
+        trees. It may also have ``release(node, keep_tree)``, which the
+        importer calls once it has saved ``node`` and its descendants,
+        to let go of them; see ``us_code.SectionTreeBuilder.release``.
+
+        """
+        raise NotImplementedError
+
+    def loaded(self, path):
+        "Called once the title file at ``path`` has been imported."
+
+
+_formats = None
+
+def _load_formats():
+    global _formats
+    if _formats is None:
+        formats = {}
+        for path in getattr(settings, "LAW_CODE_FORMATS", DEFAULT_FORMATS):
+            module, attr = path.rsplit(".", 1)
+            try:
+                format_class = getattr(__import__(module, {}, {}, [attr]), attr)
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured("Can't load code format %s: %s" % (path, e))
+            formats[format_class.name] = format_class
+        _formats = formats
+    return _formats
+
+
+def format_names():
+    "The names of the formats in ``LAW_CODE_FORMATS``."
+    return sorted(_load_formats().keys())
+
+
+def get_format(name):
+    "A new instance of the format called ``name``."
+    try:
+        return _load_formats()[name]()
+    except KeyError:
+        raise ImproperlyConfigured("No code format %r; the formats are %s" % (
+            name, ", ".join(format_names())))
+
+
+def peak_rss():
+    "The process's peak resident memory so far, in KB, or None."
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageMetrics(object):
+    """
+    The time spent in each stage, the number of items (files,
+    documents, sections) and bytes it handled, and the process's peak
+    memory when it was last at work.
+
+    Stages overlap: each document is normalized and added to the tree
+    as soon as it has been parsed. So stages are timed a step at a
+    time, with ``iterate`` timing only the work of the iterator it
+    wraps, and ``call`` that of one call.
+
+    """
+    def __init__(self):
+        self.stats = dict([(stage, {"seconds": 0.0, "items": 0, "bytes": 0,
+                                    "peak_rss_kb": None})
+                           for stage in STAGES])
+
+    def _record(self, stage, seconds, items=1, bytes=0):
+        stats = self.stats[stage]
+        stats["seconds"] += seconds
+        stats["items"] += items
+        stats["bytes"] += bytes
+        # Reading the memory use isn't free; once in a while is enough.
+        if items != 1 or stats["items"] % RSS_SAMPLE_EVERY == 0:
+            rss = peak_rss()
+            if rss is not None:
+                stats["peak_rss_kb"] = max(stats["peak_rss_kb"], rss)
+
+    def iterate(self, stage, iterable, size=None):
+        """
+        Yield from ``iterable``, counting the time it takes to produce
+        each item against ``stage``; ``size`` gives each item's bytes.
+
+        """
+        iterator = iter(iterable)
+        while True:
+            start = _clock()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                self._record(stage, _clock() - start, items=0)
+                return
+            self._record(stage, _clock() - start,
+                         bytes=size is not None and size(item) or 0)
+            yield item
+
+    def call(self, stage, items, func, *args):
+        """Call ``func(*args)``, counting it against ``stage`` as
+        ``items`` items, and return the result.
+
+        """
+        start = _clock()
+        result = func(*args)
+        self._record(stage, _clock() - start, items=items)
+        return result
+
+    def add_bytes(self, stage, bytes):
+        self.stats[stage]["bytes"] += bytes
+
+    def merge(self, stats):
+        "Add in the ``stats`` of another StageMetrics, eg a worker's."
+        for stage, other in stats.items():
+            mine = self.stats[stage]
+            for key in ("seconds", "items", "bytes"):
+                mine[key] += other[key]
+            mine["peak_rss_kb"] = max(mine["peak_rss_kb"], other["peak_rss_kb"])
+
+    def report(self):
+        "A line per stage, for the importer to print."
+        lines = []
+        for stage in STAGES:
+            stats = self.stats[stage]
+            seconds = stats["seconds"]
+            line = "%-10s %8.2fs %9d items" % (stage, seconds, stats["items"])
+            if seconds:
+                line += " %10.0f/s" % (stats["items"] / seconds)
+                if stats["bytes"]:
+                    line += " %7.2f MB/s" % (stats["bytes"] / (1024.0 * 1024.0) / seconds)
+            if stats["peak_rss_kb"] is not None:
+                line += ", peak RSS %d MB" % (stats["peak_rss_kb"] / 1024)
+            lines.append(line)
+        return lines
+
+
+# Wall time: fetching is mostly waiting, and loading is partly the
+# database's time.
+_clock = time.time
+
+
+class Checkpoint(object):
+    """
+    The title files of a run that have been loaded, in a JSON file, so
+    that if the run stops part way through, the next one skips them.
+    Each file is recorded with its checksum, so a file that has
+    changed since is imported again. The file is removed when the run
+    finishes.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.units = {}
+        if os.path.exists(path):
+            checkpoint_file = open(path)
+            try:
+                try:
+                    self.units = simplejson.load(checkpoint_file)["units"]
+                except (ValueError, KeyError):
+                    self.units = {}
+            finally:
+                checkpoint_file.close()
+
+    def __len__(self):
+        return len(self.units)
+
+    def _key(self, path):
+        return os.path.basename(path)
+
+    def is_done(self, path):
+        "Whether the title file at ``path`` has already been loaded."
+        sha1 = self.units.get(self._key(path))
+        return sha1 is not None and sha1 == file_sha1(path)
+
+    def mark_done(self, path):
+        self.units[self._key(path)] = file_sha1(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = self.path + ".tmp"
+        checkpoint_file = open(temp_path, "w")
+        try:
+            simplejson.dump({"units": self.units}, checkpoint_file)
+        finally:
+            checkpoint_file.close()
+        os.rename(temp_path, self.path)
+
+    def clear(self):
+        self.units = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def checkpoint_path(format, code):
+    "Where the checkpoint for importing ``format`` into ``code`` is kept."
+    directory = getattr(settings, "LAW_CODE_CHECKPOINT_DIR", None) or "."
+    return os.path.join(directory, "%s-%d.json" % (format.name, code.id))
+
+
+def parse_title(format, title_file, metrics):
+    """
+    Run the parse, normalize and tree-build stages over an open title
+    file, returning the tree builder.
+
+    """
+    builder = format.tree_builder()
+    for document in metrics.iterate("parse", format.documents(title_file)):
+        fields = metrics.call("normalize", 1, format.normalize, document)
+        if fields is not None:
+            metrics.call("tree-build", 1, builder.add, *fields)
+    return builder
+
+
+def parse_title_file(args):
+    """
+    Parse the title file at ``path`` in the format called
+    ``format_name``. This is the unit of work for the import_us_code
+    --jobs worker processes, so it takes and returns picklable data:
+    ``(path, order, records, stats)``, with records from
+    ``bulk.flatten_tree`` and the stages' ``StageMetrics.stats``.
+
+    """
+    format_name, path = args
+    format = get_format(format_name)
+    # The importer counts the file's bytes when it hands it out.
+    metrics = StageMetrics()
+    title_file = open(path)
+    try:
+        builder = parse_title(format, title_file, metrics)
+    finally:
+        title_file.close()
+    return path, getattr(builder, "order", None), flatten_tree(builder.roots), metrics.stats
@@ -0,0 +1,43 @@
+"""A read-only SQLite database backend for serving a published snapshot.
+
+Set ``DATABASE_ENGINE = "law_code.readonly_sqlite"`` and
+``DATABASE_NAME`` to ``LAW_CODE_DB_SNAPSHOT`` (see
+``law_code.dbsnapshot``). Each connection opens the snapshot the link
+points at when it is made, and refuses to write to it. Since nothing
+writes to a snapshot, reads are memory mapped
+(``LAW_CODE_DB_MMAP_SIZE`` bytes) and get a large page cache
+(``LAW_CODE_DB_CACHE_SIZE`` kilobytes).
+
+"""
+import os
+
+from django.db.backends.sqlite3.base import *
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+
+
+DEFAULT_MMAP_SIZE = 1024 * 1024 * 1024
+DEFAULT_CACHE_SIZE = 64 * 1024
+
+
+class _SnapshotSettings(object):
+    "``settings``, with DATABASE_NAME resolved to the current snapshot."
+    def __init__(self, settings):
+        self._settings = settings
+        self.DATABASE_NAME = os.path.realpath(settings.DATABASE_NAME)
+
+    def __getattr__(self, name):
+        return getattr(self._settings, name)
+
+
+class DatabaseWrapper(SQLiteDatabaseWrapper):
+    def _cursor(self, settings):
+        if self.connection is not None:
+            return super(DatabaseWrapper, self)._cursor(settings)
+        cursor = super(DatabaseWrapper, self)._cursor(_SnapshotSettings(settings))
+        cursor.execute("PRAGMA query_only = ON")
+        cursor.execute("PRAGMA mmap_size = %d" % getattr(
+            settings, "LAW_CODE_DB_MMAP_SIZE", DEFAULT_MMAP_SIZE))
+        cursor.execute("PRAGMA cache_size = -%d" % getattr(
+            settings, "LAW_CODE_DB_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+        cursor.execute("PRAGMA temp_store = MEMORY")
+        return cursor
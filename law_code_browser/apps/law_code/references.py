@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Cross references between sections of the US Code.
+
+Statute text constantly refers to other sections: "section 1983 of
+this title", "sections 1981 and 1982 of title 42", "42 U.S.C. 2000e".
+``ReferenceIndex`` pulls these out of sections as ``import_us_code``
+writes them and stores them as ``SectionReference`` rows, so that a
+section page can list what it refers to and what refers to it with an
+indexed lookup.
+
+References are made by a section as a whole: the text of its
+subsections, paragraphs and so on counts as the section's. The cited
+title and section number are stored with each reference, and the
+cited Section is filled in by ``resolve``, once every title has been
+written; a reference to a section that doesn't exist yet stays
+unresolved until an import adds it.
+
+Both lists are part of a section page's cached body, so ``resolve``
+touches ``modified`` on every section whose lists it changed. It sets
+it to the time the snapshot it resolves against was built, so that the
+importer can resolve before writing that snapshot, and the touched
+sections still count as unchanged since (see ``snapshot.snapshot_for``).
+
+"""
+import datetime
+import re
+
+from django.db import connection
+
+from law_code import citations
+from law_code.models import Section, SectionReference
+from law_code.us_code import ENUMERATION_TYPES
+
+
+# "... of this title" or "... of title 42", after a list of sections.
+OF_TITLE_RX = re.compile(r"\bof\s+(?:this\s+title\b|title\s+(\d+[a-z]?)\b)", re.IGNORECASE)
+# "42 U.S.C. 2000e", "42 U.S.C. § 1983"
+USC_RX = re.compile(ur"\b(\d+[a-z]?)\s+U\.\s*S\.\s*C\.\s*(?:\u00a7+\s*)?([0-9][0-9A-Za-z\-]*)",
+                    re.UNICODE)
+SECTION_NUMBER_RX = re.compile(r"[0-9][0-9A-Za-z\-]*")
+SUBDIVISION_RX = re.compile(r"\([0-9A-Za-z]+\)")
+# What may come between "section(s)" and "of this title", other than
+# section numbers and their subdivisions.
+LIST_WORDS = frozenset(["and", "or", "through", "to", ","])
+# How far back from "of this title" to look for "section".
+LOOKBEHIND = 200
+
+
+def extract_references(text, title):
+    """
+    The ``(title, section number)`` of every section ``text`` refers
+    to, in order, without repeats. ``title`` is the title the text is
+    in, for "of this title".
+
+    """
+    found = []
+    seen = {}
+
+    def add(cited_title, number):
+        number = number.rstrip("-")
+        key = (cited_title, number)
+        if number and key not in seen:
+            seen[key] = True
+            found.append(key)
+
+    for match in OF_TITLE_RX.finditer(text):
+        before = text[max(match.start() - LOOKBEHIND, 0):match.start()]
+        lowered = before.lower()
+        start = lowered.rfind("section")
+        if start == -1:
+            continue
+        listed = before[start + len("section"):]
+        if listed[:1] == "s":
+            listed = listed[1:]
+        listed = SUBDIVISION_RX.sub(" ", listed).replace(",", " , ")
+        numbers = []
+        for word in listed.split():
+            if SECTION_NUMBER_RX.match(word) and SECTION_NUMBER_RX.match(word).end() == len(word):
+                numbers.append(word)
+            elif word.lower() not in LIST_WORDS:
+                # Not a list of sections, eg "section of this title".
+                numbers = []
+                break
+        cited_title = match.group(1) or title
+        for number in numbers:
+            add(cited_title, number)
+
+    for match in USC_RX.finditer(text):
+        add(match.group(1), match.group(2))
+    return found
+
+
+def _source(node):
+    "The node whose references ``node``'s text counts as."
+    while node.type in ENUMERATION_TYPES and node.parent is not None:
+        node = node.parent
+    return node
+
+
+def _source_text(source):
+    "The text of ``source``, and of the subdivisions under it."
+    texts = []
+    stack = [source]
+    while stack:
+        node = stack.pop()
+        if node.content:
+            texts.append(node.content)
+        for child in reversed(node.children):
+            if child.type in ENUMERATION_TYPES:
+                stack.append(child)
+    return " ".join(texts)
+
+
+class ReferenceIndex(object):
+    """
+    Keeps the SectionReference rows up to date as sections are
+    written, with the same ``add_nodes`` and ``remove`` methods as
+    ``search.SearchIndex``; call ``resolve`` at the end of the import.
+    Everything is written in the importer's transaction.
+
+    """
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        qn = connection.ops.quote_name
+        self.table = qn(SectionReference._meta.db_table)
+        self.section_table = qn(Section._meta.db_table)
+        # Sections whose references or "cited by" lists have changed.
+        self.touched = {}
+
+    def add_nodes(self, code, nodes):
+        """Extract the references of the saved ``bulk.SectionNode``
+        objects in ``nodes``, replacing any their sections had.
+
+        """
+        sources = {}
+        for node in nodes:
+            source = _source(node)
+            sources[source.id] = source
+        cursor = connection.cursor()
+        ids = sources.keys()
+        for start in range(0, len(ids), self.batch_size):
+            self._delete(cursor, ids[start:start + self.batch_size])
+        rows = []
+        for source in sources.values():
+            title = source.path.split("/", 1)[0]
+            for cited_title, number in extract_references(_source_text(source), title):
+                rows.append((source.id, cited_title, number))
+            if len(rows) >= self.batch_size:
+                self._insert(cursor, rows)
+                rows = []
+        if rows:
+            self._insert(cursor, rows)
+
+    def remove(self, section_ids):
+        "Drop the references made by ``section_ids``."
+        cursor = connection.cursor()
+        section_ids = list(section_ids)
+        for start in range(0, len(section_ids), self.batch_size):
+            self._delete(cursor, section_ids[start:start + self.batch_size])
+
+    def _delete(self, cursor, source_ids):
+        if source_ids:
+            cursor.execute("SELECT DISTINCT target_id FROM %s WHERE source_id IN (%s)" % (
+                self.table, ", ".join(["%s"] * len(source_ids))), source_ids)
+            for (target_id,) in cursor.fetchall():
+                if target_id is not None:
+                    self.touched[target_id] = True
+            cursor.execute("DELETE FROM %s WHERE source_id IN (%s)" % (
+                self.table, ", ".join(["%s"] * len(source_ids))), source_ids)
+
+    def _insert(self, cursor, rows):
+        cursor.executemany(
+            "INSERT INTO %s (source_id, target_title, target_number) "
+            "VALUES (%%s, %%s, %%s)" % self.table, rows)
+
+    def resolve(self, tree):
+        """
+        Point the references made in a code at the current Sections
+        they cite, using the TreeSnapshot ``tree`` of the code (see
+        ``citations.citation_index``). References to sections that are
+        no longer current are unresolved first, so that they find the
+        section's replacement, if there is one. The sections whose
+        lists change get ``tree.built`` as their ``modified``.
+
+        Returns the number of references resolved.
+
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT DISTINCT source_id FROM %s WHERE target_id IN "
+            "(SELECT id FROM %s WHERE current_version = %%s)" % (
+                self.table, self.section_table), [False])
+        for (source_id,) in cursor.fetchall():
+            self.touched[source_id] = True
+        cursor.execute(
+            "UPDATE %s SET target_id = NULL WHERE target_id IN "
+            "(SELECT id FROM %s WHERE current_version = %%s)" % (
+                self.table, self.section_table), [False])
+        cursor.execute(
+            "SELECT id, source_id, target_title, target_number FROM %s WHERE target_id IS NULL "
+            "AND source_id IN (SELECT id FROM %s WHERE code_id = %%s)" % (
+                self.table, self.section_table), [tree.code_id])
+        index, repeated = citations.citation_index(tree)
+        updates = []
+        for id, source_id, title, number in cursor.fetchall():
+            position = index.get((title.lower(), number.lower()))
+            if position is not None:
+                updates.append((tree.ids[position], id))
+                self.touched[source_id] = True
+                self.touched[tree.ids[position]] = True
+        for start in range(0, len(updates), self.batch_size):
+            cursor.executemany("UPDATE %s SET target_id = %%s WHERE id = %%s" % self.table,
+                               updates[start:start + self.batch_size])
+
+        touched = self.touched.keys()
+        now = tree.built or datetime.datetime.now()
+        for start in range(0, len(touched), self.batch_size):
+            Section.objects.filter(id__in=touched[start:start + self.batch_size])\
+                .update(modified=now)
+        self.touched = {}
+        return len(updates)
@@ -0,0 +1,146 @@
+"""Full-text search over Section names and content.
+
+The index is an SQLite FTS5 table in its own file, set by
+``settings.LAW_CODE_SEARCH_INDEX``, so it doesn't depend on the main
+database engine. It holds one row per current Section, keyed by the
+Section's id, and is kept up to date by ``import_us_code``: the bulk
+loader indexes each title as it writes it, and incremental imports
+replace the rows of changed sections and drop retired ones.
+
+Results are ranked with bm25, weighting matches in a section's name
+above matches in its content.
+
+"""
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.html import escape
+
+
+# Put around matched terms by SQLite, then turned into HTML once the
+# rest of the snippet has been escaped.
+MATCH_START = u"\x02"
+MATCH_END = u"\x03"
+
+# bm25 column weights for (name, content).
+NAME_WEIGHT = 10.0
+CONTENT_WEIGHT = 1.0
+
+
+def _unicode(value):
+    if value is None or isinstance(value, unicode):
+        return value
+    return value.decode("utf-8", "replace")
+
+
+def fts_query(text):
+    """Turn what a user typed into an FTS5 query matching every word,
+    quoting each one so that punctuation can't be read as query
+    syntax.
+
+    """
+    words = []
+    for word in _unicode(text).split():
+        word = word.replace(u'"', u'')
+        if word:
+            words.append(u'"%s"' % word)
+    return u" ".join(words)
+
+
+def highlight(snippet):
+    "Escape a snippet from the index, and mark its matches with <b>."
+    return escape(snippet).replace(MATCH_START, u"<b>").replace(MATCH_END, u"</b>")
+
+
+class SearchIndex(object):
+    "An FTS5 index of Sections in the SQLite file at ``path``."
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        try:
+            self.connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS sections USING fts5("
+                "name, content, code_id UNINDEXED, path UNINDEXED, "
+                "tokenize = 'porter unicode61')")
+        except sqlite3.OperationalError, e:
+            raise ImproperlyConfigured(
+                "Section search needs SQLite built with FTS5: %s" % e)
+
+    def add_nodes(self, code, nodes):
+        """Index the saved ``bulk.SectionNode`` objects in ``nodes``,
+        replacing any rows they already have.
+
+        """
+        rows = [(node.id, _unicode(node.name), _unicode(node.content),
+                 code.id, _unicode(node.path)) for node in nodes]
+        self.connection.executemany(
+            "DELETE FROM sections WHERE rowid = ?", [(row[0],) for row in rows])
+        self.connection.executemany(
+            "INSERT INTO sections (rowid, name, content, code_id, path) "
+            "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def remove(self, section_ids):
+        "Drop the rows for ``section_ids``."
+        self.connection.executemany(
+            "DELETE FROM sections WHERE rowid = ?",
+            [(section_id,) for section_id in section_ids])
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def optimize(self):
+        "Merge the index's b-trees; worth doing after a large import."
+        self.connection.execute(
+            "INSERT INTO sections (sections) VALUES ('optimize')")
+        self.connection.commit()
+
+    def search(self, text, code_id=None, limit=20, offset=0):
+        """Return ``(section_id, score, name, snippet)`` for the best
+        matches for ``text``, best first. ``name`` and ``snippet`` are
+        HTML, with the matching terms in bold.
+
+        """
+        query = fts_query(text)
+        if not query:
+            return []
+        sql = ("SELECT rowid, bm25(sections, %s, %s), "
+               "highlight(sections, 0, ?, ?), "
+               "snippet(sections, 1, ?, ?, ?, 24) "
+               "FROM sections WHERE sections MATCH ?" % (
+                   NAME_WEIGHT, CONTENT_WEIGHT))
+        params = [MATCH_START, MATCH_END, MATCH_START, MATCH_END, u"\u2026", query]
+        if code_id is not None:
+            sql += " AND code_id = ?"
+            params.append(code_id)
+        sql += " ORDER BY 2 LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+        return [(section_id, score, highlight(name), highlight(snippet))
+                for section_id, score, name, snippet
+                in self.connection.execute(sql, params)]
+
+
+_local = threading.local()
+
+def get_index():
+    """The ``SearchIndex`` for ``settings.LAW_CODE_SEARCH_INDEX``, opened
+    once per thread, or None if search isn't configured.
+
+    """
+    path = getattr(settings, "LAW_CODE_SEARCH_INDEX", None)
+    if not path:
+        return None
+    index = getattr(_local, "index", None)
+    if index is None or index.path != path:
+        index = _local.index = SearchIndex(path)
+    return index
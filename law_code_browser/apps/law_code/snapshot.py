@@ -0,0 +1,321 @@
+"""Read-only snapshots of a Code's section tree, for navigation without
+queries.
+
+Everything needed to navigate a Code (ids, numbers, names, types and
+the shape of the tree) is small next to the statute text, so
+``import_us_code`` writes it for each Code it imports to a file in
+``settings.LAW_CODE_SNAPSHOT_DIR``. Each process loads a snapshot the
+first time it is asked for, and loads it again when the importer
+replaces the file, so breadcrumbs, children and URLs come from memory.
+
+A snapshot holds the Code's current sections in tree order, as
+parallel arrays indexed by position:
+
+ * ``ids``, ``levels``
+ * ``parents``: the parent's position, or -1 for a top level section
+ * ``ends``: the position just past the section's subtree, so its
+   descendants are ``range(position + 1, ends[position])``
+ * ``numbers``, ``names``, ``types``, ``paths``
+
+Anything that needs a section's content still goes to the database.
+
+A snapshot records when it was built. Imports touch the ``modified``
+of every section whose children or breadcrumbs they change (see
+``law_code.cache``), so ``snapshot_for`` only hands out a snapshot for
+sections that haven't changed since, and the views use the database
+for the rest until the importer writes the next one. Resolving cross
+references, the one thing the importer changes after building the
+snapshot, stamps the sections it touches with the snapshot's own
+``built`` (see ``references.ReferenceIndex.resolve``).
+
+"""
+from array import array
+import datetime
+import marshal
+import os
+import threading
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+
+from law_code.models import Section
+
+
+FORMAT_VERSION = 2
+
+
+class SnapshotSection(object):
+    """A section in a ``TreeSnapshot``, with enough of Section's
+    interface for templates: its name, ``number``, ``type``, ``level``,
+    ``path`` and ``get_absolute_url``.
+
+    """
+    __slots__ = ("snapshot", "position")
+
+    def __init__(self, snapshot, position):
+        self.snapshot = snapshot
+        self.position = position
+
+    id = property(lambda self: self.snapshot.ids[self.position])
+    number = property(lambda self: self.snapshot.numbers[self.position])
+    name = property(lambda self: self.snapshot.names[self.position])
+    type = property(lambda self: self.snapshot.types[self.position])
+    level = property(lambda self: self.snapshot.levels[self.position])
+    path = property(lambda self: self.snapshot.paths[self.position])
+
+    def __unicode__(self):
+        return self.name
+
+    def __repr__(self):
+        return "<law_code.SnapshotSection %s>" % self.path
+
+    def is_leaf_node(self):
+        return self.snapshot.ends[self.position] == self.position + 1
+
+    def get_absolute_url(self):
+        return reverse("view-code-section",
+                       args=[self.snapshot.code_id, self.path])
+
+
+class TreeSnapshot(object):
+    "The current sections of one Code; see the module docstring."
+
+    def __init__(self, code_id, public, ids, parents, ends, levels,
+                 numbers, names, types, paths, built=None):
+        self.code_id = code_id
+        # When the sections were read, or None if unknown.
+        self.built = built
+        self.public = public
+        self.ids = ids
+        self.parents = parents
+        self.ends = ends
+        self.levels = levels
+        self.numbers = numbers
+        self.names = names
+        self.types = types
+        self.paths = paths
+        self.by_path = dict([(path, position) for position, path in enumerate(paths)])
+        self.by_id = dict([(id, position) for position, id in enumerate(ids)])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, section_id=None, path=None):
+        "The SnapshotSection with ``section_id`` or ``path``, or None."
+        if path is not None:
+            position = self.by_path.get(path)
+        else:
+            position = self.by_id.get(section_id)
+        if position is None:
+            return None
+        return SnapshotSection(self, position)
+
+    def ancestors(self, section):
+        "``section``'s ancestors, from the top down."
+        positions = []
+        position = self.parents[section.position]
+        while position != -1:
+            positions.append(position)
+            position = self.parents[position]
+        positions.reverse()
+        return [SnapshotSection(self, position) for position in positions]
+
+    def children(self, section):
+        "``section``'s children, in order."
+        children = []
+        position = section.position + 1
+        end = self.ends[section.position]
+        while position < end:
+            children.append(SnapshotSection(self, position))
+            position = self.ends[position]
+        return children
+
+    def descendants(self, section):
+        return [SnapshotSection(self, position) for position
+                in range(section.position + 1, self.ends[section.position])]
+
+    def dumps(self):
+        return marshal.dumps((
+            FORMAT_VERSION, self.code_id, self.public,
+            self.ids.tostring(), self.parents.tostring(),
+            self.ends.tostring(), self.levels.tostring(),
+            self.numbers, self.names, self.types, self.paths,
+            self.built and self.built.timetuple()[:6] + (self.built.microsecond,)))
+
+    def loads(cls, data):
+        fields = marshal.loads(data)
+        if fields[0] != FORMAT_VERSION:
+            raise ValueError("Unknown snapshot format %r" % (fields[0],))
+        arrays = []
+        for packed in fields[3:7]:
+            values = array("i")
+            values.fromstring(packed)
+            arrays.append(values)
+        built = fields[11] and datetime.datetime(*fields[11]) or None
+        return cls(*([fields[1], fields[2]] + arrays + list(fields[7:11]) + [built]))
+    loads = classmethod(loads)
+
+
+def build_snapshot(code):
+    "A TreeSnapshot of ``code``'s current sections, in one query."
+    opts = Section._meta
+    built = datetime.datetime.now()
+    rows = code.sections.filter(current_version=True)\
+        .order_by(opts.tree_id_attr, opts.left_attr)\
+        .values_list("id", "parent", opts.level_attr,
+                     "number", "name", "type", "path")
+    ids, parents, ends, levels = array("i"), array("i"), array("i"), array("i")
+    numbers, names, types, paths = [], [], [], []
+    by_id = {}
+    # (position, id) of the sections whose subtrees are still open.
+    open_sections = []
+    for position, (id, parent_id, level, number, name, type, path) \
+            in enumerate(rows.iterator()):
+        while open_sections and open_sections[-1][1] != parent_id:
+            ends[open_sections.pop()[0]] = position
+        by_id[id] = position
+        ids.append(id)
+        parents.append(by_id.get(parent_id, -1))
+        ends.append(position + 1)
+        levels.append(level)
+        numbers.append(number)
+        names.append(name)
+        types.append(type)
+        paths.append(path)
+        open_sections.append((position, id))
+    while open_sections:
+        ends[open_sections.pop()[0]] = len(ids)
+    return TreeSnapshot(code.id, code.public, ids, parents, ends, levels,
+                        numbers, names, types, paths, built)
+
+
+def snapshot_path(code_id):
+    "The snapshot file for ``code_id``, or None if snapshots are off."
+    directory = getattr(settings, "LAW_CODE_SNAPSHOT_DIR", None)
+    if not directory:
+        return None
+    return os.path.join(directory, "code_%d.snapshot" % code_id)
+
+
+def write_snapshot(code, snapshot=None):
+    """Replace the snapshot file of ``code``, which the processes
+    serving it will pick up, with ``snapshot``, or with a new one if
+    it's None. Returns the snapshot.
+
+    """
+    path = snapshot_path(code.id)
+    if snapshot is None:
+        snapshot = build_snapshot(code)
+    if path is not None:
+        write_file(path, snapshot.dumps())
+    return snapshot
+
+
+def write_file(path, data):
+    "Replace the file at ``path`` with ``data`` in one rename."
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    out = open(tmp_path, "wb")
+    try:
+        out.write(data)
+    finally:
+        out.close()
+    os.rename(tmp_path, path)
+
+
+_lock = threading.Lock()
+# code_id: (mtime, snapshot)
+_snapshots = {}
+
+
+def get_snapshot(code_id):
+    """The snapshot of ``code_id``, loaded from its file on first use
+    and again whenever the file changes, or None if there is no file.
+
+    """
+    return load_cached(_snapshots, code_id, snapshot_path(code_id),
+                       TreeSnapshot.loads)
+
+
+def load_cached(loaded_files, key, path, loads):
+    """
+    ``loads`` of the contents of the file at ``path``, kept in the
+    dict ``loaded_files`` under ``key`` and loaded again whenever the
+    file changes, or None if ``path`` is None, there is no file, or it
+    was written in an older format (``loads`` raises ValueError).
+
+    """
+    if path is None:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    loaded = loaded_files.get(key)
+    if loaded is not None and loaded[0] == mtime:
+        return loaded[1]
+    _lock.acquire()
+    try:
+        loaded = loaded_files.get(key)
+        if loaded is None or loaded[0] != mtime:
+            loaded_file = open(path, "rb")
+            try:
+                try:
+                    loaded = (mtime, loads(loaded_file.read()))
+                except ValueError:
+                    # Until the importer writes it again.
+                    loaded = (mtime, None)
+            finally:
+                loaded_file.close()
+            loaded_files[key] = loaded
+    finally:
+        _lock.release()
+    return loaded[1]
+
+
+# code_id: (latest modified of its sections, snapshot) for codes
+# without a snapshot file.
+_built = {}
+
+
+def code_snapshot(code):
+    """
+    The snapshot of ``code``: from its file if there is one, and
+    otherwise built from the database and kept in memory, to be built
+    again once any of the code's sections has changed. Imports touch
+    ``modified`` on the parents of everything they add, change or
+    retire, so the latest ``modified`` (one lookup on the index in
+    sql/section.sql) tells whether the tree may have changed.
+
+    """
+    tree = get_snapshot(code.id)
+    if tree is not None:
+        return tree
+    latest = list(code.sections.order_by("-modified")
+                  .values_list("modified", flat=True)[:1])
+    version = latest and latest[0] or None
+    built = _built.get(code.id)
+    if built is None or built[0] != version:
+        _lock.acquire()
+        try:
+            built = _built.get(code.id)
+            if built is None or built[0] != version:
+                built = (version, build_snapshot(code))
+                _built[code.id] = built
+        finally:
+            _lock.release()
+    return built[1]
+
+
+def snapshot_for(section):
+    """
+    The SnapshotSection for the Section ``section`` in its Code's
+    snapshot, or None if there is no snapshot, the section isn't in it,
+    or it has changed since the snapshot was built.
+
+    """
+    tree = get_snapshot(section.code_id)
+    if tree is None or tree.built is None or section.modified > tree.built:
+        return None
+    return tree.get(section_id=section.id)
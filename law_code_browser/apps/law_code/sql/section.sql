@@ -0,0 +1,10 @@
+-- Each of a Code's current Sections has its own path; see Section.path.
+CREATE UNIQUE INDEX law_code_section_current_path ON law_code_section (code_id, path) WHERE current_version;
+-- Finds the version of a path in force at a given time; see law_code.versions.
+CREATE INDEX law_code_section_path_validity ON law_code_section (code_id, path, valid_from, valid_to);
+-- Keyset pagination of a tree in lft order; see law_code.stream.
+CREATE INDEX law_code_section_tree_lft ON law_code_section (tree_id, lft);
+-- A code's top level sections, and a section's children, by number.
+CREATE INDEX law_code_section_code_parent_number ON law_code_section (code_id, parent_id, number);
+-- The latest change to a code's sections; see snapshot.code_snapshot.
+CREATE INDEX law_code_section_code_modified ON law_code_section (code_id, modified);
@@ -0,0 +1,253 @@
+"""Request timing statistics.
+
+``middleware.RequestStatsMiddleware`` measures each request's wall
+time, database query count and time, template render time and
+response size, and adds them to rolling histograms for the view that
+handled it (eg ``law_code.views.view_section``). Only the last
+``settings.LAW_CODE_STATS_WINDOW`` seconds are kept.
+
+While a request is being measured, its thread's database connection
+hands out cursors wrapped in a ``TimedCursor``, much as DEBUG wraps
+them in a ``CursorDebugWrapper``; Django's connection is thread-local,
+so other threads' requests aren't affected. Rendering is timed by the
+law_code views themselves, which render through functions wrapped
+with ``timed_render``, so other apps' pages show no render time.
+Nothing depends on DEBUG, so the statistics can be
+left on in production; each request costs a few clock reads and dict
+updates.
+
+Each process keeps its own statistics, so ``dump()`` includes the
+process id.
+
+"""
+import bisect
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+
+# Bucket upper bounds; each histogram also has an overflow bucket.
+MS_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+COUNT_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BOUNDS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+METRICS = (
+    ("wall_ms", MS_BOUNDS),
+    ("queries", COUNT_BOUNDS),
+    ("query_ms", MS_BOUNDS),
+    ("render_ms", MS_BOUNDS),
+    ("bytes", BYTES_BOUNDS),
+    )
+
+
+class RollingHistogram(object):
+    """
+    Counts of values in the buckets given by ``bounds``, over the last
+    ``window`` seconds. The window is split into ``slices``, and the
+    oldest slice is dropped as a new one starts.
+
+    """
+    def __init__(self, bounds, window=3600, slices=12):
+        self.bounds = bounds
+        self.slice_seconds = max(window / slices, 1)
+        self.slices = slices
+        # slice number: ([count per bucket], sum of values)
+        self.counts = {}
+
+    def _current(self, now):
+        current = int(now // self.slice_seconds)
+        if current not in self.counts:
+            for old in self.counts.keys():
+                if old <= current - self.slices:
+                    del self.counts[old]
+            self.counts[current] = ([0] * (len(self.bounds) + 1), [0.0])
+        return current
+
+    def add(self, value, now=None):
+        counts, total = self.counts[self._current(now or time.time())]
+        counts[bisect.bisect_left(self.bounds, value)] += 1
+        total[0] += value
+
+    def summary(self, now=None):
+        """
+        A dict of the count and mean of the values in the window, the
+        buckets they fall in, and the 50th, 95th and 99th percentiles,
+        to the upper bound of their buckets (None for the overflow
+        bucket).
+
+        """
+        self._current(now or time.time())
+        buckets = [0] * (len(self.bounds) + 1)
+        total = 0.0
+        for counts, slice_total in self.counts.values():
+            for ii, count in enumerate(counts):
+                buckets[ii] += count
+            total += slice_total[0]
+        count = sum(buckets)
+        summary = {
+            "count": count,
+            "mean": count and total / count or 0.0,
+            "buckets": [[bound, hits] for bound, hits
+                        in zip(list(self.bounds) + [None], buckets)],
+            }
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            summary[name] = None
+            seen = 0
+            for bound, hits in summary["buckets"]:
+                seen += hits
+                if count and seen >= count * fraction:
+                    summary[name] = bound
+                    break
+        return summary
+
+
+class RequestStats(object):
+    "Rolling histograms of ``METRICS`` for each URL pattern name."
+
+    def __init__(self, window):
+        self.window = window
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def record(self, name, values):
+        "Add ``values``, a dict of metric: value, for the URL ``name``."
+        now = time.time()
+        self.lock.acquire()
+        try:
+            histograms = self.histograms.get(name)
+            if histograms is None:
+                histograms = self.histograms[name] = dict([
+                    (metric, RollingHistogram(bounds, self.window))
+                    for metric, bounds in METRICS])
+            for metric, value in values.items():
+                histograms[metric].add(value, now)
+        finally:
+            self.lock.release()
+
+    def dump(self):
+        "Everything, as a dict that can be serialized as JSON."
+        now = time.time()
+        self.lock.acquire()
+        try:
+            urls = dict([(name, dict([(metric, histogram.summary(now))
+                                      for metric, histogram in histograms.items()]))
+                         for name, histograms in self.histograms.items()])
+        finally:
+            self.lock.release()
+        return {
+            "pid": os.getpid(),
+            "window_seconds": self.window,
+            "uptime_seconds": now - self.started,
+            "metrics": [metric for metric, bounds in METRICS],
+            "urls": urls,
+            }
+
+
+_stats = None
+
+def get_stats():
+    "This process's RequestStats."
+    global _stats
+    if _stats is None:
+        _stats = RequestStats(getattr(settings, "LAW_CODE_STATS_WINDOW", 3600))
+    return _stats
+
+
+class Timings(object):
+    "What one request has spent on queries and rendering so far."
+    __slots__ = ("queries", "query_time", "render_time", "render_depth")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.render_time = 0.0
+        self.render_depth = 0
+
+
+_local = threading.local()
+
+def start_request():
+    """Start measuring a request in this thread, returning its
+    Timings.
+
+    """
+    timings = _local.timings = Timings()
+    connection_class = connection.__class__
+    def cursor(*args, **kwargs):
+        return TimedCursor(connection_class.cursor(connection, *args, **kwargs), timings)
+    # Set on the connection itself, which is thread-local, and taken
+    # off again by finish_request.
+    connection.cursor = cursor
+    return timings
+
+def finish_request():
+    """Stop measuring this thread's request, returning its Timings, or
+    None if it wasn't being measured.
+
+    """
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    connection.__dict__.pop("cursor", None)
+    return timings
+
+def _current():
+    return getattr(_local, "timings", None)
+
+
+class TimedCursor(object):
+    "Wraps a database cursor to add its queries to ``timings``."
+
+    def __init__(self, cursor, timings):
+        self.cursor = cursor
+        self.timings = timings
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.timings.queries += 1
+            self.timings.query_time += time.time() - start
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.timings.queries += 1
+            self.timings.query_time += time.time() - start
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def timed_render(render):
+    """
+    Wrap ``render``, a function that renders a template, eg
+    ``render_to_string``, so that the time it takes is added to the
+    render time of the request being measured, if there is one.
+
+    """
+    def timed(*args, **kwargs):
+        timings = _current()
+        if timings is None:
+            return render(*args, **kwargs)
+        # A render inside another one is already being timed.
+        timings.render_depth += 1
+        start = time.time()
+        try:
+            return render(*args, **kwargs)
+        finally:
+            timings.render_depth -= 1
+            if not timings.render_depth:
+                timings.render_time += time.time() - start
+    timed.__name__ = render.__name__
+    timed.__doc__ = render.__doc__
+    return timed
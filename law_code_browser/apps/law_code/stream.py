@@ -0,0 +1,116 @@
+"""Streaming a code, or a subtree of it, as data.
+
+``iter_records`` walks the current Sections under a root in tree (lft)
+order a batch at a time. Each batch is a keyset query, picking up after
+the last lft of the one before, rather than an OFFSET, so every batch
+costs the same however deep into a title it is, and only one batch (and
+its content, fetched in one more query) is in memory at once. That
+keeps exporting a title of 100,000 sections in constant memory, with a
+response that starts straight away.
+
+The batches are separate queries, not one transaction, so an import
+running at the same time (``import_us_code --incremental``) can move
+lft and rght between them. Each batch re-reads the root's bounds, so
+the walk stays within the subtree as it is now and stops if the root
+is removed, and it makes up for sections inserted or removed before
+the root. A change inside the subtree while the walk is under way can
+still make a section come out twice or not at all. For an export that
+is consistent to the section, serve it from the read-only database
+copy (``law_code.dbsnapshot``) or while no import is running.
+
+The views in ``law_code.views`` send the records as NDJSON, one JSON
+object per line, or as a JSON array.
+
+"""
+from django.utils import simplejson
+
+from law_code.models import Section, SectionText, decode_content
+
+
+# Along with the tree fields.
+RECORD_FIELDS = ("id", "parent", "path", "number", "type", "name")
+
+
+def iter_records(root, batch_size=1000):
+    """
+    A dict for ``root`` (a Section) and each current Section under it,
+    in tree order, with its id, parent id, path, number, type, name,
+    level and content.
+
+    Each batch first re-reads the root's tree_id, lft and rght, and
+    the walk ends if the root is gone or no longer current; see the
+    module docstring for what that does and doesn't guard against.
+
+    """
+    opts = Section._meta
+    tree_id_attr, left_attr, right_attr, level_attr = (
+        opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr)
+    fields = RECORD_FIELDS + (level_attr, left_attr, right_attr)
+    bounds = Section.objects.filter(id=root.id, current_version=True).values_list(
+        tree_id_attr, left_attr, right_attr)
+    lft = getattr(root, left_attr)
+    last_lft = lft - 1
+    while True:
+        current = list(bounds.all())
+        if not current:
+            return
+        tree_id, new_lft, rght = current[0]
+        # Sections added or removed before the root shift the whole
+        # subtree, and so the last lft written, by the same amount.
+        last_lft += new_lft - lft
+        lft = new_lft
+        rows = list(Section.objects.filter(current_version=True, **{
+            tree_id_attr: tree_id,
+            "%s__gt" % left_attr: last_lft,
+            "%s__lt" % left_attr: rght,
+            }).order_by(left_attr).values(*fields)[:batch_size])
+        if not rows:
+            return
+        texts = dict([(section_id, decode_content(encoding, data))
+                      for section_id, encoding, data in SectionText.objects.filter(
+                          pk__in=[row["id"] for row in rows])
+                      .values_list("section", "encoding", "data")])
+        for row in rows:
+            yield {
+                "id": row["id"],
+                "parent": row["parent"],
+                "path": row["path"],
+                "number": row["number"],
+                "type": row["type"],
+                "name": row["name"],
+                "level": row[level_attr],
+                "has_children": row[right_attr] - row[left_attr] > 1,
+                "content": texts.get(row["id"]),
+                }
+        if len(rows) < batch_size:
+            return
+        last_lft = rows[-1][left_attr]
+
+
+def iter_code_records(code, batch_size=1000):
+    """``iter_records`` for every top level section of ``code`` in turn,
+    in the order they were imported (by tree id), so that title 2 comes
+    before title 10.
+
+    """
+    for root in code.get_top_level_sections().order_by(Section._meta.tree_id_attr):
+        for record in iter_records(root, batch_size):
+            yield record
+
+
+def ndjson(records):
+    "The lines of NDJSON for ``records``."
+    for record in records:
+        yield simplejson.dumps(record) + "\n"
+
+
+def json_array(records):
+    "A JSON array of ``records``, a record at a time."
+    separator = "[\n"
+    for record in records:
+        yield separator + simplejson.dumps(record)
+        separator = ",\n"
+    if separator == "[\n":
+        yield "[]\n"
+    else:
+        yield "\n]\n"
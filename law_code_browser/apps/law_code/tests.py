@@ -0,0 +1,888 @@
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.utils import simplejson
+from django.utils.http import http_date
+
+from law_code import (autocomplete, bulk, cache, citations, download, incremental,
+                      search, snapshot, stats, us_code)
+from law_code.models import Code, Section, SectionReference
+
+
+def build_tree(code, chapters, sections):
+    """
+    A title in ``code`` with ``chapters`` chapters, and ``sections``
+    sections spread over them; returns the title.
+
+    """
+    title = Section.objects.create(code=code, type=Section.TITLE, number="1",
+                                   name="Title 1", content="Title text")
+    chapter_ids = []
+    for number in range(1, chapters + 1):
+        # Re-fetch parents, since saving a child changes their rght.
+        chapter_ids.append(Section.objects.create(
+            code=code, type=Section.CHAPTER, number=str(number),
+            parent=Section.objects.get(id=title.id),
+            name="Chapter %d" % number).id)
+    for number in range(1, sections + 1):
+        Section.objects.create(
+            code=code, type=Section.SECTION, number=str(number),
+            parent=Section.objects.get(id=chapter_ids[number % chapters]),
+            name="Section %d" % number, content="Text of section %d" % number)
+    return Section.objects.get(id=title.id)
+
+
+def title_text(sections):
+    """
+    The text of a US Code title file for title 1, with one chapter
+    holding ``sections``, a list of ``(number, name, statute)``.
+
+    """
+    blocks = ["-CITE-\n    1 USC TITLE 1\n\n-HEAD-\n    TITLE 1 - GENERAL PROVISIONS\n\n-End-\n",
+              "-CITE-\n    1 USC CHAPTER 1\n\n-HEAD-\n    CHAPTER 1 - RULES\n\n-End-\n"]
+    for number, name, statute in sections:
+        blocks.append("-CITE-\n    1 USC Sec. %s\n\n-HEAD-\n    Sec. %s. %s\n\n"
+                      "-STATUTE-\n      %s\n\n-End-\n" % (number, number, name, statute))
+    return "\n".join(blocks)
+
+
+# Sections 1 and 2 cite each other; section 3 cites nothing.
+TITLE_SECTIONS = [
+    ("1", "Words", "As used in section 2 of this title, words mean what they say."),
+    ("2", "Definitions", "(a) In general\n        See section 1 of this title.\n"
+     "        (b) Other terms\n        Have their ordinary meaning."),
+    ("3", "Severability", "If any part is held invalid, the rest stands."),
+    ]
+
+
+class TreeBuilderReleaseTest(unittest.TestCase):
+    def test_release(self):
+        # Released as each section is saved, the builder only keeps
+        # the title and chapter open, without any text.
+        builder = us_code.SectionTreeBuilder()
+        built = []
+        for fields in us_code.iter_us_code_sections(StringIO.StringIO(title_text(TITLE_SECTIONS))):
+            node = builder.add(*fields)
+            built.append([descendant.path for descendant in bulk.iter_tree([node])])
+            builder.release(node)
+        self.assertEqual(built, [["1"], ["1/1"], ["1/1/1"], ["1/1/2", "1/1/2/a", "1/1/2/b"],
+                                 ["1/1/3"]])
+        self.assertEqual(builder.roots, [])
+        chapter = builder.parents["chapter"]
+        self.assertEqual(chapter.children, [])
+        self.assertEqual(chapter.parent.path, "1")
+
+    def test_release_keep_tree(self):
+        builder = us_code.SectionTreeBuilder()
+        for fields in us_code.iter_us_code_sections(StringIO.StringIO(title_text(TITLE_SECTIONS))):
+            builder.release(builder.add(*fields), keep_tree=True)
+        nodes = list(bulk.iter_tree(builder.roots))
+        self.assertEqual(len(nodes), 7)
+        self.assertEqual([node.content for node in nodes], [None] * 7)
+
+
+class ImportTestCase(TestCase):
+    """
+    Runs import_us_code on title files written to a temporary
+    directory, with snapshots and checkpoints kept there too.
+
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_settings = {}
+        for name, value in (("LAW_CODE_SNAPSHOT_DIR", os.path.join(self.directory, "snapshots")),
+                            ("LAW_CODE_CHECKPOINT_DIR", self.directory),
+                            ("LAW_CODE_SEARCH_INDEX", None),
+                            ("LAW_CODE_DB_SNAPSHOT", None)):
+            self.old_settings[name] = getattr(settings, name, None)
+            setattr(settings, name, value)
+        snapshot._snapshots.clear()
+        snapshot._built.clear()
+        cache._page_cache = None
+
+    def tearDown(self):
+        for name, value in self.old_settings.items():
+            setattr(settings, name, value)
+        snapshot._snapshots.clear()
+        snapshot._built.clear()
+        cache._page_cache = None
+        shutil.rmtree(self.directory)
+
+    def import_title(self, sections, **options):
+        "Import title 1 with ``sections`` (see ``title_text``); returns the Code."
+        title_file = open(os.path.join(self.directory, download.title_filename(1)), "wb")
+        try:
+            title_file.write(title_text(sections))
+        finally:
+            title_file.close()
+        call_command("import_us_code", directory=self.directory, **options)
+        return Code.objects.get(name="US Code", type=Code.COUNTRY)
+
+
+class ImportSnapshotTest(ImportTestCase):
+    def test_snapshot_serves_referenced_sections(self):
+        # Resolving references touches the sections at both ends, but
+        # the snapshot written afterwards still counts them as fresh.
+        code = self.import_title(TITLE_SECTIONS)
+        reference = SectionReference.objects.get(source__path="1/1/1")
+        self.assertEqual(reference.target.path, "1/1/2")
+        sections = code.sections.filter(current_version=True)
+        self.assertEqual(sections.count(), 7)
+        for section in sections:
+            node = snapshot.snapshot_for(section)
+            self.failIfEqual(node, None)
+            self.assertEqual(node.path, section.path)
+
+
+class BulkImportTest(ImportTestCase):
+    def test_database_assigns_ids(self):
+        code = self.import_title(TITLE_SECTIONS, bulk=True)
+        sections = list(code.sections.all())
+        self.assertEqual(len(sections), 7)
+        for section in sections:
+            if section.parent_id is None:
+                self.assertEqual(section.path, "1")
+            else:
+                self.assertEqual(section.path.rsplit("/", 1)[0], section.parent.path)
+        self.assertEqual(code.sections.get(path="1/1/2/a").content,
+                         "In general See section 1 of this title.")
+        # The id sequence has moved past the bulk loaded rows.
+        added = Section.objects.create(
+            code=code, type=Section.SECTION, number="4", name="Added",
+            parent=code.sections.get(path="1/1"))
+        self.failIf(added.id in [section.id for section in sections])
+
+
+class IncrementalImportTest(ImportTestCase):
+    """
+    Re-importing a title with --incremental, with one section changed,
+    one added and one removed, and a subsection removed.
+
+    """
+    def setUp(self):
+        super(IncrementalImportTest, self).setUp()
+        self.code = self.import_title(TITLE_SECTIONS, incremental=True)
+        self.before = dict(self.code.sections.values_list("path", "id"))
+        changed = [
+            ("1", "Words", "As used in section 2 of this title, words mean what they mean."),
+            ("2", "Definitions", "(a) In general\n        See section 1 of this title."),
+            ("4", "Effective date", "This title takes effect at once."),
+            ]
+        self.import_title(changed, incremental=True)
+
+    def current(self, path):
+        return self.code.sections.get(path=path, current_version=True)
+
+    def assertTreeMatchesPaths(self):
+        "The current rows form one tree whose shape matches their paths."
+        opts = Section._meta
+        current = list(self.code.sections.filter(current_version=True))
+        paths = [section.path for section in current]
+        self.assertEqual(len(set([getattr(section, opts.tree_id_attr)
+                                  for section in current])), 1)
+        for section in current:
+            descendants = len([path for path in paths
+                               if path.startswith(section.path + "/")])
+            self.assertEqual(section.get_descendant_count(), descendants)
+            self.assertEqual(section.is_leaf_node(), descendants == 0)
+
+    def test_changed(self):
+        section = self.current("1/1/1")
+        self.assertEqual(section.id, self.before["1/1/1"])
+        self.assertEqual(section.content,
+                         "As used in section 2 of this title, words mean what they mean.")
+        old = self.code.sections.get(path="1/1/1", current_version=False)
+        self.assertEqual(old.content,
+                         "As used in section 2 of this title, words mean what they say.")
+        self.failIfEqual(old.valid_to, None)
+        self.assertEqual(old.parent_id, None)
+        self.assertEqual(getattr(old, Section._meta.tree_id_attr), incremental.DETACHED_TREE_ID)
+
+    def test_added(self):
+        section = self.current("1/1/4")
+        self.assertEqual(section.parent_id, self.before["1/1"])
+        self.failUnless(section.is_leaf_node())
+        chapter = self.current("1/1")
+        self.assertEqual(sorted([child.path for child in chapter.get_children()]),
+                         ["1/1/1", "1/1/2", "1/1/4"])
+        self.assertTreeMatchesPaths()
+
+    def test_removed(self):
+        for path in ("1/1/3", "1/1/2/b"):
+            section = self.code.sections.get(id=self.before[path])
+            self.failIf(section.current_version)
+            self.failIfEqual(section.valid_to, None)
+            self.assertEqual(getattr(section, Section._meta.tree_id_attr),
+                             incremental.DETACHED_TREE_ID)
+        self.assertEqual(self.current("1/1/2").get_descendant_count(), 1)
+        self.assertTreeMatchesPaths()
+        # Old versions don't show up as children to expand, in the
+        # database or the snapshot.
+        for snapshot_dir in (None, settings.LAW_CODE_SNAPSHOT_DIR):
+            settings.LAW_CODE_SNAPSHOT_DIR = snapshot_dir
+            response = self.client.get(reverse("section-children", args=[self.before["1/1"]]))
+            children = simplejson.loads(response.content)["children"]
+            self.assertEqual([child["number"] for child in children], ["1", "2", "4"])
+            self.assertEqual([child["has_children"] for child in children],
+                             [False, True, False])
+
+    def test_tree_ids(self):
+        # Old versions don't use up tree ids.
+        opts = Section._meta
+        tree_ids = set(self.code.sections.values_list(opts.tree_id_attr, flat=True))
+        self.assertEqual(tree_ids, set([incremental.DETACHED_TREE_ID,
+                                        getattr(self.current("1"), opts.tree_id_attr)]))
+        self.assertEqual(bulk.next_tree_id(), getattr(self.current("1"), opts.tree_id_attr) + 1)
+
+
+class SearchTest(ImportTestCase):
+    "The search index import_us_code keeps, in a file of its own."
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        settings.LAW_CODE_SEARCH_INDEX = os.path.join(self.directory, "search.db")
+
+    def tearDown(self):
+        index = getattr(search._local, "index", None)
+        if index is not None:
+            index.connection.close()
+            search._local.index = None
+        super(SearchTest, self).tearDown()
+
+    def found(self, text, **kwargs):
+        return [result[0] for result in search.get_index().search(text, **kwargs)]
+
+    def test_ranks_names_first(self):
+        code = self.import_title([
+            ("1", "Definitions", "Severability is governed by section 2 of this title."),
+            ("2", "Severability", "If any part is held invalid, the rest stands."),
+            ])
+        first, second = search.get_index().search("severability")
+        self.assertEqual(first[0], code.sections.get(path="1/1/2").id)
+        self.assertEqual(first[2], u"<b>Severability</b>")
+        self.assertEqual(second[0], code.sections.get(path="1/1/1").id)
+        self.failUnless(u"<b>Severability</b> is governed" in second[3])
+        self.assertEqual(self.found("severability", code_id=code.id + 1), [])
+
+    def test_query_syntax(self):
+        # Quotes and operators are searched for as words.
+        self.import_title(TITLE_SECTIONS)
+        self.assertEqual(search.fts_query(u'held "invalid" OR (a'),
+                         u'"held" "invalid" "OR" "(a"')
+        self.assertEqual(self.found(u'"held" invalid'), self.found("held invalid"))
+        self.assertEqual(len(self.found("held invalid")), 1)
+        self.assertEqual(self.found('"'), [])
+
+    def test_incremental_import(self):
+        self.import_title(TITLE_SECTIONS, incremental=True)
+        code = self.import_title([
+            ("1", "Words", "As used in section 2 of this title, words mean what they mean."),
+            ("2", "Definitions", "(a) In general\n        See section 1 of this title."),
+            ("4", "Effective date", "This title takes effect at once."),
+            ], incremental=True)
+        self.assertEqual(self.found("mean"), [code.sections.get(
+            path="1/1/1", current_version=True).id])
+        self.assertEqual(self.found("say"), [])
+        self.assertEqual(self.found("ordinary"), [])
+        self.assertEqual(self.found("invalid"), [])
+        self.assertEqual(self.found("effect"), [code.sections.get(path="1/1/4").id])
+
+
+class AutocompleteTest(ImportTestCase):
+    "The prefix index import_us_code writes, and the view serving it."
+
+    def setUp(self):
+        super(AutocompleteTest, self).setUp()
+        autocomplete._indexes.clear()
+        self.code = self.import_title(TITLE_SECTIONS)
+        self.url = reverse("law-code-autocomplete", args=[self.code.id])
+
+    def tearDown(self):
+        autocomplete._indexes.clear()
+        super(AutocompleteTest, self).tearDown()
+
+    def paths(self, query, **params):
+        params["q"] = query
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return [result["path"] for result in simplejson.loads(response.content)["results"]]
+
+    def test_lookup(self):
+        index = autocomplete.get_index(self.code.id)
+        self.failIfEqual(index, None)
+        self.assertEqual(index.code_id, self.code.id)
+        for query, paths in (("1 usc 2", ["1/1/2"]),
+                             (u"1 U.S.C. \u00a7 3", ["1/1/3"]),
+                             ("tit 1 sec 3", ["1/1/3"]),
+                             ("Title 1 ch 1", ["1/1", "1/1/1", "1/1/2", "1/1/3"]),
+                             ("defin", ["1/1/2"]),
+                             ("3", ["1/1/3"]),
+                             # Subsections and stop words aren't indexed.
+                             ("other terms", []),
+                             ("of", []),
+                             ("", [])):
+            self.assertEqual([result["path"] for result in index.lookup(query)], paths)
+        suggestion = index.lookup("1 usc 2")[0]
+        self.assertEqual(suggestion["id"], self.code.sections.get(path="1/1/2").id)
+        self.assertEqual(suggestion["label"], "Title 1, Chapter 1, Section 2")
+        self.assertEqual(suggestion["name"], "Definitions")
+        self.assertEqual(len(index.lookup("title 1", limit=2)), 2)
+
+    def test_view(self):
+        response = self.client.get(self.url, {"q": "sever"})
+        results = simplejson.loads(response.content)["results"]
+        self.assertEqual([result["url"] for result in results],
+                         [reverse("view-code-section", args=[self.code.id, "1/1/3"])])
+        self.assertEqual(len(self.paths("title 1", limit=2)), 2)
+        response = self.client.get(self.url, {"q": "title 1", "limit": "many"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_without_index_file(self):
+        # Built from the code's snapshot instead.
+        settings.LAW_CODE_SNAPSHOT_DIR = None
+        self.assertEqual(autocomplete.get_index(self.code.id), None)
+        self.assertEqual(self.paths("1 usc 2"), ["1/1/2"])
+
+    def test_not_public(self):
+        # The index file doesn't know the code has been hidden since.
+        Code.objects.filter(id=self.code.id).update(public=False)
+        self.failUnless(autocomplete.get_index(self.code.id).public)
+        for snapshot_dir in (settings.LAW_CODE_SNAPSHOT_DIR, None):
+            settings.LAW_CODE_SNAPSHOT_DIR = snapshot_dir
+            response = self.client.get(self.url, {"q": "1 usc 2"})
+            self.assertEqual(response.status_code, 404)
+
+
+class ExportLawCodeTest(ImportTestCase):
+    def read(self, path, compressed=False):
+        if compressed:
+            page_file = gzip.open(path)
+        else:
+            page_file = open(path, "rb")
+        try:
+            return page_file.read()
+        finally:
+            page_file.close()
+
+    def test_export_pages(self):
+        # The exported pages are the ones the site serves.
+        code = self.import_title(TITLE_SECTIONS)
+        output = os.path.join(self.directory, "export")
+        call_command("export_law_code", output=output)
+        urls = [code.get_absolute_url()] + [
+            section.get_absolute_url()
+            for section in code.sections.filter(current_version=True)]
+        self.assertEqual(len(urls), 8)
+        for url in urls:
+            path = os.path.join(output, *(url.strip("/").split("/") + ["index.html"]))
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.read(path), response.content)
+            self.assertEqual(self.read(path + ".gz", compressed=True), response.content)
+
+
+class RenderQueryCountTest(TestCase):
+    """
+    Rendering a code or a section runs the same number of queries
+    however many sections are on the page; in particular,
+    Section.get_absolute_url runs none.
+
+    """
+    def setUp(self):
+        self.old_debug = settings.DEBUG
+        self.old_snapshot_dir = getattr(settings, "LAW_CODE_SNAPSHOT_DIR", None)
+        settings.DEBUG = True
+        # Render from the database, not snapshots left by an import.
+        settings.LAW_CODE_SNAPSHOT_DIR = None
+        cache._page_cache = None
+        self.small = Code.objects.create(name="Small", type=Code.COUNTRY)
+        self.small_title = build_tree(self.small, 1, 1)
+        self.large = Code.objects.create(name="Large", type=Code.COUNTRY)
+        self.large_title = build_tree(self.large, 2, 27)
+
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+        settings.LAW_CODE_SNAPSHOT_DIR = self.old_snapshot_dir
+        cache._page_cache = None
+
+    def queries(self, url):
+        "The number of queries a GET of ``url`` runs."
+        connection.queries = []
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(connection.queries)
+
+    def test_tree_sizes(self):
+        self.assertEqual(self.small.sections.count(), 3)
+        self.assertEqual(self.large.sections.count(), 30)
+
+    def test_get_absolute_url(self):
+        section = Section.objects.get(code=self.large, path="1/1/4")
+        connection.queries = []
+        self.assertEqual(section.get_absolute_url(),
+                         reverse("view-code-section", args=[self.large.id, "1/1/4"]))
+        self.assertEqual(len(connection.queries), 0)
+
+    def test_view_code(self):
+        self.assertEqual(
+            self.queries(reverse("view-law-code", args=[self.small.id])),
+            self.queries(reverse("view-law-code", args=[self.large.id])))
+
+    def test_view_section(self):
+        small = self.queries(self.small_title.get_absolute_url())
+        large = self.queries(self.large_title.get_absolute_url())
+        self.assertEqual(small, large)
+
+
+class ConditionalGetTest(TestCase):
+    "The ETag and Last-Modified validators of the code and section pages."
+
+    def setUp(self):
+        self.old_snapshot_dir = getattr(settings, "LAW_CODE_SNAPSHOT_DIR", None)
+        settings.LAW_CODE_SNAPSHOT_DIR = None
+        cache._page_cache = None
+        self.code = Code.objects.create(name="Validated", type=Code.COUNTRY)
+        self.title = build_tree(self.code, 1, 2)
+
+    def tearDown(self):
+        settings.LAW_CODE_SNAPSHOT_DIR = self.old_snapshot_dir
+        cache._page_cache = None
+
+    def assertConditional(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+        for headers, status in (({"HTTP_IF_NONE_MATCH": etag}, 304),
+                                ({"HTTP_IF_NONE_MATCH": '"other", %s' % etag}, 304),
+                                ({"HTTP_IF_NONE_MATCH": "*"}, 304),
+                                ({"HTTP_IF_NONE_MATCH": '"other"'}, 200),
+                                # The ETag is checked instead of the date.
+                                ({"HTTP_IF_NONE_MATCH": '"other"',
+                                  "HTTP_IF_MODIFIED_SINCE": last_modified}, 200),
+                                ({"HTTP_IF_MODIFIED_SINCE": last_modified}, 304),
+                                ({"HTTP_IF_MODIFIED_SINCE": http_date(0)}, 200),
+                                ({"HTTP_IF_MODIFIED_SINCE": "garbage"}, 200)):
+            response = self.client.get(url, **headers)
+            self.assertEqual(response.status_code, status)
+            self.assertEqual(response["ETag"], etag)
+            self.assertEqual(response["Last-Modified"], last_modified)
+            if status == 304:
+                # Answered without rendering anything.
+                self.assertEqual(response.template, None)
+                self.assertEqual(response.content, "")
+        return etag
+
+    def test_view_code(self):
+        url = self.code.get_absolute_url()
+        etag = self.assertConditional(url)
+        Code.objects.filter(id=self.code.id).update(
+            modified=self.code.modified + datetime.timedelta(seconds=1))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.failIfEqual(response["ETag"], etag)
+
+    def test_view_section(self):
+        url = self.title.get_absolute_url()
+        etag = self.assertConditional(url)
+        Section.objects.filter(id=self.title.id).update(
+            modified=self.title.modified + datetime.timedelta(seconds=1))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.failIfEqual(response["ETag"], etag)
+
+
+class InvalidationTest(TestCase):
+    """
+    ``cache.Invalidation``: which pages it finds an import changed,
+    and that touching them makes their cached fragments stale.
+
+    """
+    def setUp(self):
+        self.old_depth = getattr(settings, "LAW_CODE_TREE_DEPTH", 2)
+        self.old_snapshot_dir = getattr(settings, "LAW_CODE_SNAPSHOT_DIR", None)
+        settings.LAW_CODE_TREE_DEPTH = 2
+        settings.LAW_CODE_SNAPSHOT_DIR = None
+        cache._page_cache = None
+        # A title, chapter, section, subsection and paragraph, ids 1-5.
+        self.nodes = []
+        parent = None
+        for id, type in enumerate((Section.TITLE, Section.CHAPTER, Section.SECTION,
+                                   Section.SUBSECTION, Section.PARAGRAPH)):
+            parent = bulk.SectionNode(type, "1", "Name", parent=parent)
+            parent.id = id + 1
+            self.nodes.append(parent)
+
+    def tearDown(self):
+        settings.LAW_CODE_TREE_DEPTH = self.old_depth
+        settings.LAW_CODE_SNAPSHOT_DIR = self.old_snapshot_dir
+        cache._page_cache = None
+
+    def collected(self, invalidation):
+        return (sorted(invalidation.section_ids.keys()),
+                sorted(invalidation.subtree_ids.keys()), invalidation.code_changed)
+
+    def test_section_added(self):
+        invalidation = cache.Invalidation()
+        invalidation.section_added(self.nodes[4])
+        self.assertEqual(self.collected(invalidation), ([3, 4], [], False))
+        invalidation.section_added(self.nodes[1])
+        self.assertEqual(self.collected(invalidation), ([1, 3, 4], [], True))
+
+    def test_section_changed(self):
+        invalidation = cache.Invalidation()
+        invalidation.section_changed(self.nodes[3], Section(number="1", name="Name"))
+        self.assertEqual(self.collected(invalidation), ([2, 3, 4], [], False))
+        invalidation.section_changed(self.nodes[3], Section(number="1", name="Old name"))
+        self.assertEqual(self.collected(invalidation), ([2, 3, 4], [4], False))
+
+    def test_section_removed(self):
+        invalidation = cache.Invalidation()
+        invalidation.section_removed(self.nodes[3], 4)
+        self.assertEqual(self.collected(invalidation), ([3, 4], [], False))
+        invalidation.section_removed(self.nodes[0], 1)
+        self.assertEqual(self.collected(invalidation), ([1, 3, 4], [], True))
+
+    def test_tree_added(self):
+        invalidation = cache.Invalidation()
+        invalidation.tree_added()
+        self.assertEqual(self.collected(invalidation), ([], [], True))
+
+    def test_apply(self):
+        code = Code.objects.create(name="Cached", type=Code.COUNTRY)
+        title = build_tree(code, 2, 5)
+        chapter = code.sections.get(path="1/1")
+        long_ago = datetime.datetime(2000, 1, 1)
+        code.sections.all().update(modified=long_ago)
+        Code.objects.filter(id=code.id).update(modified=long_ago)
+        # Cache the title's page, then rename a chapter behind its back.
+        response = self.client.get(title.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        code.sections.filter(id=chapter.id).update(name="Renamed chapter")
+        self.failIf("Renamed chapter" in self.client.get(title.get_absolute_url()).content)
+
+        title_node = bulk.SectionNode(Section.TITLE, "1", title.name)
+        title_node.id = title.id
+        chapter_node = bulk.SectionNode(Section.CHAPTER, "1", "Renamed chapter",
+                                        parent=title_node)
+        chapter_node.id = chapter.id
+        invalidation = cache.Invalidation()
+        invalidation.section_changed(chapter_node, chapter)
+        invalidation.apply(code)
+        touched = sorted(code.sections.exclude(modified=long_ago)
+                         .values_list("path", flat=True))
+        self.assertEqual(touched, ["1", "1/1", "1/1/2", "1/1/4"])
+        self.failIfEqual(Code.objects.get(id=code.id).modified, long_ago)
+        self.failUnless("Renamed chapter" in self.client.get(title.get_absolute_url()).content)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.code = Code.objects.create(name="Exported", type=Code.COUNTRY)
+        for number in ("1", "2", "10"):
+            title = Section.objects.create(code=self.code, type=Section.TITLE,
+                                           number=number, name="Title %s" % number)
+            Section.objects.create(code=self.code, type=Section.SECTION, number="1",
+                                   parent=title, name="Section 1", content="Text")
+
+    def test_export_code(self):
+        response = self.client.get(reverse("export-law-code", args=[self.code.id]))
+        records = [simplejson.loads(line) for line in response.content.splitlines()]
+        # Titles in the order they were imported, not by their numbers as strings.
+        self.assertEqual([record["path"] for record in records],
+                         ["1", "1/1", "2", "2/1", "10", "10/1"])
+        self.assertEqual([record["has_children"] for record in records],
+                         [True, False] * 3)
+        self.assertEqual(records[1]["content"], "Text")
+
+    def test_export_section_in_batches(self):
+        title = Section.objects.get(code=self.code, path="10")
+        old_batch_size = getattr(settings, "LAW_CODE_EXPORT_BATCH_SIZE", 1000)
+        settings.LAW_CODE_EXPORT_BATCH_SIZE = 1
+        try:
+            response = self.client.get(reverse("export-section", args=[title.id]),
+                                       {"format": "json"})
+        finally:
+            settings.LAW_CODE_EXPORT_BATCH_SIZE = old_batch_size
+        self.assertEqual([record["path"] for record in simplejson.loads(response.content)],
+                         ["10", "10/1"])
+
+
+class RequestStatsTest(TestCase):
+    "``middleware.RequestStatsMiddleware``, which settings.py installs."
+
+    def setUp(self):
+        self.old_stats = stats._stats
+        stats._stats = None
+        cache._page_cache = None
+        self.code = Code.objects.create(name="Measured", type=Code.COUNTRY)
+        build_tree(self.code, 1, 2)
+
+    def tearDown(self):
+        stats._stats = self.old_stats
+        cache._page_cache = None
+
+    def test_records_request(self):
+        response = self.client.get(reverse("view-law-code", args=[self.code.id]))
+        self.assertEqual(response.status_code, 200)
+        recorded = stats.get_stats().dump()["urls"]["law_code.views.view_code"]
+        self.assertEqual(recorded["wall_ms"]["count"], 1)
+        self.failUnless(recorded["queries"]["mean"] >= 1)
+        self.assertEqual(recorded["render_ms"]["count"], 1)
+        self.assertEqual(recorded["bytes"]["mean"], len(response.content))
+        # The connection's cursors are only wrapped during the request.
+        self.failIf("cursor" in connection.__dict__)
+
+
+class CitationsTest(unittest.TestCase):
+    "Parsing citations, and resolving them against a tree snapshot."
+
+    def test_parse_citation(self):
+        for text, parsed in (
+            ("42 U.S.C. \xc2\xa7 1983(a)(1)", ("42", "1983", ["a", "1"])),
+            (u"42 U.S.C. \u00a7\u00a7 1981", ("42", "1981", [])),
+            ("42 USC 2000e-2 et seq.", ("42", "2000e-2", [])),
+            ("5a U.S.C.A. sec. 12", ("5a", "12", [])),
+            ("42 U.S.C. 1983(a) (2)", ("42", "1983", ["a", "2"])),
+            ("section 1983", None),
+            ("42 CFR 1983", None),
+            ("", None)):
+            self.assertEqual(citations.parse_citation(text), parsed)
+
+    def test_resolve_citations(self):
+        # Title 1 uses section number 2 twice, in chapters 1 and 2.
+        rows = [("1", -1, Section.TITLE, "1"),
+                ("1", 0, Section.CHAPTER, "1/1"),
+                ("2", 1, Section.SECTION, "1/1/2"),
+                ("a", 2, Section.SUBSECTION, "1/1/2/a"),
+                ("1", 3, Section.PARAGRAPH, "1/1/2/a/1"),
+                ("2", 0, Section.CHAPTER, "1/2"),
+                ("2", 5, Section.SECTION, "1/2/2-1"),
+                ("2000e-2", 5, Section.SECTION, "1/2/2000e-2")]
+        tree = snapshot.TreeSnapshot(
+            1, True, range(10, 18), [row[1] for row in rows], [0] * 8, [0] * 8,
+            [row[0] for row in rows], ["Name"] * 8, [row[2] for row in rows],
+            [row[3] for row in rows])
+        deepest, other_case, inexact, missing = citations.resolve_citations(
+            tree, ["1 U.S.C. 2(a)(1)", "1 usc 2000E-2", "1 USC 2(b)", "2 USC 2"], "/law/1/")
+        self.assertEqual((deepest["id"], deepest["path"], deepest["url"]),
+                         (14, "1/1/2/a/1", "/law/1/1/1/2/a/1"))
+        self.failUnless(deepest["exact"])
+        self.failUnless(deepest["ambiguous"])
+        self.assertEqual(other_case["path"], "1/2/2000e-2")
+        self.failIf("ambiguous" in other_case)
+        self.assertEqual(inexact["path"], "1/1/2")
+        self.failIf(inexact["exact"])
+        self.assertEqual(missing, {"citation": "2 USC 2", "error": "no such section"})
+
+
+class ResolveCitationsTest(TestCase):
+    "The citations view, given citations in each of the ways it takes them."
+
+    def setUp(self):
+        self.old_snapshot_dir = getattr(settings, "LAW_CODE_SNAPSHOT_DIR", None)
+        settings.LAW_CODE_SNAPSHOT_DIR = None
+        snapshot._built.clear()
+        self.code = Code.objects.create(name="Cited", type=Code.COUNTRY)
+        build_tree(self.code, 2, 5)
+        self.url = reverse("resolve-citations", args=[self.code.id])
+
+    def tearDown(self):
+        settings.LAW_CODE_SNAPSHOT_DIR = self.old_snapshot_dir
+        snapshot._built.clear()
+
+    def results(self, response):
+        self.assertEqual(response.status_code, 200)
+        return simplejson.loads(response.content)["results"]
+
+    def test_json_body(self):
+        response = self.client.post(
+            self.url, simplejson.dumps(["1 U.S.C. 4", u"1 U.S.C. \u00a7 4(a)",
+                                        "nonsense", "1 U.S.C. 99"]),
+            content_type="application/json")
+        found, inexact, unrecognized, missing = self.results(response)
+        self.assertEqual(found["path"], "1/1/4")
+        self.assertEqual(found["url"], reverse("view-code-section",
+                                               args=[self.code.id, "1/1/4"]))
+        self.failUnless(found["exact"])
+        self.assertEqual(inexact["path"], "1/1/4")
+        self.failIf(inexact["exact"])
+        self.assertEqual(unrecognized["error"], "unrecognized citation")
+        self.assertEqual(missing["error"], "no such section")
+
+    def test_json_body_not_a_list(self):
+        response = self.client.post(self.url, simplejson.dumps({"c": "1 U.S.C. 4"}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_query_string(self):
+        response = self.client.get(self.url, QUERY_STRING="c=1+U.S.C.+4&c=1+U.S.C.+5")
+        self.assertEqual([result["path"] for result in self.results(response)],
+                         ["1/1/4", "1/2/5"])
+
+    def test_form(self):
+        response = self.client.post(self.url, "c=1+U.S.C.+5&c=1+U.S.C.+4",
+                                    content_type="application/x-www-form-urlencoded")
+        self.assertEqual([result["path"] for result in self.results(response)],
+                         ["1/2/5", "1/1/4"])
+
+
+class TitleServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A stand-in for the House's download server, on localhost: it
+    serves ``files`` (name: data) with an ETag, answering
+    If-None-Match with a 304 and Range (guarded by If-Range) with a
+    206, and records the headers of each request in ``requests``. A
+    file named in ``delays`` is sent after that many seconds.
+
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), TitleRequestHandler)
+        self.files = {}
+        self.delays = {}
+        self.etags = True
+        self.requests = []
+
+    def etag(self, name):
+        return '"%s-%d"' % (name, hash(self.files[name]) & 0xffffff)
+
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+
+class TitleRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        name = self.path.lstrip("/")
+        server.requests.append((name, dict(self.headers.items())))
+        if name in server.delays:
+            time.sleep(server.delays[name])
+        if name not in server.files:
+            self.send_error(404)
+            return
+        data = server.files[name]
+        etag = server.etag(name)
+        if server.etags and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") == etag \
+                and range_header.startswith("bytes="):
+            start = int(range_header[len("bytes="):].rstrip("-"))
+        if start:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        if server.etags:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+class DownloadTest(unittest.TestCase):
+    "``law_code.download`` against a local TitleServer."
+
+    def setUp(self):
+        self.server = TitleServer()
+        self.server.files[download.title_filename(1)] = "-CITE-\n    1 USC TITLE 1\n" * 2000
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, download.title_filename(1))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        title_file = open(path, "rb")
+        try:
+            return title_file.read()
+        finally:
+            title_file.close()
+
+    def fetch(self):
+        return download.fetch_title(1, self.directory, base_url=self.server.url())
+
+    def test_download_titles(self):
+        titles = dict(download.download_titles(
+            self.directory, numbers=[1, 2], base_url=self.server.url(), jobs=2))
+        self.assertEqual(titles[2], None)
+        title = titles[1]
+        self.assertEqual(title.path, self.path)
+        self.assertEqual(self.read(self.path), self.server.files["Title_01.txt"])
+        self.assertEqual(title.sha1, download.file_sha1(self.path))
+        self.failIf(title.unchanged)
+        self.failIf(os.path.exists(self.path + ".part"))
+
+    def test_download_titles_in_order(self):
+        # Title 1 finishes last, but still comes first.
+        for number in (2, 3):
+            self.server.files[download.title_filename(number)] = "-CITE-\n"
+        self.server.delays["Title_01.txt"] = 0.5
+        titles = download.download_titles(
+            self.directory, numbers=[1, 2, 3], base_url=self.server.url(), jobs=3)
+        self.assertEqual([number for number, title in titles], [1, 2, 3])
+
+    def test_resume(self):
+        data = self.server.files["Title_01.txt"]
+        part_file = open(self.path + ".part", "wb")
+        part_file.write(data[:1000])
+        part_file.close()
+        download._write_meta(self.path, {"partial_etag": self.server.etag("Title_01.txt")})
+        self.fetch()
+        name, headers = self.server.requests[-1]
+        self.assertEqual(headers.get("range"), "bytes=1000-")
+        self.assertEqual(self.read(self.path), data)
+
+    def test_resume_changed_file(self):
+        # The file changed since the partial download, so If-Range
+        # fails and the whole file is sent again.
+        part_file = open(self.path + ".part", "wb")
+        part_file.write("stale" * 100)
+        part_file.close()
+        download._write_meta(self.path, {"partial_etag": '"old"'})
+        self.fetch()
+        self.assertEqual(self.read(self.path), self.server.files["Title_01.txt"])
+
+    def test_not_modified(self):
+        self.fetch().mark_imported()
+        title = self.fetch()
+        name, headers = self.server.requests[-1]
+        self.assertEqual(headers.get("if-none-match"), self.server.etag("Title_01.txt"))
+        self.failUnless(title.unchanged)
+        self.assertEqual(self.read(self.path), self.server.files["Title_01.txt"])
+
+    def test_unchanged_checksum(self):
+        # Without validators, the file comes again, and its checksum
+        # tells that it hasn't changed since it was imported.
+        self.server.etags = False
+        self.fetch().mark_imported()
+        self.failUnless(self.fetch().unchanged)
+        self.server.files["Title_01.txt"] += "more"
+        self.failIf(self.fetch().unchanged)
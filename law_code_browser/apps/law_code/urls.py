@@ -4,8 +4,16 @@ from django.views.generic.simple import direct_to_template
 
 urlpatterns = patterns(
     'law_code.views',
+    (r'^search/$', 'search_sections', {}, 'law-code-search'),
+    (r'^stats/$', 'request_stats', {}, 'law-code-stats'),
+    (r'^stats\.json$', 'request_stats_json', {}, 'law-code-stats-json'),
+    (r'^sections/(\d+)/children/$', 'section_children', {}, 'section-children'),
+    (r'^sections/(\d+)/diff/(\d+)/$', 'section_diff', {}, 'section-diff'),
+    (r'^sections/(\d+)/export/$', 'export_section', {}, 'export-section'),
     (r'^(\d+)/$', 'view_code', {}, 'view-law-code'),
+    (r'^(\d+)/autocomplete/$', 'autocomplete_sections', {}, 'law-code-autocomplete'),
+    (r'^(\d+)/citations/$', 'resolve_citations', {}, 'resolve-citations'),
+    (r'^(\d+)/export/$', 'export_code', {}, 'export-law-code'),
     (r'^(\d+)/(.*)', 'view_section', {}, 'view-code-section'),
 
 )
-
@@ -0,0 +1,567 @@
+"""Parsing of the US Code ASCII title files.
+
+See http://uscode.house.gov/download/ascii.shtml
+
+Each title file is a series of documents, one per title, chapter,
+section and so on, each made up of fields such as ``-CITE-``,
+``-HEAD-`` and ``-STATUTE-``. A file is parsed in three steps:
+
+ * ``iter_head_blocks`` streams the file, cutting it into blocks at
+   each ``-HEAD-`` marker.
+
+ * ``iter_fields`` tokenizes a block into its fields, and
+   ``parse_header`` pulls the type, number and name out of the
+   ``-HEAD-`` field.
+
+ * ``split_statute`` splits the ``-STATUTE-`` field into its
+   enumerated subsections, paragraphs, clauses and so on, and
+   ``SectionTreeBuilder`` hangs everything off the right parents.
+
+None of this uses regular expressions; each block is scanned with
+``str.find`` and each line of statute text is looked at once.
+
+``USCodeFormat`` puts these together as the stages of
+``law_code.pipeline`` for ``import_us_code``.
+
+"""
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from law_code import download
+from law_code.bulk import SectionNode, iter_tree
+from law_code.models import Code, Section
+from law_code.pipeline import CodeFormat
+
+
+# The original header regex. The importer no longer uses it, but it is
+# kept as the baseline for ``benchmark_law_code parser``.
+us_section_rx = re.compile("""
+^\- HEAD \-# The header of each... well, header.
+.*\n # Get to the next line, when the content starts
+\W* # strip the leading whitespace
+([\w]+?) # The first group: part, section, title, etc
+(?:\-1)? # This is a special case for Title 42, Chapter 77, Subchaper
+         # III, Part A-1, which is inconsistently named, and should
+         # either be renamed B, or removed entirely.
+\.? # Sections are usually abbreviated "Sec." - so, ignore the period
+\W # Strop whitespace after the title
+([0-9]+[a-z]?) # Each section is ually a number with at most 1 suffix
+               # character, or a single character. This matches both.
+\.?# Section *numbers* usually have a trailing dot -  "2181."
+(?:\- )? # Larger sections (titles, etc) use SECTION X - THE TITLE
+\W+ # Force whitespace between section and title
+([\r\na-zA-Z,\(\) ]+) # The title of the section
+\\r\\n\\r\\n # Two newlines end the title
+""", re.VERBOSE|re.MULTILINE)
+
+# Marks the start of each section's header. The leading newline
+# anchors it to the start of a line.
+HEAD_MARKER = "\n-HEAD-"
+
+# How much of a title file is read at a time.
+CHUNK_SIZE = 64 * 1024
+
+section_mapping = {
+    "sec": Section.SECTION,
+    "chapter": Section.CHAPTER,
+    "title": Section.TITLE,
+    # Usually, eg, "secs 210 to 215: repealed". Exclude for now.
+    "secs": None,
+    "subtitle": Section.SUBTITLE,
+    "subchapter": Section.SUBCHAPTER,
+    "subpart": Section.SUBPART,
+    "part": Section.PART,
+    "division": Section.DIVISION,
+    }
+
+# The Section type of each level of enumeration inside a section:
+# (a), (1), (A), (i), (I).
+ENUMERATION_TYPES = (
+    Section.SUBSECTION,
+    Section.PARAGRAPH,
+    Section.SUBPARAGRAPH,
+    Section.CLAUSE,
+    Section.SUBCLAUSE,
+    )
+FIRST_LABELS = ("a", "1", "A", "i", "I")
+
+# A "(b)" at the start of a line that follows one of these words is a
+# cross reference that happens to have been wrapped, eg "under
+# subsection\n(b) of this section", rather than a new subsection.
+REFERENCE_WORDS = frozenset([
+    "section", "sections", "subsection", "subsections",
+    "paragraph", "paragraphs", "subparagraph", "subparagraphs",
+    "clause", "clauses", "subclause", "subclauses",
+    ])
+
+
+def _roman_numerals(count):
+    numerals = []
+    values = ((100, "c"), (90, "xc"), (50, "l"), (40, "xl"),
+              (10, "x"), (9, "ix"), (5, "v"), (4, "iv"), (1, "i"))
+    for number in range(1, count + 1):
+        numeral = ""
+        for value, letters in values:
+            while number >= value:
+                numeral += letters
+                number -= value
+        numerals.append(numeral)
+    return numerals
+
+ROMAN_NUMERALS = _roman_numerals(200)
+ROMAN_INDEX = dict([(numeral, ii) for ii, numeral in enumerate(ROMAN_NUMERALS)])
+
+
+def iter_head_blocks(title_file, chunk_size=CHUNK_SIZE):
+    """
+    Yield the text of each ``-HEAD-`` block in ``title_file``: from the
+    start of a ``-HEAD-`` line up to the start of the next one, or the
+    end of the file.
+
+    The file is read ``chunk_size`` bytes at a time, and only the block
+    currently being collected is held in memory, so memory use depends
+    on the largest single section rather than the size of the title.
+
+    """
+    buf = "\n" # So that a -HEAD- on the very first line is found.
+    head = -1 # Offset of the current block's marker in buf, if any.
+    scanned = 0 # Everything before this offset has been searched.
+    while True:
+        chunk = title_file.read(chunk_size)
+        buf += chunk
+        while True:
+            found = buf.find(HEAD_MARKER, scanned)
+            if found == -1:
+                break
+            if head != -1:
+                yield buf[head + 1:found + 1]
+            head = found
+            scanned = found + 1
+        if not chunk:
+            break
+        # A marker may be split across chunks, so rescan its length.
+        scanned = max(scanned, len(buf) - len(HEAD_MARKER) + 1)
+        if head == -1:
+            drop = scanned
+        else:
+            drop = head
+        buf = buf[drop:]
+        scanned -= drop
+        if head != -1:
+            head = 0
+    if head != -1:
+        yield buf[head + 1:]
+
+
+def _is_field_marker(line):
+    return (len(line) > 2 and line[0] == "-" and line[-1] == "-"
+            and line[1:-1].isalnum())
+
+
+def iter_fields(block):
+    """
+    Yield ``(name, text)`` for each field in a block, eg
+    ``("STATUTE", "...")``. Only lines starting with a dash are looked
+    at individually; the rest of the text is skipped by ``str.find``.
+
+    """
+    name = None
+    text_start = 0
+    pos = -1 # The newline before the line being looked at.
+    while True:
+        line_end = block.find("\n", pos + 1)
+        if line_end == -1:
+            line_end = len(block)
+        line = block[pos + 1:line_end].rstrip()
+        if _is_field_marker(line):
+            if name is not None:
+                yield name, block[text_start:pos + 1]
+            name = line[1:-1]
+            text_start = line_end + 1
+        pos = block.find("\n-", line_end)
+        if pos == -1:
+            break
+    if name is not None:
+        yield name, block[text_start:]
+
+
+def parse_header(text):
+    """
+    Split the text of a ``-HEAD-`` field, eg ``"Sec. 1. Words
+    denoting number, gender, and so forth"`` or ``"CHAPTER 21 - CIVIL
+    RIGHTS"``, into ``(type, number, name)``.
+
+    Returns None if the header isn't of a type in ``section_mapping``.
+
+    """
+    words = text.split(None, 2)
+    if len(words) < 2:
+        return None
+    sectype = words[0].lstrip("[").rstrip(".")
+    if sectype.lower() not in section_mapping:
+        return None
+    number = words[1].rstrip(".:")
+    if "--" in number:
+        # "CHAPTER 1--RULES OF CONSTRUCTION"
+        number, name = number.split("--", 1)
+        words[2:] = [" ".join([name] + words[2:])]
+    if not number:
+        return None
+    name = ""
+    if len(words) == 3:
+        name = words[2].lstrip("-").strip()
+    return sectype, number, name
+
+
+def _candidate_levels(label):
+    if label.isdigit():
+        return (1,)
+    if not label.isalpha():
+        return ()
+    if label.islower():
+        if label in ROMAN_INDEX:
+            return (0, 3)
+        return (0,)
+    if label.isupper():
+        if label.lower() in ROMAN_INDEX:
+            return (2, 4)
+        return (2,)
+    return ()
+
+
+def _successor(label, level):
+    if level == 1:
+        return str(int(label) + 1)
+    if level >= 3:
+        index = ROMAN_INDEX.get(label.lower())
+        if index is None or index + 1 >= len(ROMAN_NUMERALS):
+            return None
+        following = ROMAN_NUMERALS[index + 1]
+        if level == 4:
+            following = following.upper()
+        return following
+    # Letters run a..z, then aa, bb, ...
+    letter = label[-1]
+    if label != letter * len(label):
+        return None
+    if letter in "zZ":
+        return chr(ord(letter) - 25) * (len(label) + 1)
+    return chr(ord(letter) + 1) * len(label)
+
+
+def _label_level(label, open_labels, expects_child):
+    """
+    The level of enumeration ``label`` continues, given the label open
+    at each level, or None if it can't continue any of them.
+
+    A label either follows the open label at its own level ("(c)"
+    after "(b)"), or starts a new level below every open one ("(1)"
+    after "(b)"). Some labels, like "(i)", could be either; then
+    ``expects_child`` (the text so far ended with a colon or dash)
+    breaks the tie in favour of the deeper level.
+
+    """
+    valid = []
+    for level in _candidate_levels(label):
+        current = open_labels[level]
+        if current is not None:
+            if label == _successor(current, level):
+                valid.append(level)
+        elif label == FIRST_LABELS[level] and not [
+                l for l in open_labels[level:] if l is not None]:
+            valid.append(level)
+    if not valid:
+        return None
+    if expects_child:
+        return valid[-1]
+    return valid[0]
+
+
+def split_statute(text):
+    """
+    Split the text of a ``-STATUTE-`` field into its enumerated parts.
+
+    Returns ``(lead_in, parts)``: the text before the first enumerated
+    part (or None), and a list of ``(level, label, text)`` tuples in
+    document order, where level indexes ``ENUMERATION_TYPES``.
+
+    A line starts a new part when it begins with one or more labels,
+    eg "(b)" or "(b)(1)(A)", that continue the enumeration so far;
+    anything else continues the current part.
+
+    """
+    lead_in = []
+    parts = []
+    current = lead_in
+    open_labels = [None] * len(ENUMERATION_TYPES)
+    previous = ""
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == "(":
+            last_word = previous[previous.rfind(" ") + 1:].lower()
+            if last_word not in REFERENCE_WORDS:
+                expects_child = previous[-1:] in (":", "-")
+                while line[:1] == "(":
+                    close = line.find(")")
+                    label = line[1:close]
+                    if close == -1 or not label:
+                        break
+                    level = _label_level(label, open_labels, expects_child)
+                    if level is None:
+                        break
+                    open_labels[level] = label
+                    for deeper in range(level + 1, len(open_labels)):
+                        open_labels[deeper] = None
+                    current = []
+                    parts.append((level, label, current))
+                    line = line[close + 1:].lstrip()
+                    expects_child = True
+        if line:
+            current.append(line)
+            previous = line
+
+    lead_in = " ".join(lead_in) or None
+    return lead_in, [(level, label, " ".join(words))
+                     for level, label, words in parts]
+
+
+def iter_us_code_documents(title_file):
+    """
+    Yield ``(head, statute)`` for each block of ``title_file``, as
+    the file is read: the text of its ``-HEAD-`` field, and of its
+    ``-STATUTE-`` field, or None.
+
+    """
+    for block in iter_head_blocks(title_file):
+        head = statute = None
+        for name, text in iter_fields(block):
+            if name == "HEAD":
+                head = text
+            elif name == "STATUTE":
+                statute = text
+                break
+        if head is not None:
+            yield head, statute
+
+
+def normalize_us_code_document(head, statute):
+    """
+    ``(type, number, name, statute)`` for a document from
+    ``iter_us_code_documents``, or None if it isn't a section header.
+
+    """
+    header = parse_header(" ".join(head.split()))
+    if header is None:
+        return None
+    return header + (statute,)
+
+
+def iter_us_code_sections(title_file):
+    """
+    Yield ``(type, number, name, statute)`` for each section header
+    in ``title_file``, as the file is read. ``statute`` is the raw text
+    of the section's ``-STATUTE-`` field, or None.
+
+    """
+    for head, statute in iter_us_code_documents(title_file):
+        fields = normalize_us_code_document(head, statute)
+        if fields is not None:
+            yield fields
+
+
+class SectionTreeBuilder(object):
+    """
+    Builds the tree of ``bulk.SectionNode`` objects for one title, one
+    section header at a time.
+
+    Ordering Section Types
+    ======================
+
+    The US code does not use consistent ordering. This is just one of
+    many beautiful features that makes it a write-only document. The
+    Title is the uppermost division, while the Section is always,
+    AFAIK, the smallest division. However, the divisions bewtween
+    Title and Section do not use consistent ordering:
+
+    http://en.wikipedia.org/wiki/United_States_Code#Organization
+
+    Since greater subtypes must always precede lower ones, I simply
+    add each new section type to the ordering list the first time it
+    is seen. Types that haven't been seen yet can't be anyone's
+    parent, so the ordering is always complete enough for the
+    headers that have been read so far.
+
+    Determination of the Parent
+    ===========================
+
+    Each section type seen so far holds the most recent node of that
+    type. A new node's parent is the most recent node of the lowest
+    type above it in ``order``; any nodes of its own type or lower
+    are forgotten, since they can no longer be parents.
+
+    Below the Section, the subsections, paragraphs and so on come from
+    ``split_statute``, and always nest in the same order.
+
+    """
+    def __init__(self):
+        self.order = []
+        self.parents = {}
+        self.roots = []
+        self.paths = {}
+
+    def _path(self, parent, number):
+        """
+        The path for a new node numbered ``number`` under ``parent``.
+        The US Code reuses a few section numbers, so a path that has
+        already been used gets "~2", "~3" and so on appended.
+
+        """
+        if parent is None:
+            path = number
+        else:
+            path = "%s/%s" % (parent.path, number)
+        unique = path
+        count = 1
+        while unique in self.paths:
+            count += 1
+            unique = "%s~%d" % (path, count)
+        self.paths[unique] = True
+        return unique
+
+    def add(self, sectype, number, name, statute=None):
+        """
+        Add the section from one header, along with the parts of its
+        statute text, returning its node, or None if its type isn't
+        imported.
+
+        """
+        sectype = sectype.lower().strip()
+        if sectype not in self.order:
+            self.order.append(sectype)
+            self.parents[sectype] = None
+        position = self.order.index(sectype)
+
+        # Clear out child types, so they aren't seen as potential parents.
+        for ct in self.order[position:]:
+            self.parents[ct] = None
+        parent = None
+        for ppt in self.order[:position]:
+            if self.parents[ppt] is not None:
+                parent = self.parents[ppt]
+
+        name = name.rstrip("\r")
+        assert sectype in section_mapping, sectype
+        type = section_mapping[sectype]
+        if type is None:
+            return None
+        node = SectionNode(type, number, name, parent=parent,
+                           path=self._path(parent, number))
+        if parent is None:
+            self.roots.append(node)
+        self.parents[sectype] = node
+        if statute is not None:
+            self._add_statute(node, statute)
+        return node
+
+    def release(self, node, keep_tree=False):
+        """
+        Let go of ``node``'s subtree once it has been written, so that
+        a title saved a section at a time only holds the chain of open
+        parents (and the paths used so far): the text of its nodes is
+        dropped, and its descendants are detached, as is ``node`` from
+        its parent (or ``roots``). ``node`` itself stays as long as it
+        can be a parent. With ``keep_tree``, only the text is dropped,
+        for a caller that needs the shape of the whole title at the end.
+
+        """
+        for descendant in iter_tree([node]):
+            descendant.content = None
+        if keep_tree:
+            return
+        node.children = []
+        if node.parent is None:
+            siblings = self.roots
+        else:
+            siblings = node.parent.children
+        if siblings and siblings[-1] is node:
+            siblings.pop()
+
+    def _add_statute(self, section, statute):
+        section.content, parts = split_statute(statute)
+        open_nodes = [None] * len(ENUMERATION_TYPES)
+        for level, label, text in parts:
+            parent = section
+            for candidate in open_nodes[:level]:
+                if candidate is not None:
+                    parent = candidate
+            node = SectionNode(ENUMERATION_TYPES[level], label,
+                               "(%s)" % label, text or None, parent=parent,
+                               path=self._path(parent, label))
+            open_nodes[level] = node
+            for deeper in range(level + 1, len(open_nodes)):
+                open_nodes[deeper] = None
+
+
+class USCodeFormat(CodeFormat):
+    """
+    The US Code, from the House's ASCII title files: either a
+    directory of them (``import_us_code --directory``), or downloaded
+    (see ``law_code.download``).
+
+    """
+    name = "us"
+    code_name = "US Code"
+    code_type = Code.COUNTRY
+
+    def __init__(self):
+        self.downloaded = {}
+
+    def fetch(self, options, log):
+        if options.get("directory"):
+            base_dir = os.path.abspath(os.path.expanduser(options["directory"]))
+            for number in download.TITLE_NUMBERS:
+                path = os.path.join(base_dir, download.title_filename(number))
+                if not os.path.exists(path):
+                    log("Skipping missing %s" % path)
+                    continue
+                yield path
+            return
+
+        directory = options.get("download_dir") or getattr(
+            settings, "LAW_CODE_DOWNLOAD_DIR", None)
+        if not directory:
+            raise ImproperlyConfigured("Give --directory or --download-dir, or set "
+                                       "LAW_CODE_DOWNLOAD_DIR")
+        directory = os.path.abspath(os.path.expanduser(directory))
+        titles = download.download_titles(
+            directory, base_url=options.get("download_url"),
+            jobs=options.get("download_jobs") or 4)
+        for number, title in titles:
+            if title is None:
+                log("Title %d isn't on the server; skipping it" % number)
+                continue
+            if title.unchanged and options.get("incremental"):
+                log("Skipping unchanged %s" % title.path)
+                continue
+            self.downloaded[title.path] = title
+            yield title.path
+
+    def documents(self, title_file):
+        return iter_us_code_documents(title_file)
+
+    def normalize(self, document):
+        return normalize_us_code_document(*document)
+
+    def tree_builder(self):
+        return SectionTreeBuilder()
+
+    def loaded(self, path):
+        # Remember that the downloaded file has been imported.
+        title = self.downloaded.pop(path, None)
+        if title is not None:
+            title.mark_imported()
@@ -0,0 +1,155 @@
+"""Browsing a code as of a date, and diffs between versions of a Section.
+
+Every version of a section is a row with the section's path, valid from
+``valid_from`` until ``valid_to`` (None for the current one); see
+``law_code.incremental`` for how re-imports write them. So the section
+at a path as of a time is the row with that path whose range covers
+it, which the ``(code, path, valid_from, valid_to)`` index in
+sql/section.sql finds directly, and its descendants as of that time are
+the rows under the path whose ranges cover it.
+
+Old versions are kept outside of the code's tree, so their place in it
+is taken from the current row with the same path. A section that has
+been removed has none, and is placed after its nearest ancestor that
+is still current, with the other removed sections in path order.
+
+Diffs are worked out the first time they're asked for and then kept in
+the page cache (see ``law_code.cache``), under the content hashes of the
+two versions, so they never need to be invalidated.
+
+"""
+import datetime
+import difflib
+import re
+
+from django.db.models import Q
+from django.utils.html import escape
+
+from law_code.cache import cached_fragment
+from law_code.models import Section, load_content
+
+
+def parse_as_of(value):
+    """
+    The time a date given as "YYYY-MM-DD" refers to, the end of that
+    day, or None if it isn't a date.
+
+    """
+    try:
+        day = datetime.datetime.strptime(value.strip(), "%Y-%m-%d")
+    except ValueError:
+        return None
+    return day + datetime.timedelta(days=1, microseconds=-1)
+
+
+def valid_at(queryset, when):
+    "Restrict a queryset of Sections to the versions in force at ``when``."
+    return queryset.filter(valid_from__lte=when).filter(
+        Q(valid_to__isnull=True) | Q(valid_to__gt=when))
+
+
+def section_as_of(code, path, when):
+    "The version of the section at ``path`` in force at ``when``, or None."
+    rows = list(valid_at(code.sections.filter(path=path), when)
+                .order_by("-valid_from")[:1])
+    if not rows:
+        return None
+    return rows[0]
+
+
+def ancestors_as_of(section, when):
+    "The versions of ``section``'s ancestors in force at ``when``."
+    parts = section.path.split("/")
+    paths = ["/".join(parts[:end]) for end in range(1, len(parts))]
+    if not paths:
+        return []
+    by_path = dict([(row.path, row) for row in valid_at(
+        Section.objects.filter(code=section.code_id, path__in=paths), when)])
+    return [by_path[path] for path in paths if path in by_path]
+
+
+def descendants_as_of(section, when, depth):
+    """
+    The versions of ``section``'s descendants, up to ``depth`` levels
+    down, in force at ``when``, in tree order and with their content
+    loaded. Their ``level`` is set from their path, since old versions
+    aren't in the tree.
+
+    """
+    prefix = section.path + "/"
+    max_slashes = section.path.count("/") + depth
+    rows = [row for row in valid_at(Section.objects.filter(
+        code=section.code_id, path__startswith=prefix), when)
+            if row.path.count("/") <= max_slashes]
+
+    # The tree order of each path, from the current rows, which are
+    # the ones in the tree.
+    opts = Section._meta
+    positions = {}
+    in_tree = Section.objects.filter(code=section.code_id, path__startswith=prefix,
+                                     current_version=True)\
+        .values_list("path", opts.tree_id_attr, opts.left_attr)
+    for path, tree_id, lft in in_tree:
+        positions[path] = (tree_id, lft)
+
+    def position(path):
+        while path not in positions and "/" in path:
+            path = path.rsplit("/", 1)[0]
+        return positions.get(path)
+    rows.sort(key=lambda row: (position(row.path), row.path))
+    for row in rows:
+        setattr(row, opts.level_attr, row.path.count("/"))
+    return load_content(rows)
+
+
+def versions(section):
+    "Every version of ``section``, oldest first."
+    return Section.objects.filter(code=section.code_id, path=section.path)\
+        .order_by("valid_from", "id")
+
+
+WORD_RX = re.compile(r"(\s+)", re.UNICODE)
+
+
+def _words(text):
+    return [word for word in WORD_RX.split(text or u"") if word]
+
+
+def diff_html(old_text, new_text):
+    """
+    HTML showing the changes from ``old_text`` to ``new_text`` word by
+    word, with removed words in ``<del>`` and added ones in ``<ins>``.
+
+    """
+    old_words = _words(old_text)
+    new_words = _words(new_text)
+    matcher = difflib.SequenceMatcher(None, old_words, new_words)
+    parts = []
+    for op, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if op == "equal":
+            parts.append(escape(u"".join(old_words[old_start:old_end])))
+            continue
+        if old_end > old_start:
+            parts.append(u"<del>%s</del>" % escape(
+                u"".join(old_words[old_start:old_end])))
+        if new_end > new_start:
+            parts.append(u"<ins>%s</ins>" % escape(
+                u"".join(new_words[new_start:new_end])))
+    return u"".join(parts)
+
+
+def diff_key(old, new):
+    return "law_code:diff:%s:%s" % (old.content_hash, new.content_hash)
+
+
+def cached_diff(old, new):
+    """
+    The diff (see ``diff_html``) of the names and content of two
+    versions of a section, from the page cache if it's there.
+
+    """
+    def render():
+        load_content([old, new])
+        return u'<h2>%s</h2>\n<div class="section-content">%s</div>' % (
+            diff_html(old.name, new.name), diff_html(old.content, new.content))
+    return cached_fragment(diff_key(old, new), render)
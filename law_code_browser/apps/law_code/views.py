@@ -1,38 +1,529 @@
-from django.http import HttpResponseRedirect, Http404
+from email.Utils import mktime_tz, parsedate_tz
+import datetime
+import time
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.paginator import Paginator, InvalidPage
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponseBadRequest, HttpResponseNotModified
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404
-from django.views.generic.simple import direct_to_template
+from django.template import loader
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
+from django.views.generic import simple
+
+from law_code import (autocomplete, citations, models, search, snapshot, stats, stream,
+                      versions)
+from law_code.cache import cached_fragment, code_key, rendered_depth, section_key
+
+
+# Rendering, timed for the request statistics; see law_code.stats.
+render_to_string = stats.timed_render(loader.render_to_string)
+direct_to_template = stats.timed_render(simple.direct_to_template)
+
+
+def _mark_collapsed(sections, max_level):
+    """Set ``collapsed`` on each Section at ``max_level`` that has
+    children, which the templates render as an expand link."""
+    for section in sections:
+        section.collapsed = (section.level >= max_level
+                             and not section.is_leaf_node())
+    return sections
+
 
-from law_code import models
+def _not_modified(request, etag, last_modified):
+    "Whether the request's conditional headers match the validators."
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    if_modified_since = request.META.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since:
+        since = parsedate_tz(if_modified_since.split(";")[0])
+        if since is not None:
+            return last_modified <= mktime_tz(since)
+    return False
+
+
+def _conditional(request, key, modified, respond):
+    """
+    Answer a conditional GET for a page whose cache key (see
+    ``law_code.cache``) is ``key`` and which last changed at
+    ``modified`` with a 304, or call ``respond`` for the full response.
+    Either way, the response gets ETag and Last-Modified headers.
+
+    The page also shows who is logged in, so the ETag includes the
+    user; the session middleware adds ``Vary: Cookie``. Without the
+    auth middleware (see settings_readonly.py) there is no user.
+
+    """
+    user = getattr(request, "user", None)
+    user_id = user is not None and user.id or None
+    etag = '"%s"' % md5_constructor("%s:%s" % (key, user_id)).hexdigest()
+    last_modified = int(time.mktime(modified.timetuple()))
+    if request.method in ("GET", "HEAD") and _not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        response = respond()
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def code_list(request, template="law_code/code_list.html"):
+    "The public Codes."
+    return direct_to_template(request, template, {
+        "code_list": models.Code.objects.filter(public=True).order_by("name")})
 
 
 def view_code(request, code_id, template="law_code/code_index.html"):
+    """Show the top of a Code's tree. Only the first few levels are
+    rendered (see ``cache.rendered_depth``); deeper ones are expanded
+    on demand through ``section_children``.
+
+    The tree is rendered once per version of the Code and cached (see
+    ``law_code.cache``). Imports touch ``Code.modified`` whenever the
+    rendered levels change, so it also serves as the page's validator
+    for conditional GETs.
+
+    """
     code = get_object_or_404(models.Code.objects.filter(public=True), id=int(code_id))
-    return direct_to_template(request, template, {"code": code})
 
+    def render():
+        depth = rendered_depth()
+        sections = code.sections.filter(current_version=True, level__lt=depth)\
+            .order_by("tree_id", "lft")
+        sections = models.load_content(list(sections))
+        return render_to_string("law_code/code_index_body.html", {
+            "code": code,
+            "sections": _mark_collapsed(sections, depth - 1)})
+
+    key = code_key(code)
+    return _conditional(request, key, code.modified, lambda: direct_to_template(
+        request, template, {"code": code, "body": cached_fragment(key, render)}))
+
+
+# How many references and "cited by" links a section page lists.
+REFERENCE_LIMIT = 100
 
 def view_section(request, code_id, section_string):
     """URL resolution here needs to be able to handle an arbitrary
     depth of sections.
 
     To do so, everything after the code_id is captured and passed as
-    section_string. Then, I split on '/', and keep drilling down to
-    the correct Section.
+    section_string. That's the same as the Section's stored path, so
+    any depth takes a single indexed lookup, which also fetches the
+    Code.
+
+    As with ``view_code``, only the first few levels below the section
+    are rendered, and the result is cached; a cache hit takes no more
+    queries than the lookup. The breadcrumbs come from the Code's tree
+    snapshot (see ``law_code.snapshot``) when there is one.
+
+    Imports touch a Section's ``modified`` whenever anything its page
+    renders changes, including descendants within the rendered depth
+    and the names of its ancestors, so it is the latest ``modified``
+    of everything on the page. That makes it the validator for
+    conditional GETs, answered with a 304 before anything is rendered.
+
+    The page also lists the sections this one refers to and those that
+    refer to it (see ``law_code.references``), up to
+    ``REFERENCE_LIMIT`` of each, and the section's earlier versions
+    with links to their diffs.
+
+    With ``?as_of=YYYY-MM-DD``, the section is shown as it was at the
+    end of that day instead; see ``law_code.versions``.
 
     """
-    code = get_object_or_404(models.Code.objects.filter(public=True), id=int(code_id))
-    section_parts = section_string.split('/')
-    if not section_parts:
+    section_string = section_string.strip('/')
+    if not section_string:
         raise Http404("No section segment found")
-    root_section_number = section_parts.pop(0)
-    root_section = get_object_or_404(code.sections.filter(parent=None), current_version=True, number=root_section_number)
-    parent = root_section
-    if not section_parts:
-        node = root_section
-    for part in section_parts:
-        node = parent.get_children().get(number=part)
-        parent = node
-
-    return direct_to_template(
+    if request.GET.get("as_of"):
+        return _view_section_as_of(request, code_id, section_string,
+                                   request.GET["as_of"])
+    node = get_object_or_404(
+        models.Section.objects.select_related("code"),
+        code__id=int(code_id), code__public=True,
+        current_version=True, path=section_string)
+
+    def render():
+        max_level = node.level + rendered_depth()
+        descendants = node.get_descendants().filter(
+            current_version=True, level__lte=max_level)
+        in_tree = snapshot.snapshot_for(node)
+        if in_tree is not None:
+            ancestors = in_tree.snapshot.ancestors(in_tree)
+        else:
+            ancestors = node.get_ancestors()
+        descendants = list(descendants)
+        # The content of everything on the page, in one query.
+        models.load_content([node] + descendants)
+        references = models.SectionReference.objects.filter(
+            source=node, target__isnull=False).select_related("target")\
+            .order_by("target__path")[:REFERENCE_LIMIT]
+        cited_by = models.SectionReference.objects.filter(
+            target=node, source__current_version=True).select_related("source")\
+            .order_by("source__path")[:REFERENCE_LIMIT]
+        return render_to_string("law_code/code_section_body.html", {
+            "section": node,
+            "ancestors": ancestors,
+            "descendants": _mark_collapsed(descendants, max_level),
+            "references": [reference.target for reference in references],
+            "cited_by": [reference.source for reference in cited_by],
+            "history": _history(node)})
+
+    key = section_key(node)
+    return _conditional(request, key, node.modified, lambda: direct_to_template(
         request, "law_code/code_section.html",
-        {"section": node})
+        {"section": node, "body": cached_fragment(key, render)}))
+
+
+def _history(section):
+    """The versions of ``section``, newest first, each with the URL of
+    its diff from the version before it; empty if it only has one.
+
+    """
+    history = list(versions.versions(section))
+    if len(history) < 2:
+        return []
+    previous = None
+    for version in history:
+        if previous is not None:
+            version.diff_url = reverse("section-diff", args=[previous.id, version.id])
+        previous = version
+    history.reverse()
+    return history
+
+
+def _view_section_as_of(request, code_id, section_string, as_of):
+    """``view_section`` for a section as of the date ``as_of``. A page
+    for a day that is over can't change any more, so it is cached
+    for good; one for today or later is rendered every time.
+
+    """
+    when = versions.parse_as_of(as_of)
+    if when is None:
+        return HttpResponseBadRequest("as_of must be a date, YYYY-MM-DD")
+    code = get_object_or_404(models.Code, id=int(code_id), public=True)
+    node = versions.section_as_of(code, section_string, when)
+    if node is None:
+        raise Http404("No such section on %s" % as_of)
+    node.code = code
+
+    def render():
+        models.load_content([node])
+        return render_to_string("law_code/code_section_body.html", {
+            "section": node,
+            "as_of": when,
+            "link_suffix": "?as_of=%s" % when.strftime("%Y-%m-%d"),
+            "ancestors": versions.ancestors_as_of(node, when),
+            "descendants": versions.descendants_as_of(node, when, rendered_depth())})
+
+    if when < datetime.datetime.now():
+        key = "law_code:section-as-of:%d:%s:%s:%d" % (
+            node.id, md5_constructor(node.path.encode("utf-8")).hexdigest(),
+            when.strftime("%Y%m%d"), rendered_depth())
+        body = cached_fragment(key, render)
+    else:
+        body = mark_safe(render())
+    return direct_to_template(request, "law_code/code_section.html",
+                              {"section": node, "body": body})
+
+
+def section_diff(request, old_id, new_id, template="law_code/section_diff.html"):
+    """
+    The changes between two versions of a section, which are rows with
+    the same path (see ``law_code.versions``). The diff is worked out
+    once and cached; its key also serves as the ETag, so a repeat
+    visit gets a 304.
+
+    """
+    old = get_object_or_404(models.Section.objects.select_related("code"),
+                            id=int(old_id), code__public=True)
+    new = get_object_or_404(models.Section.objects.select_related("code"),
+                            id=int(new_id), code__public=True)
+    if old.code_id != new.code_id or old.path != new.path:
+        raise Http404("Not versions of the same section")
+    return _conditional(request, versions.diff_key(old, new),
+                        max(old.modified, new.modified), lambda: direct_to_template(
+        request, template, {"section": new, "old": old, "new": new,
+                            "diff": versions.cached_diff(old, new)}))
+
+
+def section_children(request, section_id):
+    """JSON for one level of a Section's children, used to expand the
+    tree in place.
+
+    Children come from the Code's tree snapshot (see
+    ``law_code.snapshot``) if the section hasn't changed since it was
+    built, and are otherwise found by the parent's lft/rght range and
+    level, so no other part of the tree is touched. Either way the
+    section and its Code are looked up first, so a Code that has been
+    unpublished stops serving them. Long lists are split into pages
+    of ``LAW_CODE_CHILDREN_PER_PAGE``; ``next`` gives the URL of the
+    following page.
+
+    """
+    section = get_object_or_404(
+        models.Section.objects.filter(code__public=True), id=int(section_id))
+    code_id = section.code_id
+    in_tree = snapshot.snapshot_for(section)
+    if in_tree is not None:
+        children = [{
+            "id": child.id,
+            "number": child.number,
+            "name": child.name,
+            "type": child.type,
+            "level": child.level,
+            "url": child.get_absolute_url(),
+            "has_children": not child.is_leaf_node(),
+            } for child in in_tree.snapshot.children(in_tree)]
+    else:
+        children = models.Section.objects.filter(
+            tree_id=section.tree_id, lft__gt=section.lft, rght__lt=section.rght,
+            level=section.level + 1, current_version=True).order_by("lft")\
+            .values("id", "number", "name", "type", "path", "lft", "rght", "level")
+    paginator = Paginator(children, getattr(settings, "LAW_CODE_CHILDREN_PER_PAGE", 200))
+    try:
+        page = paginator.page(int(request.GET.get("page", 1)))
+    except (ValueError, InvalidPage):
+        raise Http404("No such page of children")
+
+    children_url = reverse("section-children", args=[section.id])
+    next_url = None
+    if page.has_next():
+        next_url = "%s?page=%d" % (children_url, page.next_page_number())
+    data = {
+        "section": section.id,
+        "page": page.number,
+        "pages": paginator.num_pages,
+        "count": paginator.count,
+        "next": next_url,
+        "children": [],
+        }
+    for child in page.object_list:
+        if "url" not in child:
+            child = {
+                "id": child["id"],
+                "number": child["number"],
+                "name": child["name"],
+                "type": child["type"],
+                "level": child["level"],
+                "url": reverse("view-code-section", args=[code_id, child["path"]]),
+                "has_children": child["rght"] - child["lft"] > 1,
+                }
+        child["children_url"] = reverse("section-children", args=[child["id"]])
+        data["children"].append(child)
+    return HttpResponse(simplejson.dumps(data), mimetype="application/json")
+
+
+def _export_response(request, records):
+    """
+    Stream ``records`` (see ``law_code.stream``) as NDJSON, or as a
+    JSON array with ``?format=json``.
+
+    """
+    if request.GET.get("format") == "json":
+        return HttpResponse(stream.json_array(records), mimetype="application/json")
+    return HttpResponse(stream.ndjson(records), mimetype="application/x-ndjson")
+
+
+def _export_batch_size():
+    return getattr(settings, "LAW_CODE_EXPORT_BATCH_SIZE", 1000)
+
+
+def export_code(request, code_id):
+    """Every current Section of a Code as data, a title at a time and
+    in tree order; see ``law_code.stream``. The response is written as
+    the Sections are read, in batches, so a whole code takes no more
+    memory than one batch. The batches aren't one transaction, so an
+    export made while an import is running may not be consistent.
+
+    """
+    code = get_object_or_404(models.Code, id=int(code_id), public=True)
+    return _export_response(request, stream.iter_code_records(code, _export_batch_size()))
+
+
+def export_section(request, section_id):
+    "A Section and everything under it as data; see ``export_code``."
+    section = get_object_or_404(
+        models.Section.objects.filter(code__public=True, current_version=True),
+        id=int(section_id))
+    return _export_response(request, stream.iter_records(section, _export_batch_size()))
+
+
+def resolve_citations(request, code_id):
+    """
+    Resolve a batch of citations, eg "42 U.S.C. 1983(a)", to the
+    Code's current Sections, using ``law_code.citations``. Citations
+    are given as a JSON list in the body of a POST with the content
+    type application/json, or as repeated ``c`` parameters, in the
+    query string or a form.
+
+    Returns JSON: ``{"results": [...]}``, with one result per citation,
+    in order; see ``citations.resolve_citations``.
+
+    """
+    code = get_object_or_404(models.Code.objects.filter(public=True), id=int(code_id))
+    # Django parses any body that isn't multipart into request.POST,
+    # so a JSON body is told apart by its content type.
+    content_type = request.META.get("CONTENT_TYPE", "")
+    if request.method == "POST" and content_type.startswith("application/json"):
+        try:
+            requested = simplejson.loads(request.raw_post_data)
+        except ValueError:
+            return HttpResponseBadRequest("Expected a JSON list of citations")
+        if not isinstance(requested, list):
+            return HttpResponseBadRequest("Expected a JSON list of citations")
+    else:
+        requested = request.REQUEST.getlist("c")
+    limit = getattr(settings, "LAW_CODE_MAX_CITATIONS", 20000)
+    if len(requested) > limit:
+        return HttpResponseBadRequest("At most %d citations at a time" % limit)
+
+    tree = snapshot.code_snapshot(code)
+    url_prefix = reverse("view-code-section", args=[code.id, "-"])[:-1]
+    results = citations.resolve_citations(
+        tree, [unicode(citation) for citation in requested], url_prefix)
+    return HttpResponse(simplejson.dumps({"results": results}),
+                        mimetype="application/json")
+
+
+# The most suggestions autocomplete_sections gives for a query.
+MAX_SUGGESTIONS = 50
+
+def autocomplete_sections(request, code_id):
+    """
+    Suggest a Code's titles, chapters, sections and so on for what's
+    been typed so far (``q``): a section number, a citation, a place
+    such as "Title 42 ch 21", or words of a name. See
+    ``law_code.autocomplete``; with the index import_us_code writes,
+    this runs one query, to check that the Code is public. Without
+    one, the index is built from the code's snapshot (see
+    ``snapshot.code_snapshot``) once per process and kept until the
+    code changes.
+
+    Returns JSON: ``{"query": ..., "results": [...]}``, with up to
+    ``limit`` (default 10) results, each with the Section's ``id``,
+    ``label``, ``name``, ``path`` and ``url``.
+
+    """
+    code = get_object_or_404(models.Code.objects.filter(public=True), id=int(code_id))
+    index = autocomplete.get_index(code.id)
+    if index is None:
+        index = autocomplete.tree_index(snapshot.code_snapshot(code))
+    query = request.GET.get("q", "")
+    try:
+        limit = min(max(int(request.GET.get("limit", 10)), 1), MAX_SUGGESTIONS)
+    except ValueError:
+        return HttpResponseBadRequest("limit must be a number")
+    url_prefix = reverse("view-code-section", args=[index.code_id, "-"])[:-1]
+    results = index.lookup(query, limit)
+    for result in results:
+        result["url"] = url_prefix + result["path"]
+    return HttpResponse(simplejson.dumps({"query": query, "results": results}),
+                        mimetype="application/json")
+
+
+def search_sections(request, template="law_code/search.html"):
+    """Ranked full-text search over the current Sections of public
+    Codes, using the index from ``law_code.search``. Pass ``code`` to
+    search a single Code.
+
+    """
+    index = search.get_index()
+    if index is None:
+        raise Http404("Search isn't configured")
+    query = request.GET.get("q", "").strip()
+    try:
+        code_id = int(request.GET.get("code", "")) or None
+    except ValueError:
+        code_id = None
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        raise Http404("No such page of results")
+    per_page = getattr(settings, "LAW_CODE_SEARCH_RESULTS_PER_PAGE", 20)
+
+    # Ask for one extra hit to find out whether there's a next page.
+    hits = index.search(query, code_id=code_id, limit=per_page + 1,
+                        offset=(page - 1) * per_page)
+    has_next = len(hits) > per_page
+    hits = hits[:per_page]
+    sections = models.Section.objects.filter(
+        code__public=True, current_version=True)\
+        .in_bulk([section_id for section_id, score, name, snippet in hits])
+    results = []
+    for section_id, score, name, snippet in hits:
+        if section_id in sections:
+            results.append({
+                "section": sections[section_id],
+                "name": mark_safe(name),
+                "snippet": mark_safe(snippet),
+                })
+    return direct_to_template(request, template, {
+        "query": query,
+        "code_id": code_id,
+        "results": results,
+        "page": page,
+        "previous_page": page > 1 and page - 1 or None,
+        "next_page": has_next and page + 1 or None,
+        })
+
+
+def _is_staff(request):
+    """Whether a staff member is logged in; never, without the auth
+    middleware (see settings_readonly.py).
+
+    """
+    user = getattr(request, "user", None)
+    return user is not None and user.is_authenticated() and user.is_staff
+
+
+def _staff_only(view):
+    """``staff_member_required``, or a 404 where there are no users
+    (see settings_readonly.py).
+
+    """
+    required = staff_member_required(view)
+    def wrapper(request, *args, **kwargs):
+        if not hasattr(request, "user"):
+            raise Http404("No such page")
+        return required(request, *args, **kwargs)
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+def request_stats(request, template="law_code/stats.html"):
+    """Rolling request statistics for each view, from
+    ``middleware.RequestStatsMiddleware``. Staff only.
+
+    """
+    dump = stats.get_stats().dump()
+    urls = []
+    for name in sorted(dump["urls"]):
+        urls.append({
+            "name": name,
+            "metrics": [(metric, dump["urls"][name][metric])
+                        for metric in dump["metrics"]],
+            })
+    return direct_to_template(request, template, {"stats": dump, "urls": urls})
+request_stats = _staff_only(request_stats)
+
+
+def request_stats_json(request):
+    """The same statistics as ``request_stats``, as JSON, for staff or
+    for requests with ``?token=`` set to ``LAW_CODE_STATS_TOKEN``.
+
+    """
+    token = getattr(settings, "LAW_CODE_STATS_TOKEN", None)
+    if not _is_staff(request) and not (token and request.GET.get("token") == token):
+        raise Http404("No such page")
+    return HttpResponse(simplejson.dumps(stats.get_stats().dump()),
+                        mimetype="application/json")
@@ -0,0 +1,70 @@
+/* Expands collapsed parts of the section tree in place, one level at a
+ * time, using the JSON from the law_code section_children view. Without
+ * JavaScript, the expand links just go to the section's own page. */
+(function () {
+    function escape(text) {
+        return String(text).replace(/&/g, "&amp;").replace(/</g, "&lt;")
+            .replace(/>/g, "&gt;").replace(/"/g, "&quot;");
+    }
+
+    function sectionDiv(level, html) {
+        var div = document.createElement("div");
+        div.className = "section";
+        div.style.marginLeft = level + "em";
+        div.innerHTML = "<h3>" + html + "</h3>";
+        return div;
+    }
+
+    function childDiv(child) {
+        var html = '<a href="' + escape(child.url) + '">' + escape(child.name) + "</a>";
+        if (child.has_children) {
+            html += ' <a class="expand" href="' + escape(child.url) +
+                '" data-children="' + escape(child.children_url) + '">[+]</a>';
+        }
+        return sectionDiv(child.level, html);
+    }
+
+    function expand(link) {
+        var request = new XMLHttpRequest();
+        request.open("GET", link.getAttribute("data-children"), true);
+        request.onreadystatechange = function () {
+            if (request.readyState != 4) {
+                return;
+            }
+            if (request.status != 200) {
+                window.location = link.href;
+                return;
+            }
+            var data = JSON.parse(request.responseText);
+            var div = link.parentNode.parentNode;
+            var after = div;
+            var ii, node;
+            for (ii = 0; ii < data.children.length; ii++) {
+                node = childDiv(data.children[ii]);
+                after.parentNode.insertBefore(node, after.nextSibling);
+                after = node;
+            }
+            if (data.next) {
+                node = sectionDiv(data.children[0].level,
+                    '<a class="expand more" href="' + escape(link.href) +
+                    '" data-children="' + escape(data.next) + '">More&hellip;</a>');
+                after.parentNode.insertBefore(node, after.nextSibling);
+            }
+            if (/\bmore\b/.test(link.className)) {
+                div.parentNode.removeChild(div);
+            } else {
+                link.parentNode.removeChild(link);
+            }
+        };
+        request.send(null);
+    }
+
+    document.addEventListener("click", function (event) {
+        var link = event.target;
+        if (!/\bexpand\b/.test(link.className) || !link.getAttribute("data-children")) {
+            return;
+        }
+        event.preventDefault();
+        expand(link);
+    }, false);
+})();
@@ -71,6 +71,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'law_code.middleware.RequestStatsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -149,6 +150,64 @@ SITE_NAME = "Law Code Browser"
 LOGIN_URL = "/account/login"
 LOGIN_REDIRECT_URLNAME = "what_next"
 
+# How many levels of the section tree the law_code pages render before
+# collapsing the rest behind expand links, and how many children the
+# expand links fetch at a time.
+LAW_CODE_TREE_DEPTH = 2
+LAW_CODE_CHILDREN_PER_PAGE = 200
+
+# The SQLite full-text index import_us_code builds for searching
+# Sections; set to None to turn search off.
+LAW_CODE_SEARCH_INDEX = os.path.join(PROJECT_ROOT, "search.db")
+LAW_CODE_SEARCH_RESULTS_PER_PAGE = 20
+
+# Store long section texts zlib-compressed.
+LAW_CODE_COMPRESS_CONTENT = True
+
+# The most citations one request to the citation resolver may give.
+LAW_CODE_MAX_CITATIONS = 20000
+
+# How many Sections the NDJSON/JSON export reads per query.
+LAW_CODE_EXPORT_BATCH_SIZE = 1000
+
+# Where rendered law_code pages are cached; any Django cache URI, eg
+# "memcached://127.0.0.1:11211/" or "file:///var/tmp/law_code_cache".
+# Entries beyond max_entries are culled.
+LAW_CODE_CACHE_BACKEND = "locmem:///?max_entries=5000&timeout=86400"
+
+# Where import_us_code writes each code's navigation snapshot and
+# autocomplete index, which the law_code views load into memory. With
+# None, navigation uses queries, and citation and autocomplete lookups
+# build the snapshot in memory once per process, and again after an
+# import changes the code.
+LAW_CODE_SNAPSHOT_DIR = os.path.join(PROJECT_ROOT, "snapshots")
+
+# How many seconds of request statistics law_code.middleware keeps, and
+# a token that lets monitoring fetch them from /law/stats.json?token=...
+# without logging in; None allows staff only.
+LAW_CODE_STATS_WINDOW = 3600
+LAW_CODE_STATS_TOKEN = None
+
+# Where import_us_code downloads the title files from when it isn't
+# given --directory, and where it keeps them between runs.
+LAW_CODE_DOWNLOAD_URL = "http://uscode.house.gov/download/ascii/"
+LAW_CODE_DOWNLOAD_DIR = os.path.join(PROJECT_ROOT, "downloads")
+
+# The formats of code import_us_code --format can import (see
+# law_code.pipeline), and where it keeps the checkpoint that lets an
+# import that stopped part way through carry on where it left off.
+LAW_CODE_FORMATS = ("law_code.us_code.USCodeFormat",)
+LAW_CODE_CHECKPOINT_DIR = os.path.join(PROJECT_ROOT, "checkpoints")
+
+# Where import_us_code publishes a read-only, optimized copy of the
+# (sqlite3) database when it finishes; None to not publish one. Web
+# workers serve from it with DATABASE_ENGINE = "law_code.readonly_sqlite"
+# and DATABASE_NAME = LAW_CODE_DB_SNAPSHOT, memory mapping up to
+# LAW_CODE_DB_MMAP_SIZE bytes with a LAW_CODE_DB_CACHE_SIZE KiB page cache.
+LAW_CODE_DB_SNAPSHOT = None
+LAW_CODE_DB_MMAP_SIZE = 1024 * 1024 * 1024
+LAW_CODE_DB_CACHE_SIZE = 64 * 1024
+
 # local_settings.py can be used to override environment-specific settings
 # like database and email that differ between development and production.
 try:
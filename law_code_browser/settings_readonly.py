@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Django settings for browse-only law_code web workers.
+#
+# Everything comes from settings.py, but a worker only serves the
+# law_code pages to anonymous readers: no sessions, logins, OpenID,
+# notifications or admin. So it runs none of their middleware or
+# context processors, and its URLconf (urls_readonly.py) doesn't import
+# the Pinax account stack at startup. Use it with
+# deploy/law_code_browser_readonly.wsgi, alongside a full deployment
+# that serves everything else.
+
+from settings import *
+
+MIDDLEWARE_CLASSES = (
+    'law_code.middleware.RequestStatsMiddleware',
+    'django.middleware.common.CommonMiddleware',
+)
+
+ROOT_URLCONF = 'law_code_browser.urls_readonly'
+
+# site_base.html without the login box and links to the rest of the site.
+TEMPLATE_DIRS = (
+    os.path.join(PROJECT_ROOT, "templates_readonly"),
+) + TEMPLATE_DIRS
+
+TEMPLATE_CONTEXT_PROCESSORS = (
+    "django.core.context_processors.media",
+    "misc.context_processors.site_name",
+)
+
+INSTALLED_APPS = (
+    'django.contrib.humanize',
+    'law_code',
+    'mptt',
+)
+
+# Serve from the snapshot import_us_code publishes, if there is one;
+# see law_code.dbsnapshot.
+if LAW_CODE_DB_SNAPSHOT:
+    DATABASE_ENGINE = 'law_code.readonly_sqlite'
+    DATABASE_NAME = LAW_CODE_DB_SNAPSHOT
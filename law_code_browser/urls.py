@@ -10,18 +10,10 @@ admin.autodiscover()
 
 import os
 
-from law_code.models import Code
-
-def index(request):
-    code_list = Code.objects.filter(public=True).order_by("name")
-    return direct_to_template(
-        request, 'law_code/code_list.html',
-        {"code_list": code_list})
-
 
 urlpatterns = patterns(
     '',
-    url(r'^$', index, {}, name="home"),
+    url(r'^$', 'law_code.views.code_list', {}, name="home"),
     (r'^law/', include('law_code.urls')),
 
     (r'^about/', include('about.urls')),
@@ -0,0 +1,16 @@
+# The URLconf of settings_readonly: just the law_code pages.
+
+from django.conf.urls.defaults import *
+from django.conf import settings
+
+
+urlpatterns = patterns(
+    '',
+    url(r'^$', 'law_code.views.code_list', {}, name="home"),
+    (r'^law/', include('law_code.urls')),
+)
+
+if settings.SERVE_MEDIA:
+    urlpatterns += patterns('', 
+        (r'^site_media/(?P<path>.*)$', 'misc.views.serve')
+    )